@@ -14,10 +14,13 @@ from tastypie import fields
 from tastypie import http
 
 from analytics.collectors.semantic import get_graph
-from dataman.processors import ClusterBuilder, GeoClusterBuilder, \
-     TweetNormalizer, normalize_aggressive, categorize_repr_docs
+from dataman.processors import TweetNormalizer, normalize_many, \
+     categorize_repr_docs, CENTRALITY_MODES
+from dataman.executors import categorize_clusters
+from dataman.clustering import get_cluster_builder, CLUSTER_ENGINES
+from dataman import resultcache, hotspots
 from dataman.elastic import create_or_update_doc, delete_doc, update_doc, \
-     search, FilterConverter, ES_KEYWORDS
+     search, get_sources, FilterConverter, ES_KEYWORDS
 from core.utils import RecordDict, flatten_list, avg_coords, \
      MalformedValueError, QUERY_TERMS
 from .auth import StaffAuthorization, UserAuthorization
@@ -148,6 +151,7 @@ class TweetResource(GeoJsonResource):
             'flood_probability': ('gte',),
             'lang': ('exact',),
             'country': ('exact',),
+            'region': ('exact',),
             'representative': ('exact',),
             }
         ordering = [
@@ -175,10 +179,13 @@ class TweetResource(GeoJsonResource):
         self.filters = {}
         self.sort = {}
         self.aggregate = {}
+        self.hotspots = None
 
     def normalize_object(self, bundle):
         try:
-            obj = TweetNormalizer(bundle.data).normalize()
+            obj = TweetNormalizer(
+                bundle.data, geocode_async=settings.GEOCODE_ASYNC
+                ).normalize()
         except Exception as err:
             LOG.error("{}: {}\n---FAILURE REPORT START---\n{}\n---FAILURE REPORT END---\n".format(
                 type(err), err, json.dumps(bundle.data, indent=4)))
@@ -293,6 +300,8 @@ class TweetResource(GeoJsonResource):
             buckets = prepare_buckets(key, buckets)
             aggregations.update({key: buckets})
 
+        if self.hotspots is not None:
+            aggregations.update(agg_hotspot=self.hotspots)
         return aggregations
 
     def apply_filters(self, request):
@@ -449,7 +458,8 @@ class TweetResource(GeoJsonResource):
                         }
                     }
                 })
-        if "agg_hotspot" in filters:
+        # Geohash cells, unless hotspots are found by `get_hotspots`.
+        if ("agg_hotspot" in filters) and (self.hotspots is None):
             precision = filters.get("agg_hotspot__precision", settings.HOTSPOTS_PRECISION)
             size = filters.get("agg_hotspot__size", settings.HOTSPOTS_MAX_NUMBER)
             aggregate_by.update({
@@ -470,6 +480,52 @@ class TweetResource(GeoJsonResource):
                 })
         return aggregate_by
 
+    def get_hotspots(self, **filters):
+        """
+        Density-based hotspots (see `dataman.hotspots`), if requested
+        with "agg_hotspot__engine=dbscan". Parameters:
+            - agg_hotspot__eps: max distance between neighbours (meters);
+            - agg_hotspot__min_entries: min number of docs around;
+            - agg_hotspot__size: max number of hotspots.
+        With more than settings.HOTSPOTS_MAX_DOCS docs, geohash cells of
+        "es" engine are aggregated instead.
+
+        :return: list of dicts or None (not requested, "es" engine or
+            too many docs).
+        """
+        if "agg_hotspot" not in filters:
+            return None
+        engine = filters.get("agg_hotspot__engine", settings.HOTSPOTS_ENGINE)
+        if engine not in hotspots.HOTSPOT_ENGINES:
+            raise ImmediateHttpResponse(response=http.HttpBadRequest(
+                "Wrong engine! Must be one of: {}".format(", ".join(hotspots.HOTSPOT_ENGINES))
+                ))
+        if engine != hotspots.ENGINE_DBSCAN:
+            return None
+
+        eps = float(filters.get("agg_hotspot__eps", settings.HOTSPOTS_EPS))
+        min_entries = int(filters.get("agg_hotspot__min_entries", settings.HOTSPOT_MIN_ENTRIES))
+        size = int(filters.get("agg_hotspot__size", settings.HOTSPOTS_MAX_NUMBER))
+        if eps <= 0:
+            raise ValueError("agg_hotspot__eps must be positive!")
+
+        # Repeated map loads (by any user) share the result. The key and
+        # the query have the same canonical filters.
+        filters = resultcache.canonical_filters(filters)
+
+        def find():
+            match = self.build_query(**filters)
+            es_filters = self.build_filters(**filters)
+            if es_filters:
+                match = {"bool": {"must": match, "filter": es_filters}}
+            return hotspots.get_hotspots(match, eps, min_entries, size=size)
+
+        result = resultcache.cached("hotspots", [], filters, find)
+        if result is None:
+            LOG.info("Too many docs for {} hotspots, {} engine is used".format(
+                hotspots.ENGINE_DBSCAN, hotspots.ENGINE_ES))
+        return result
+
     def obj_get_list(self, bundle, **kwargs):
         filters = {}
         self.messages = dict((x, []) for x in MSG_KEYS)
@@ -480,8 +536,9 @@ class TweetResource(GeoJsonResource):
         self.match = self.build_query(**filters)
         self.filters = self.build_filters(**filters)
         self.sort = self.get_order_by(**filters)
-        self.aggregate = self.get_aggregate_by(**filters)
         try:
+            self.hotspots = self.get_hotspots(**filters)
+            self.aggregate = self.get_aggregate_by(**filters)
             objects = self.apply_filters(bundle.request)
         except ValueError:
             raise ImmediateHttpResponse(response=http.HttpBadRequest(
@@ -501,6 +558,7 @@ class CategorizedTweetResource(TweetResource):
             "flood_probability": ("gte",),
             "lang": ("exact",),
             "country": ("exact",),
+            "region": ("exact",),
             }
         ordering = [
             settings.ES_TIMESTAMP_FIELD,
@@ -531,7 +589,7 @@ class CategorizedTweetResource(TweetResource):
                 ]
         return container
 
-    def _categorize_list(self, objects):
+    def _categorize_list(self, objects, centrality):
         """
         Categorizes list of objects to 'representative' and non-representative'.
         """
@@ -544,14 +602,20 @@ class CategorizedTweetResource(TweetResource):
                 doc = obj.copy()
             doc.update({
                 "_id": doc[self._meta.detail_uri_name],
-                "_normalized_text": normalize_aggressive(doc["text"])
+                "_normalized_text": doc.get("normalized_text", None),
+                "_fingerprint": doc.get("fingerprint", None)
                 })
             docs.append(doc)
-        categorized = categorize_repr_docs(docs)
+
+        # Only docs indexed before normalized text was stored.
+        missing = [doc for doc in docs if doc["_normalized_text"] is None]
+        for doc, text in zip(missing, normalize_many(x["text"] for x in missing)):
+            doc.update({"_normalized_text": text})
+        categorized = categorize_repr_docs(docs, centrality=centrality)
         prepared = self._prepare_categorized(categorized)
         return [{"docs": prepared}]
 
-    def _categorize_clusters(self, request, terms):
+    def _categorize_clusters(self, request, terms, centrality):
         """
         Categorizes documents to 'representative' and non-representative',
         seperating them to segments given by terms (procided by user).
@@ -559,19 +623,39 @@ class CategorizedTweetResource(TweetResource):
         Does not require list of objects, operates on user-provided filters.
         """
         filters = request.GET.dict()
-        if settings.ES_GEO_FIELD in terms:
-            # Clustering tweets by geolocation is different.
-            terms = tuple(x for x in terms if x != settings.ES_GEO_FIELD)
-            cb = GeoClusterBuilder(*terms, **filters)
-        else:
-            cb = ClusterBuilder(*terms, **filters)
-        clusters = cb.get_clusters()
+        filters.pop("centrality", None)
+        # Requests of the same segments and time range (by any user)
+        # share the result. Clusters are built with the same canonical
+        # filters, so they hold only docs of the requested range.
+        filters = resultcache.canonical_filters(filters)
+
+        def categorize():
+            cb = get_cluster_builder(*terms, **filters)
+            clusters = cb.get_clusters()
+
+            # Select representative tweets for each cluster. Only ids and
+            # scores are kept (and cached), not bodies of docs.
+            categorized = categorize_clusters(clusters.clusters, centrality=centrality)
+            for cluster, categorized_docs in zip(clusters.clusters, categorized):
+                cluster["docs"] = dict(
+                    (key, [dict((x, doc[x]) for x in ("_id", "_multiplicity", "_centrality"))
+                           for doc in docs])
+                    for key, docs in categorized_docs.items()
+                    )
+            return clusters.clusters
+
+        clusters = resultcache.cached(
+            "categorized:{}".format(centrality), terms, filters, categorize)
 
-        # Select representative tweets for each cluster.
-        for cluster in clusters.clusters:
-            categorized = categorize_repr_docs(cluster["docs"])
-            cluster["docs"] = self._prepare_categorized(categorized)
-        return clusters.clusters
+        # Texts of all docs at once.
+        docs = [doc for cluster in clusters
+                for container in cluster["docs"].values() for doc in container]
+        sources = get_sources([doc["_id"] for doc in docs], ["text"])
+        for doc in docs:
+            doc["text"] = sources.get(doc["_id"], {}).get("text")
+        for cluster in clusters:
+            cluster["docs"] = self._prepare_categorized(cluster["docs"])
+        return clusters
 
     def _categorize(self, request, objects):
         terms = request.GET.get('terms', '')
@@ -580,10 +664,21 @@ class CategorizedTweetResource(TweetResource):
         assert type(terms) in [list, tuple], \
             "Wrong terms type! Must be list or tuple!"
 
+        centrality = request.GET.get("centrality", settings.REPR_CENTRALITY)
+        if centrality not in CENTRALITY_MODES:
+            raise ImmediateHttpResponse(response=http.HttpBadRequest(
+                "Wrong centrality! Must be one of: {}".format(", ".join(CENTRALITY_MODES))
+                ))
+        engine = request.GET.get("engine", settings.CLUSTER_ENGINE)
+        if engine not in CLUSTER_ENGINES:
+            raise ImmediateHttpResponse(response=http.HttpBadRequest(
+                "Wrong engine! Must be one of: {}".format(", ".join(CLUSTER_ENGINES))
+                ))
+
         if terms:
-            categorized = self._categorize_clusters(request, terms)
+            categorized = self._categorize_clusters(request, terms, centrality)
         else:
-            categorized = self._categorize_list(objects)
+            categorized = self._categorize_list(objects, centrality)
         return categorized
 
     def alter_list_data_to_serialize(self, request, data):
@@ -0,0 +1,189 @@
+"""
+Benchmark of entity extraction in `TweetNormalizer.normalize`:
+legacy recursive `collect_hashtags` + `collect_media_urls` (two walks)
+vs. single-walk `collect_entities`.
+
+Tweets are either read from a file (JSON list of raw tweets, or one
+tweet per line), or generated: retweets of quoted tweets with extended
+entities, as they come from the streaming API.
+
+Usage: python benchmarks/bench_entities.py [-f tweets.json] [-n 10000]
+"""
+import os
+import sys
+import copy
+import json
+import time
+import optparse
+from collections.abc import MutableMapping
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../'))
+
+from dataman.entities import collect_entities, extract_hatshtags
+
+
+def legacy_collect_hashtags(data, hashtags):
+    for val in data.values():
+        if isinstance(val, MutableMapping):
+            _hatshtags = legacy_collect_hashtags(val, hashtags)
+        else:
+            _hatshtags = extract_hatshtags(val)
+
+        hashtags.extend(_hatshtags)
+    return list(set(hashtags))
+
+
+def legacy_collect_media_urls(data, media_urls):
+    for val in data.values():
+        if isinstance(val, MutableMapping):
+            _media_urls = legacy_collect_media_urls(val, media_urls)
+        elif isinstance(val, list):
+            _media_urls = []
+            for item in val:
+                try:
+                    _media_urls.append(item["media_url"])
+                except (KeyError, TypeError):
+                    pass
+                try:
+                    _media_urls.append(item["media_url_https"])
+                except (KeyError, TypeError):
+                    pass
+        else:
+            continue
+
+        media_urls.extend(_media_urls)
+    return list(set(media_urls))
+
+
+def legacy(tweet):
+    return {
+        "hashtags": set(legacy_collect_hashtags(tweet, [])),
+        "media_urls": set(legacy_collect_media_urls(tweet, [])),
+        }
+
+
+def make_user(idx):
+    return {
+        "id": 1000 + idx,
+        "id_str": str(1000 + idx),
+        "name": "User {}".format(idx),
+        "screen_name": "user_{}".format(idx),
+        "location": "Houston, TX",
+        "description": "Storm chaser #weather #wx #txwx",
+        "followers_count": 1500,
+        "friends_count": 300,
+        "created_at": "Mon Apr 02 11:16:01 +0000 2012",
+        "lang": "en",
+        "profile_image_url": "http://pbs.twimg.com/profile_images/{}/a.jpg".format(idx),
+        }
+
+
+def make_status(idx, text, hashtags, nested=None, nested_key=None):
+    media = [{
+        "id": 5000 + idx,
+        "type": "photo",
+        "media_url": "http://pbs.twimg.com/media/{}.jpg".format(idx),
+        "media_url_https": "https://pbs.twimg.com/media/{}.jpg".format(idx),
+        "url": "https://t.co/{}".format(idx),
+        "sizes": {"small": {"w": 680, "h": 453, "resize": "fit"},
+                  "large": {"w": 2048, "h": 1365, "resize": "fit"}},
+        }]
+    status = {
+        "created_at": "Tue Jun 26 19:12:00 +0000 2018",
+        "id": idx,
+        "id_str": str(idx),
+        "text": text,
+        "lang": "en",
+        "user": make_user(idx),
+        "place": None,
+        "coordinates": None,
+        "entities": {
+            "hashtags": [{"text": tag, "indices": [0, len(tag) + 1]} for tag in hashtags],
+            "urls": [{"url": "https://t.co/x{}".format(idx),
+                      "expanded_url": "https://example.com/{}".format(idx)}],
+            "user_mentions": [{"screen_name": "user_{}".format(idx + 1)}],
+            "media": media,
+            },
+        "extended_entities": {"media": media},
+        "extended_tweet": {
+            "full_text": text + " more at https://t.co/x{}".format(idx),
+            "entities": {
+                "hashtags": [{"text": tag, "indices": [0, 1]} for tag in hashtags],
+                "media": media,
+                },
+            },
+        }
+    if nested is not None:
+        status[nested_key] = nested
+    return status
+
+
+def generate_tweets(size):
+    tweets = []
+    for idx in range(size):
+        quoted = make_status(
+            3*idx, "Flash Flood Warning for #Houston until 9 PM #txwx #flood",
+            ["Houston", "txwx", "flood"]
+            )
+        quote = make_status(
+            3*idx + 1, "Roads are closed #flood #HoustonFlood stay safe",
+            ["flood", "HoustonFlood"], quoted, "quoted_status"
+            )
+        tweet = make_status(
+            3*idx + 2, "RT @user_{}: Roads are closed #flood #HoustonFlood".format(idx),
+            ["flood", "HoustonFlood"], quote, "retweeted_status"
+            )
+        tweet["annotations"] = {"flood_probability": [0.1, 0.9]}
+        tweets.append(tweet)
+    return tweets
+
+
+def load_tweets(fname):
+    with open(fname) as f:
+        content = f.read()
+    try:
+        tweets = json.loads(content)
+    except ValueError:
+        tweets = [json.loads(line) for line in content.splitlines() if line.strip()]
+    if isinstance(tweets, dict):
+        tweets = [tweets]
+    return tweets
+
+
+def timed(func, tweets):
+    # Work on copies, timing should not depend on previous runs.
+    tweets = copy.deepcopy(tweets)
+    started = time.time()
+    results = [func(tweet) for tweet in tweets]
+    return time.time() - started, results
+
+
+def main(tweets):
+    time_legacy, expected = timed(legacy, tweets)
+    time_single, results = timed(collect_entities, tweets)
+    assert results == expected, "Results differ from the legacy ones!"
+    print("tweets: {}".format(len(tweets)))
+    print("legacy (2 walks): {:.3f}s".format(time_legacy))
+    print("collect_entities: {:.3f}s ({:.1f}x)".format(
+        time_single, time_legacy / time_single))
+
+
+if __name__ == '__main__':
+    cmdparser = optparse.OptionParser(usage="usage: python %prog [OPTIONS]")
+    cmdparser.add_option("-f", "--file",
+                         action="store",
+                         dest="fname",
+                         default=None,
+                         help="File with raw tweets (JSON list or one per line)")
+    cmdparser.add_option("-n", "--number",
+                         action="store",
+                         dest="number",
+                         default=10000,
+                         type=int,
+                         help="Number of generated tweets, ignored if -f "
+                              "is given [default \'%default\']")
+    opts, args = cmdparser.parse_args()
+    if opts.fname:
+        main(load_tweets(opts.fname))
+    else:
+        main(generate_tweets(opts.number))
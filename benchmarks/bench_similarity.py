@@ -0,0 +1,107 @@
+"""
+Benchmark of similarity computations in `categorize_repr_docs`:
+legacy ordered double loops (two of them) vs. SimilarityKernel.
+
+Usage: python benchmarks/bench_similarity.py [-s 100,1000,5000] [-l 1000]
+"""
+import os
+import sys
+import time
+import random
+import optparse
+from string import ascii_lowercase
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../'))
+
+from Levenshtein import ratio
+
+from dataman.similarity import SimilarityKernel, near_duplicate_pairs, \
+     SIMILAR_PREDICTION_EDIT_DISTANCE_MAX
+
+
+def generate_texts(size, seed=0):
+    """
+    Tweet-like texts: a fifth of originals, the rest are retweets,
+    texts with links and truncated copies.
+    """
+    rnd = random.Random(seed)
+    words = ["".join(rnd.choice(ascii_lowercase) for _ in range(rnd.randint(2, 9)))
+             for _ in range(3000)]
+    originals = [" ".join(rnd.choice(words) for _ in range(rnd.randint(6, 20)))
+                 for _ in range(max(1, size // 5))]
+    texts = []
+    for _ in range(size):
+        text = rnd.choice(originals)
+        dice = rnd.random()
+        if dice < 0.3:
+            text = "RT _USER_ : " + text
+        elif dice < 0.5:
+            text = text + " _URL_"
+        elif dice < 0.6:
+            text = text[:int(len(text)*0.9)]
+        texts.append(text)
+    return texts
+
+
+def legacy(texts):
+    """
+    Similarity work of the original `categorize_repr_docs`.
+    """
+    duplicates = set()
+    for i, tu in enumerate(texts):
+        for j, tv in enumerate(texts):
+            if ratio(tu, tv) > SIMILAR_PREDICTION_EDIT_DISTANCE_MAX:
+                duplicates.add((min(i, j), max(i, j)))
+    similarities = [0.] * len(texts)
+    for i, tu in enumerate(texts):
+        for j, tv in enumerate(texts):
+            similarity = ratio(tu, tv)
+            similarities[i] += similarity
+            similarities[j] += similarity
+    return similarities, duplicates
+
+
+def timed(func, *args):
+    started = time.time()
+    func(*args)
+    return time.time() - started
+
+
+def main(sizes, legacy_max):
+    print("{:>6} {:>12} {:>12} {:>8} {:>14}".format(
+        "n", "legacy, s", "kernel, s", "speedup", "duplicates, s"))
+    for size in sizes:
+        texts = generate_texts(size)
+        kernel = SimilarityKernel(texts)
+        time_kernel = timed(kernel.scan)
+        if size <= legacy_max:
+            time_legacy = timed(legacy, texts)
+            mark = ""
+        else:
+            # Quadratic extrapolation from the largest measured size.
+            sample = generate_texts(legacy_max)
+            time_legacy = timed(legacy, sample) * (float(size) / legacy_max)**2
+            mark = "*"
+        time_dups = timed(near_duplicate_pairs, texts)
+        print("{:>6} {:>11.2f}{:1} {:>12.2f} {:>7.1f}x {:>14.2f}".format(
+            size, time_legacy, mark, time_kernel, time_legacy / time_kernel, time_dups))
+    if any(size > legacy_max for size in sizes):
+        print("* extrapolated from n={}".format(legacy_max))
+
+
+if __name__ == '__main__':
+    cmdparser = optparse.OptionParser(usage="usage: python %prog [OPTIONS]")
+    cmdparser.add_option("-s", "--sizes",
+                         action="store",
+                         dest="sizes",
+                         default="100,1000,5000",
+                         help="Comma-separated numbers of docs [default \'%default\']")
+    cmdparser.add_option("-l", "--legacy_max",
+                         action="store",
+                         dest="legacy_max",
+                         default=5000,
+                         type=int,
+                         help="Largest n to run the legacy loops on, bigger "
+                              "ones are extrapolated [default \'%default\']")
+    opts, args = cmdparser.parse_args()
+    main([int(x) for x in opts.sizes.split(",")], opts.legacy_max)
@@ -5,10 +5,15 @@ import sys
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings.base')
 
+# Tasks use models (geocoding cache, representatives state).
+import django
+django.setup()
+
 from django.conf import settings
 from django.utils import timezone
 
 from celery import Celery
+from celery.signals import worker_process_init
 from celery.task.base import periodic_task
 from celery.task.schedules import crontab
 
@@ -16,40 +21,75 @@ import datetime
 import logging
 import geopy
 
-from dataman import cassandra, elastic
-from dataman.processors import categorize_repr_docs, TweetNormalizer, \
-     ClusterBuilder, GeoClusterBuilder
+from dataman import cassandra, elastic, nlp
+from core import gazetteer, geocoding
+from dataman.processors import TweetNormalizer, set_countries, cc, rc
+from dataman.executors import categorize_clusters
+from dataman.clustering import get_cluster_builder
+from dataman.representatives import SegmentRepresentatives, \
+     UncategorizedClusterBuilder, segment_key
 
 app = Celery('celerytasks')
 app.conf.broker_url = settings.BROKER_URL
 app.conf.result_backend = settings.RESULT_BACKEND
 app.conf.accept_content = settings.CELERY_ACCEPT_CONTENT
+app.conf.task_routes = {
+    'celerytasks.geocode_places': {'queue': settings.GEOCODE_QUEUE}
+    }
 
 
 INDEX_UPDATE_TIME_LIMIT = settings.CASSANDRA_BEAT + 60
 LOG = logging.getLogger("tasks")
 
 
+@worker_process_init.connect
+def warm_up_worker(**kwargs):
+    """
+    Loads NLP models and gazetteer once per worker process, before it
+    gets any task.
+    """
+    loaded = nlp.warm_up()
+    LOG.debug("NER models loaded: {}".format(loaded))
+    gazetteer.get_gazetteer()
+
+
 @periodic_task(run_every=crontab(minute=settings.GEO_TAG_INTERVAL))
 def fill_geotags(time_limit=settings.GEO_TAG_INTERVAL*60*0.95):
     def _delete(id_, reason):
         elastic.delete_doc(id_)
         LOG.debug("{} deleted. Reason: {}".format(id_, reason))
 
-    query = {
+    # Docs waiting for geocoded places, the oldest first (the backlog
+    # doesn't starve them), then a bounded batch of unmarked docs (e.g.
+    # indexed before the mark): they get the mark below.
+    has_location = {"exists": {"field": "location"}}
+    pending_query = {
         "query": {
             "bool": {
-                "must_not": {
-                    "exists": {
-                        "field": "location"
-                        }
-                    }
+                "filter": {"term": {"geo_pending": True}},
+                "must_not": has_location
                 }
             },
-        "size":settings.ES_MAX_RESULTS
+        "sort": [{settings.ES_TIMESTAMP_FIELD: "asc"}],
+        "size": settings.ES_MAX_RESULTS
         }
-    queryset = elastic.search(query)
-    for hit in queryset["hits"]["hits"]:
+    unmarked_query = {
+        "query": {
+            "bool": {
+                "must_not": [has_location, {"exists": {"field": "geo_pending"}}]
+                }
+            },
+        "sort": [{settings.ES_TIMESTAMP_FIELD: "asc"}],
+        "size": settings.GEO_TAG_UNMARKED_BATCH
+        }
+    hits = []
+    for query in (pending_query, unmarked_query):
+        queryset = elastic.search(query)
+        if queryset is not None:
+            hits.extend(queryset["hits"]["hits"])
+
+    norms = []
+    for hit in hits:
         doc = hit["_source"]
 
         # Mock fields to use original methods of TweetNormalizer.
@@ -68,18 +108,98 @@ def fill_geotags(time_limit=settings.GEO_TAG_INTERVAL*60*0.95):
             LOG.debug(exc)
             continue
 
-        norm = TweetNormalizer(doc)
+        # Docs should never wait for Nominatim here: places that are still
+        # unknown are in the geocoding queue, their docs are completed
+        # by the next run.
+        norms.append(TweetNormalizer(doc, geocode_async=settings.GEOCODE_ASYNC))
+
+    # Analyze all texts at once.
+    analyses = nlp.analyze_many([norm.original["text"] for norm in norms])
+    geotagged = []
+    marks = []
+    for norm, analysis in zip(norms, analyses):
+        doc = norm.original
         try:
-            geotagged = norm.set_geotag()
-        except geopy.exc.GeocoderQuotaExceeded as exc:
-            # Passively stop, it isn't our fault... Hope for future.
+            if norm.set_geotag(analysis):
+                geotagged.append(norm)
+                continue
+            # Still waiting for places, or all of them are known and none
+            # fits (not pending anymore).
+            pending = bool(norm.geo_pending)
+        except geopy.exc.GeopyError as exc:
+            # Quota exceeded or Nominatim failed - passively stop, it
+            # isn't our fault... Hope for future.
             LOG.debug("{} postponed. Reason: {}".format(doc["tweetid"], exc))
-        else:
-            if geotagged:
-                norm.set_country()
-                norm.set_region()
-                elastic.create_or_update_doc(doc["tweetid"], norm.normalized)
-                LOG.debug("{} updated".format(doc["tweetid"]))
+            pending = True
+        if doc.get("geo_pending") is not pending:
+            marks.append((doc["tweetid"], {"geo_pending": pending}))
+
+    # Look up countries and save docs at once.
+    set_countries(geotagged)
+    for norm in geotagged:
+        norm.normalized.pop("geo_pending", None)
+    results = elastic.bulk_create_or_update(
+        [(norm.original["tweetid"], norm.normalized) for norm in geotagged])
+    for norm, result in zip(geotagged, results):
+        LOG.debug("{} {}".format(norm.original["tweetid"], result))
+
+    # Marks don't change clusters.
+    results = elastic.bulk_update(marks, invalidate=False)
+    for (id_, fields), result in zip(marks, results):
+        LOG.debug("{} geo_pending={}: {}".format(id_, fields["geo_pending"], result))
+
+
+@app.task(ignore_result=True)
+def fill_countries(regions=False):
+    """
+    Sets country and region of all geotagged docs that don't have a
+    country (e.g. after changes in world borders), page by page: countries
+    and regions of a page are looked up at once, docs are updated in bulk.
+    Run it with `core/management/commands/fill_countries.py`.
+
+    :param regions: bool - also docs that don't have a region (e.g. after
+        changes in settings.REGIONS_FILE). Docs out of all regions are
+        checked on every run.
+    """
+    missing = [{"exists": {"field": "country"}}]
+    if regions:
+        missing.append({"exists": {"field": "region"}})
+    query = {
+        "query": {
+            "bool": {
+                "must": {"exists": {"field": "location"}},
+                "must_not": missing
+                }
+            },
+        "_source": ["location", "country", settings.ES_TIMESTAMP_FIELD],
+        "size": settings.ES_SCROLL_BATCHSIZE
+        }
+    results = {}
+    response = elastic.search(query, scroll=True)
+    while response and response["hits"]["hits"]:
+        hits = response["hits"]["hits"]
+        lats = [hit["_source"]["location"]["lat"] for hit in hits]
+        lons = [hit["_source"]["location"]["lon"] for hit in hits]
+        # Timestamps limit invalidation of cached results to their buckets.
+        updates = []
+        for hit, country, region in zip(hits, cc.get_countries(lats, lons),
+                                        rc.get_regions(lats, lons)):
+            fields = {}
+            if "country" not in hit["_source"]:
+                fields["country"] = str(country)
+            if region is not None:
+                fields["region"] = region
+            if not fields:
+                continue
+            if settings.ES_TIMESTAMP_FIELD in hit["_source"]:
+                fields[settings.ES_TIMESTAMP_FIELD] = hit["_source"][settings.ES_TIMESTAMP_FIELD]
+            updates.append((hit["_id"], fields))
+        for result in elastic.bulk_update(updates):
+            results[result] = results.get(result, 0) + 1
+        response = elastic.scroll(response["_scroll_id"])
+
+    LOG.info("[fill_countries] finished: {}".format(results))
+    return results
 
 
 def update_doc(doc):
@@ -101,19 +221,41 @@ def update_doc(doc):
     return doc
 
 
-def process_doc(_id, doc):
-    norm = TweetNormalizer(doc)
-    obj = norm.normalize()
+def index_doc(_id, norm, analysis=None):
+    """
+    :param norm: TweetNormalizer instance.
+    :param analysis: nlp.Analysis of the text (analyzed if not given).
+    """
+    obj = norm.normalize(analysis=analysis)
     try:
         res = elastic.create_or_update_doc(_id, obj)
     except Exception as err:
         print("! [process_doc] Could not add doc {} to index:\n  {}".format(
-            doc['tweetid'], err))
+            obj['tweetid'], err))
         res = 'failed'
     # If sucessful `res` is either 'created' or 'updated'
     return res
 
 
+def process_doc(_id, doc, analysis=None):
+    norm = TweetNormalizer(doc, geocode_async=settings.GEOCODE_ASYNC)
+    return index_doc(_id, norm, analysis)
+
+
+@app.task(ignore_result=True)
+def geocode_places(places):
+    """
+    Geocodes places submitted by `geocoding.enqueue` (results are cached).
+    """
+    for place in places:
+        try:
+            geocoding.geocode(place)
+        except geopy.exc.GeopyError as exc:
+            LOG.debug("Failed to geocode {}: {}".format(place, exc))
+        finally:
+            geocoding.release(place)
+
+
 def es_index_update(timestamp, timestamp_to=None):
     elastic.ensure_mapping()
     cass = cassandra.CassandraProxy()
@@ -157,8 +299,16 @@ def es_index_update(timestamp, timestamp_to=None):
 @app.task
 def process_batch(batch):
     results = {'created': 0, 'updated': 0, 'failed': 0}
-    for rec in batch:
-        result = process_doc(rec['_id'], rec['_source'])
+    norms = [TweetNormalizer(rec['_source'], geocode_async=settings.GEOCODE_ASYNC)
+             for rec in batch]
+    analyses = nlp.analyze_many([norm.original["text"] for norm in norms])
+    geotagged = [norm for norm, analysis in zip(norms, analyses)
+                 if norm.preprocess(analysis)]
+    # Look up countries of the whole batch at once.
+    set_countries(geotagged)
+
+    docs = [(rec['_id'], norm.postprocess()) for rec, norm in zip(batch, norms)]
+    for result in elastic.bulk_create_or_update(docs):
         results[result] += 1
     print("..[process_batch] Processed {}".format(results))
     return results
@@ -187,29 +337,60 @@ def full_reindex():
 
 
 def set_representative_flag(*terms, **filters):
-    if settings.ES_GEO_FIELD in terms:
-        # Clustering tweets by geolocation.
-        terms = tuple(x for x in terms if x != settings.ES_GEO_FIELD)
-        cb = GeoClusterBuilder(*terms, **filters)
-    else:
-        cb = ClusterBuilder(*terms, **filters)
-    result = cb.get_clusters()
+    """
+    :terms: list of terms to group by.
+    :filters: filters for ClusterBuilder. Special keys:
+        - 'centrality' is one of CENTRALITY_MODES (settings.REPR_CENTRALITY
+          by default).
+        - 'engine' is one of CLUSTER_ENGINES (settings.CLUSTER_ENGINE by
+          default).
+    """
+    centrality = filters.pop("centrality", settings.REPR_CENTRALITY)
+    result = get_cluster_builder(*terms, **filters).get_clusters()
 
     # Select representative tweets for each cluster.
+    for categorized in categorize_clusters(result["clusters"], centrality=centrality):
+        # Update "representative" flag.
+        for doc in categorized["non_representative_docs"]:
+            elastic.update_doc(doc["_id"], representative=False)
+
+        for doc in categorized["representative_docs"]:
+            elastic.update_doc(doc["_id"], representative=True)
+
+
+def update_representative_flag(*terms, **filters):
+    """
+    Incremental version of `set_representative_flag`: categorizes only
+    docs that haven't been flagged yet, against representatives of
+    their segments stored since previous runs.
+
+    :terms: list of terms to group by (clustering by geo-location is
+        not supported: geo-cells are not stable between runs).
+    :filters: filters for ClusterBuilder.
+    """
+    assert settings.ES_GEO_FIELD not in terms, \
+        "Cannot segment by {} incrementally!".format(settings.ES_GEO_FIELD)
+
+    cb = UncategorizedClusterBuilder(*terms, **filters)
+    result = cb.get_clusters()
     for cluster in result["clusters"]:
-        categorized = categorize_repr_docs(cluster["docs"])
+        state = SegmentRepresentatives.load(segment_key(cluster))
+        categorized = state.update(cluster["docs"])
+        state.save()
 
-        # Update "representative" flag.
         for doc in categorized["non_representative_docs"]:
-            elastic.update_doc(doc["_id"], reprsentative=False)
+            elastic.update_doc(doc["_id"], representative=False)
 
         for doc in categorized["representative_docs"]:
-            elastic.update_doc(doc["_id"], reprsentative=True)
+            elastic.update_doc(doc["_id"], representative=True)
+
+        for _id in categorized["demoted"]:
+            elastic.update_doc(_id, representative=False)
 
 
 @periodic_task(run_every=crontab(minute=settings.STREAM_TIMEFRAME))
 def task_mark_representative_tweets():
     timestamp_gte = settings.ES_TIMESTAMP_FIELD + '__gte'
-    past = (timezone.now() - timezone.timedelta(minutes=settings.STREAM_TIMEFRAME))
+    past = (timezone.now() - timezone.timedelta(minutes=settings.REPR_STATE_TTL))
     filters = {timestamp_gte: past.isoformat()}
-    set_representative_flag(filters)
+    update_representative_flag(*settings.REPR_SEGMENT_TERMS, **filters)
@@ -2,6 +2,8 @@ from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import User
 
+from .models import GeocodeCache
+
 
 def admin_method_attrs(**outer_kwargs):
     """
@@ -63,3 +65,10 @@ class AppUserAdmin(UserAdmin):
 
 admin.site.unregister(User)
 admin.site.register(User, AppUserAdmin)
+
+
+@admin.register(GeocodeCache)
+class GeocodeCacheAdmin(admin.ModelAdmin):
+    list_display = ('place', 'key', 'lat', 'lon', 'hits', 'updated')
+    search_fields = ('place', 'key')
+    ordering = ('-hits',)
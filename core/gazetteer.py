@@ -0,0 +1,234 @@
+"""
+Offline geocoding of place names with a GeoNames gazetteer.
+
+The gazetteer (e.g. cities15000.txt or cities15000.zip from
+http://download.geonames.org/export/dump/) is loaded once per process
+into a sorted array of normalized names (names, ascii names and
+alternate names of all places), which serves exact and prefix lookups
+with binary search. Entries with the same name are ordered by
+population, so the most populous place wins unless the place string
+is qualified by a country or admin1 code ("London, CA" or
+"Houston, TX").
+"""
+import io
+import os
+import bisect
+import logging
+import zipfile
+
+import numpy
+
+from django.conf import settings
+
+from core.utils import normalize_place
+
+
+LOG = logging.getLogger("geocoding")
+
+# Columns of GeoNames "geoname" table.
+GEONAMES_COLUMNS = {
+    "name": 1,
+    "asciiname": 2,
+    "alternatenames": 3,
+    "latitude": 4,
+    "longitude": 5,
+    "country_code": 8,
+    "admin1_code": 10,
+    "population": 14,
+    }
+
+# Shorter names are abbreviations too often.
+MIN_NAME_LENGTH = 3
+
+# Generic words after a place name that don't change the place
+# ("Houston area"). Other trailing words may (e.g. "Orange County").
+PLACE_SUFFIXES = {
+    "area", "city", "downtown", "metro", "centre", "center", "region",
+    }
+
+# Qualifiers that are neither country nor admin1 codes.
+COUNTRY_ALIASES = {
+    "uk": "gb",
+    "united kingdom": "gb",
+    "england": "gb",
+    "scotland": "gb",
+    "wales": "gb",
+    "usa": "us",
+    "united states": "us",
+    }
+
+
+class Gazetteer(object):
+    """
+    In-memory index of places.
+    """
+    def __init__(self, places, alternate_names=True):
+        """
+        :param places: iterable of dicts with keys "name", "asciiname",
+            "alternatenames" (list of str), "latitude", "longitude",
+            "country_code", "admin1_code" and "population".
+        :param alternate_names: bool - index alternate names, too.
+        """
+        lat, lon, population = [], [], []
+        self.country_codes, self.admin1_codes = [], []
+        entries = set()
+        for idx, place in enumerate(places):
+            lat.append(place["latitude"])
+            lon.append(place["longitude"])
+            population.append(place["population"])
+            self.country_codes.append(place["country_code"].lower())
+            self.admin1_codes.append(place["admin1_code"].lower())
+
+            names = [place["name"], place["asciiname"]]
+            if alternate_names:
+                names.extend(place["alternatenames"])
+            for name in names:
+                name = normalize_place(name)
+                if len(name) >= MIN_NAME_LENGTH:
+                    entries.add((name, idx))
+
+        self.lat = numpy.array(lat, dtype=numpy.float64)
+        self.lon = numpy.array(lon, dtype=numpy.float64)
+        self.population = numpy.array(population, dtype=numpy.int64)
+
+        # Sorted by name, then by population (descending).
+        entries = sorted(entries, key=lambda x: (x[0], -self.population[x[1]]))
+        self.names = [name for name, _ in entries]
+        self.refs = numpy.array([idx for _, idx in entries], dtype=numpy.int32)
+
+    def __len__(self):
+        return len(self.lat)
+
+    @classmethod
+    def load(cls, fname, min_population=0, alternate_names=True):
+        """
+        Loads places from GeoNames dump (txt or zip).
+
+        :param fname: str - file name.
+        :param min_population: int - skip smaller places.
+        :return: Gazetteer
+        """
+        return cls(read_geonames(fname, min_population), alternate_names)
+
+    def candidates(self, name):
+        """
+        :param name: str - normalized name.
+        :return: list of int - indexes of places with this name, the
+            most populous first.
+        """
+        start = bisect.bisect_left(self.names, name)
+        end = bisect.bisect_right(self.names, name, lo=start)
+        return self.refs[start:end].tolist()
+
+    def match_qualifiers(self, candidates, qualifiers):
+        """
+        Leaves only places in countries or admin1 units from qualifiers.
+        """
+        codes = set(COUNTRY_ALIASES.get(x, x) for x in qualifiers)
+        return [idx for idx in candidates
+                if (self.country_codes[idx] in codes) \
+                or (self.admin1_codes[idx] in codes)]
+
+    def lookup(self, place):
+        """
+        Figures out geo-coords for a given place: "name[, qualifier...]".
+        If the name isn't known, it is tried without generic suffixes
+        ("Houston area" -> "houston", see PLACE_SUFFIXES).
+
+        :param place: str.
+        :return: dict {lat: <float>, lon: <float>} or empty dict, if unsuccessfull.
+        """
+        parts = [normalize_place(x) for x in place.split(",")]
+        qualifiers = [x for x in parts[1:] if x]
+        words = parts[0].split()
+        candidates = self.candidates(" ".join(words))
+        while (not candidates) and (len(words) > 1) and (words[-1] in PLACE_SUFFIXES):
+            words = words[:-1]
+            candidates = self.candidates(" ".join(words))
+
+        if candidates and qualifiers:
+            # Unknown qualifiers ("London, Ontario") make the place ambiguous.
+            candidates = self.match_qualifiers(candidates, qualifiers)
+
+        if not candidates:
+            return {}
+
+        idx = candidates[0]
+        return {"lat": float(self.lat[idx]), "lon": float(self.lon[idx])}
+
+
+def read_geonames(fname, min_population=0):
+    """
+    Reads places from GeoNames dump (tab-separated, txt or zip).
+
+    :param fname: str - file name.
+    :param min_population: int - skip smaller places.
+    :return: generator of dicts (see `Gazetteer`).
+    """
+    if fname.endswith(".zip"):
+        archive = zipfile.ZipFile(fname)
+        member = os.path.splitext(os.path.basename(fname))[0] + ".txt"
+        f = io.TextIOWrapper(archive.open(member), encoding="utf-8")
+    else:
+        f = open(fname, encoding="utf-8")
+
+    cols = GEONAMES_COLUMNS
+    with f:
+        for line in f:
+            row = line.rstrip("\n").split("\t")
+            try:
+                population = int(row[cols["population"]] or 0)
+                place = {
+                    "name": row[cols["name"]],
+                    "asciiname": row[cols["asciiname"]],
+                    "alternatenames": [
+                        x for x in row[cols["alternatenames"]].split(",") if x
+                        ],
+                    "latitude": float(row[cols["latitude"]]),
+                    "longitude": float(row[cols["longitude"]]),
+                    "country_code": row[cols["country_code"]],
+                    "admin1_code": row[cols["admin1_code"]],
+                    "population": population
+                    }
+            except (IndexError, ValueError):
+                LOG.warning("Malformed gazetteer line: {}".format(line[:100]))
+                continue
+
+            if population >= min_population:
+                yield place
+
+
+_GAZETTEER = None
+
+
+def get_gazetteer():
+    """
+    :return: Gazetteer loaded from settings.GEONAMES_FILE (once per
+        process), or None if the file is not available.
+    """
+    global _GAZETTEER
+    if _GAZETTEER is None:
+        fname = settings.GEONAMES_FILE
+        if not (fname and os.path.exists(fname)):
+            _GAZETTEER = False
+        else:
+            _GAZETTEER = Gazetteer.load(
+                fname,
+                min_population=settings.GEONAMES_MIN_POPULATION,
+                alternate_names=settings.GEONAMES_ALTERNATE_NAMES
+                )
+            LOG.debug("Gazetteer loaded: {} places, {} names".format(
+                len(_GAZETTEER), len(_GAZETTEER.names)))
+    return _GAZETTEER or None
+
+
+def lookup(place):
+    """
+    :param place: str.
+    :return: dict {lat: <float>, lon: <float>} or empty dict, if the
+        place is unknown or there's no gazetteer.
+    """
+    gazetteer = get_gazetteer()
+    if gazetteer is None:
+        return {}
+    return gazetteer.lookup(place)
@@ -0,0 +1,307 @@
+"""
+Geocoding of place names.
+
+Lookups go through four tiers:
+    - in-process LRU cache;
+    - offline gazetteer (see `core.gazetteer`), if available;
+    - persistent cache (`GeocodeCache`), shared by all processes;
+    - Nominatim (rate-limited to 1 request per second in all processes).
+Places are looked up by normalized keys, so "London", "london " and
+"LONDON!" are geocoded only once. Unresolvable places are cached, too,
+with a shorter TTL.
+
+Ingest doesn't have to wait for Nominatim: `geocode_cached` doesn't
+make network requests, and unknown places can be submitted to the
+geocoding queue with `enqueue`, which coalesces identical requests.
+"""
+import time
+import hashlib
+import logging
+from collections import OrderedDict, Counter
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError
+from django.db.models import F
+from django.core.cache import caches
+from django.utils import timezone
+
+from core.models import GeocodeCache
+from core.utils import geocode_nominatim, normalize_place
+from core import gazetteer
+
+
+LOG = logging.getLogger("geocoding")
+
+# Hit/miss counters of the current process:
+#   memory_hits, db_hits - found in the cache of the respective tier;
+#   gazetteer_hits - found in the offline gazetteer;
+#   misses - geocoded by Nominatim;
+#   unresolved - places without coordinates (from any tier).
+STATS = Counter()
+
+
+def place_key(place):
+    """
+    :param place: str - normalized place name.
+    :return: str - key in `GeocodeCache` (at most 255 characters).
+    """
+    if len(place) > 255:
+        return hashlib.sha1(place.encode("utf-8")).hexdigest()
+    return place
+
+
+def get_ttl(location):
+    """
+    :return: int - seconds to keep a result of geocoding.
+    """
+    if location:
+        return settings.GEOCODE_CACHE_TTL * 60
+    return settings.GEOCODE_NEGATIVE_TTL * 60
+
+
+class LRUCache(object):
+    """
+    Least recently used items with expiration time.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        """
+        :return: cached value, or None if missing or expired.
+        """
+        try:
+            value, expires = self.items[key]
+        except KeyError:
+            return None
+
+        if expires < time.time():
+            del self.items[key]
+            return None
+
+        self.items.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl):
+        self.items[key] = (value, time.time() + ttl)
+        self.items.move_to_end(key)
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+
+MEMORY_CACHE = LRUCache(settings.GEOCODE_CACHE_SIZE)
+
+
+def get_cached(key):
+    """
+    :param key: str - see `place_key`.
+    :return: dict {lat: <float>, lon: <float>} or empty dict (place
+        is unresolvable), or None if there's no valid cache entry.
+    """
+    try:
+        obj = GeocodeCache.objects.get(key=key)
+    except GeocodeCache.DoesNotExist:
+        return None
+
+    location = obj.location
+    if obj.updated < timezone.now() - timezone.timedelta(seconds=get_ttl(location)):
+        return None
+
+    # `update` leaves `updated` (TTL) as is.
+    GeocodeCache.objects.filter(pk=obj.pk).update(hits=F("hits") + 1)
+    return location
+
+
+def set_cached(key, place, location):
+    """
+    :param key: str - see `place_key`.
+    :param place: str - original place name.
+    :param location: dict {lat: <float>, lon: <float>} or empty dict.
+    """
+    try:
+        GeocodeCache.objects.update_or_create(
+            key=key,
+            defaults={
+                "place": place[:255],
+                "lat": location.get("lat", None),
+                "lon": location.get("lon", None)
+                }
+            )
+    except IntegrityError:
+        # Concurrent process has just cached the same place.
+        pass
+
+
+def lookup_cached(key, place):
+    """
+    Looks a place up in all tiers but Nominatim.
+
+    :param key: str - see `place_key`.
+    :param place: str - original place name.
+    :return: dict {lat: <float>, lon: <float>} or empty dict (place
+        is unresolvable), or None if the place hasn't been geocoded yet.
+    """
+    location = MEMORY_CACHE.get(key)
+    if location is not None:
+        STATS["memory_hits"] += 1
+        return location
+
+    location = gazetteer.lookup(place)
+    if location:
+        STATS["gazetteer_hits"] += 1
+    else:
+        try:
+            location = get_cached(key)
+        except DatabaseError as exc:
+            LOG.warning("Geocode cache is not available: {}".format(exc))
+            location = None
+        if location is None:
+            return None
+        STATS["db_hits"] += 1
+
+    MEMORY_CACHE.set(key, location, get_ttl(location))
+    return location
+
+
+def geocode_remote(key, place):
+    """
+    Geocodes a place with Nominatim and caches the result. Failures of
+    Nominatim are not cached (the place will be geocoded again).
+
+    :param key: str - see `place_key`.
+    :param place: str - original place name.
+    :return: dict {lat: <float>, lon: <float>} or empty dict.
+    :raise: geopy.exc.GeopyError.
+    """
+    STATS["misses"] += 1
+    throttle()
+    location = geocode_nominatim(place)
+    try:
+        set_cached(key, place, location)
+    except DatabaseError as exc:
+        LOG.warning("Geocode cache is not available: {}".format(exc))
+    MEMORY_CACHE.set(key, location, get_ttl(location))
+    return location
+
+
+def geocode(place):
+    """
+    Figures out geo-coords for a given place, using cache.
+
+    :param place: str.
+    :return: dict {lat: <float>, lon: <float>} or empty dict, if unsuccessfull.
+    """
+    normalized = normalize_place(place or "")
+    if not normalized:
+        return {}
+
+    key = place_key(normalized)
+    location = lookup_cached(key, place)
+    if location is None:
+        location = geocode_remote(key, place)
+
+    if not location:
+        STATS["unresolved"] += 1
+    return dict(location)
+
+
+def geocode_cached(place):
+    """
+    Figures out geo-coords for a given place without calling Nominatim
+    (see `enqueue` for geocoding unknown places asynchronously).
+
+    :param place: str.
+    :return: dict {lat: <float>, lon: <float>} or empty dict, if
+        unsuccessfull, or None if the place hasn't been geocoded yet.
+    """
+    normalized = normalize_place(place or "")
+    if not normalized:
+        return {}
+
+    location = lookup_cached(place_key(normalized), place)
+    if location is None:
+        return None
+
+    if not location:
+        STATS["unresolved"] += 1
+    return dict(location)
+
+
+def get_shared_cache():
+    return caches[settings.SHARED_CACHE]
+
+
+def inflight_key(place):
+    key = place_key(normalize_place(place or ""))
+    return "geocode:inflight:" + hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def throttle():
+    """
+    Blocks until GEOCODE_MIN_DELAY seconds have passed since the previous
+    request to Nominatim from any process.
+    """
+    cache = get_shared_cache()
+    try:
+        while not cache.add("geocode:throttle", 1, settings.GEOCODE_MIN_DELAY):
+            time.sleep(0.1)
+    except DatabaseError as exc:
+        LOG.warning("Shared cache is not available: {}".format(exc))
+
+
+def enqueue(places):
+    """
+    Submits places to the geocoding queue (celery task `geocode_places`).
+    Places that are being geocoded already (by any process) are skipped.
+
+    :param places: iterable of str.
+    :return: list of str - submitted places.
+    """
+    cache = get_shared_cache()
+    submitted = []
+    for place in sorted(set(places)):
+        try:
+            added = cache.add(inflight_key(place), place,
+                              settings.GEOCODE_INFLIGHT_TIMEOUT)
+        except DatabaseError as exc:
+            LOG.warning("Shared cache is not available: {}".format(exc))
+            added = True
+        if added:
+            submitted.append(place)
+
+    if submitted:
+        # Imported here: celerytasks depend on this module.
+        from celerytasks import geocode_places
+        geocode_places.delay(submitted)
+    return submitted
+
+
+def release(place):
+    """
+    Marks a place as not being geocoded any more.
+    """
+    try:
+        get_shared_cache().delete(inflight_key(place))
+    except DatabaseError as exc:
+        LOG.warning("Shared cache is not available: {}".format(exc))
+
+
+def get_stats():
+    """
+    :return: dict - hit/miss counters of the current process and hit
+        ratio (share of lookups that haven't reached Nominatim).
+    """
+    stats = dict((key, STATS[key])
+                 for key in ("memory_hits", "gazetteer_hits", "db_hits",
+                             "misses", "unresolved"))
+    total = stats["memory_hits"] + stats["gazetteer_hits"] + stats["db_hits"] \
+        + stats["misses"]
+    stats["hit_ratio"] = float(total - stats["misses"]) / total if total else 0.
+    return stats
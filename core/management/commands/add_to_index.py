@@ -4,6 +4,7 @@ Adding Twitter posts to index in ES.
 import optparse
 import json
 
+from dataman.nlp import analyze_many
 from dataman.processors import TweetNormalizer
 from dataman.elastic import ensure_mapping, create_or_update_doc
 
@@ -27,9 +28,11 @@ def add_file_to_index(filename, **kwargs):
 
     ensure_mapping()
 
-    for rec in data[startfrom: startfrom+n_records]:
-        norm = TweetNormalizer(rec)
-        doc = norm.normalize()
+    records = data[startfrom: startfrom+n_records]
+    norms = [TweetNormalizer(rec) for rec in records]
+    analyses = analyze_many([norm.original["text"] for norm in norms])
+    for rec, norm, analysis in zip(records, norms, analyses):
+        doc = norm.normalize(analysis=analysis)
         try:
             res = create_or_update_doc(rec['tweetid'], doc)
         except Exception as err:
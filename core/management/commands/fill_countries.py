@@ -0,0 +1,37 @@
+"""
+Setting countries and regions of geotagged docs that don't have them
+(e.g. after changes in world borders or regions).
+"""
+import sys
+import os
+import optparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../../'))
+
+from celerytasks import fill_countries
+
+
+def main(*args, **kwargs):
+    if kwargs.get("background"):
+        fill_countries.delay(regions=kwargs.get("regions", False))
+        print("[.] Submitted")
+        return
+
+    results = fill_countries(regions=kwargs.get("regions", False))
+    print("[.] Done: {}".format(results))
+
+
+if __name__ == '__main__':
+    cmdparser = optparse.OptionParser(usage="usage: python %prog [OPTIONS]")
+    cmdparser.add_option("-r", "--regions",
+                         action="store_true",
+                         dest="regions",
+                         default=False,
+                         help="Also docs without region [default \'%default\']")
+    cmdparser.add_option("-b", "--background",
+                         action="store_true",
+                         dest="background",
+                         default=False,
+                         help="Run in a celery worker [default \'%default\']")
+    opts, args = cmdparser.parse_args()
+    main(*args, **opts.__dict__)
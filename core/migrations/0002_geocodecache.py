@@ -0,0 +1,25 @@
+# Generated by Django 2.0.6 on 2026-10-17 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeocodeCache',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255, unique=True)),
+                ('place', models.CharField(max_length=255)),
+                ('lat', models.FloatField(blank=True, null=True)),
+                ('lon', models.FloatField(blank=True, null=True)),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True, db_index=True)),
+            ],
+        ),
+    ]
@@ -55,3 +55,31 @@ def update_user_profile(user, created):
 def user_post_save(sender, instance, created, **kwargs):
     update_user_profile(instance, created)
     ensure_api_key(instance)
+
+
+class GeocodeCache(models.Model):
+    """
+    Results of geocoding place names (see `core.geocoding`).
+
+    Unresolvable places are cached, too (with empty `lat` and `lon`),
+    to avoid geocoding them again and again.
+    """
+    key = models.CharField(max_length=255, unique=True)
+    place = models.CharField(max_length=255)
+    lat = models.FloatField(null=True, blank=True)
+    lon = models.FloatField(null=True, blank=True)
+    hits = models.PositiveIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True, db_index=True)
+
+    def __str__(self):
+        return self.place
+
+    @property
+    def resolved(self):
+        return self.lat is not None and self.lon is not None
+
+    @property
+    def location(self):
+        if self.resolved:
+            return {"lat": self.lat, "lon": self.lon}
+        return {}
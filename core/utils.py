@@ -1,15 +1,17 @@
 import os
 import re
 import json
+import unicodedata
 import random
 import collections
 from string import ascii_lowercase, digits
 from datetime import datetime, date, time, timedelta
 from tempfile import NamedTemporaryFile
 from geopy.geocoders import Nominatim
-from geopy.distance import distance
+from geopy.distance import geodesic
 from geopy.extra.rate_limiter import RateLimiter
 
+import numpy
 import dpath.util
 import dateparser
 
@@ -20,9 +22,18 @@ from django.contrib.gis.geos import GEOSGeometry
 
 
 GEO_LOCATOR = Nominatim(user_agent="python")
-GEO_CODE = RateLimiter(GEO_LOCATOR.geocode, min_delay_seconds=1)
+# Errors (timeouts, quota) are raised after retries, so that they are not
+# taken for unresolvable places.
+GEO_CODE = RateLimiter(GEO_LOCATOR.geocode, min_delay_seconds=1,
+                       swallow_exceptions=False)
 
 CHARS = ascii_lowercase + digits
+# Mean Earth radius (meters).
+EARTH_RADIUS = 6371008.8
+# Max relative error of haversine distance against geodesic one.
+HAVERSINE_ERROR = 0.005
+GLOB_CHARS = re.compile(r"[*?\[\]]")
+GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
 TS_GTE = settings.ES_TIMESTAMP_FIELD + '__gte'
 TS_LTE = settings.ES_TIMESTAMP_FIELD + '__lte'
 QUERY_TERMS = [
@@ -118,10 +129,26 @@ def get_val_by_path(*args, **kwargs):
     :return: object or None
     """
     for path in args:
-        try:
-            val = dpath.util.get(kwargs, path)
-        except KeyError:
-            continue
+        if GLOB_CHARS.search(path):
+            try:
+                val = dpath.util.get(kwargs, path)
+            except KeyError:
+                continue
+            else:
+                return val
+
+        # Plain path: walk the document directly.
+        val = kwargs
+        for key in path.split("/"):
+            if isinstance(val, collections.Mapping):
+                if key not in val:
+                    break
+                val = val[key]
+            elif isinstance(val, (list, tuple)) and key.isdigit() \
+              and int(key) < len(val):
+                val = val[int(key)]
+            else:
+                break
         else:
             return val
     return None
@@ -394,13 +421,37 @@ def avg_coords_list(coords):
     return {"lat": lat/count, "lon": lon/count}
 
 
+def normalize_place(place):
+    """
+    :param place: str
+    :return: str - lowercase place name without extra spaces and
+        surrounding punctuation.
+    """
+    place = unicodedata.normalize("NFKC", place).lower()
+    return re.sub(r"\s+", " ", place).strip(" .,;:!?-_'\"#@*()[]")
+
+
 def get_place_coords(place):
     """
-    Figures out geo-coords for a given place.
+    Figures out geo-coords for a given place (cached).
 
     :param place: str.
     :return: dict {lat: <float>, lon: <float>} or empty dict, if unsuccessfull.
     """
+    # Imported here: geocoding depends on models, which depend on utils.
+    from core.geocoding import geocode
+    return geocode(place)
+
+
+def geocode_nominatim(place):
+    """
+    Figures out geo-coords for a given place with Nominatim (not cached).
+
+    :param place: str.
+    :return: dict {lat: <float>, lon: <float>} or empty dict, if the
+        place is not found.
+    :raise: geopy.exc.GeopyError if Nominatim fails.
+    """
     # geo_location = GEO_LOCATOR.geocode(place)
     geo_location = GEO_CODE(place)
     try:
@@ -418,12 +469,156 @@ def geo(lat, lon, srid=4326):
 
 def meters(point_from, point_to):
     """
-    Distance in meters between two points.
+    Distance in meters between two points (geodesic).
 
     :param point_from: dict {lat: <float>, lon: <float>}
     :param point_to: the same
     :return: float
     """
-    point_from = geo(point_from["lat"], point_from["lon"])
-    point_to = geo(point_to["lat"], point_to["lon"])
-    return distance(point_from, point_to).m
+    return geodesic(
+        (point_from["lat"], point_from["lon"]),
+        (point_to["lat"], point_to["lon"])
+        ).m
+
+
+def haversine(lats_from, lons_from, lats_to, lons_to):
+    """
+    Great-circle distance in meters, vectorized: arguments are floats
+    or arrays of degrees, broadcast against each other.
+
+    :return: numpy.array of float (or float for scalar arguments).
+    """
+    lat1, lon1, lat2, lon2 = (
+        numpy.radians(numpy.asarray(x, dtype=numpy.float64))
+        for x in (lats_from, lons_from, lats_to, lons_to)
+        )
+    a = numpy.sin((lat2 - lat1) / 2.)**2 \
+        + numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin((lon2 - lon1) / 2.)**2
+    return 2. * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.clip(a, 0., 1.)))
+
+
+def nearest_location(candidates, point, refine=False):
+    """
+    Finds the candidate nearest to a point in one vectorized pass.
+
+    :param candidates: list of dicts {lat: <float>, lon: <float>}
+    :param point: dict {lat: <float>, lon: <float>}
+    :param refine: bool - if True, candidates within the error of
+        haversine from the nearest one are re-ranked by geodesic
+        distance, which is also returned instead of haversine.
+    :return: tuple (index in candidates, distance in meters), or
+        (None, None) if there are no candidates.
+    """
+    if not candidates:
+        return None, None
+
+    dists = haversine(
+        [x["lat"] for x in candidates], [x["lon"] for x in candidates],
+        point["lat"], point["lon"]
+        )
+    idx = int(dists.argmin())
+    if not refine:
+        return idx, float(dists[idx])
+
+    limit = dists[idx] * (1. + 2*HAVERSINE_ERROR)
+    nearest = [(meters(candidates[i], point), i)
+               for i in numpy.flatnonzero(dists <= limit)]
+    dist, idx = min(nearest)
+    return int(idx), dist
+
+
+def geohash_encode(lat, lon, precision):
+    """
+    :param precision: int - length of geohash.
+    :return: str - geohash of a point.
+    """
+    lat_range, lon_range = [-90., 90.], [-180., 180.]
+    chars = []
+    char, n_bits, is_lon = 0, 0, True
+    while len(chars) < precision:
+        interval, value = (lon_range, lon) if is_lon else (lat_range, lat)
+        mid = (interval[0] + interval[1]) / 2.
+        if value >= mid:
+            char = char*2 + 1
+            interval[0] = mid
+        else:
+            char = char*2
+            interval[1] = mid
+        is_lon = not is_lon
+        n_bits += 1
+        if n_bits == 5:
+            chars.append(GEOHASH_BASE32[char])
+            char, n_bits = 0, 0
+    return "".join(chars)
+
+
+def geohash_encode_many(lats, lons, precision):
+    """
+    Vectorized `geohash_encode`.
+
+    :param lats: sequence of latitudes.
+    :param lons: sequence of longitudes.
+    :param precision: int - length of geohashes (at most 12).
+    :return: numpy.array of str.
+    """
+    bits = 5 * precision
+    lat_bits, lon_bits = bits // 2, (bits + 1) // 2
+    lats = numpy.asarray(lats, dtype=numpy.float64)
+    lons = numpy.asarray(lons, dtype=numpy.float64)
+    # Indexes of cells by latitude and longitude are the bits of the
+    # respective coordinate in the geohash.
+    lat_idx = numpy.clip(numpy.floor((lats + 90.) / 180. * 2**lat_bits),
+                         0, 2**lat_bits - 1).astype(numpy.int64)
+    lon_idx = numpy.clip(numpy.floor((lons + 180.) / 360. * 2**lon_bits),
+                         0, 2**lon_bits - 1).astype(numpy.int64)
+    code = numpy.zeros(len(lats), dtype=numpy.int64)
+    for bit in range(bits):
+        # Bits alternate, longitude first.
+        if bit % 2 == 0:
+            value = (lon_idx >> (lon_bits - 1 - bit // 2)) & 1
+        else:
+            value = (lat_idx >> (lat_bits - 1 - bit // 2)) & 1
+        code = (code << 1) | value
+
+    shifts = 5 * numpy.arange(precision - 1, -1, -1)
+    digits = (code[:, None] >> shifts) & 31
+    chars = numpy.array(list(GEOHASH_BASE32))[digits]
+    return numpy.ascontiguousarray(chars).view("<U{}".format(precision)).ravel()
+
+
+def geohash_bounds(geohash):
+    """
+    :param geohash: str.
+    :return: dict - bounding box of the geohash cell, in the format of
+        bounding box filters (see settings.ES_BOUNDING_BOX_FIELDS).
+    """
+    lat_range, lon_range = [-90., 90.], [-180., 180.]
+    is_lon = True
+    for char in geohash:
+        code = GEOHASH_BASE32.index(char)
+        for shift in range(4, -1, -1):
+            interval = lon_range if is_lon else lat_range
+            mid = (interval[0] + interval[1]) / 2.
+            if (code >> shift) & 1:
+                interval[0] = mid
+            else:
+                interval[1] = mid
+            is_lon = not is_lon
+    return {
+        "top_left_lat": lat_range[1],
+        "top_left_lon": lon_range[0],
+        "bottom_right_lat": lat_range[0],
+        "bottom_right_lon": lon_range[1]
+        }
+
+
+def geohash_decode(geohash):
+    """
+    :param geohash: str.
+    :return: dict {lat: <float>, lon: <float>} - center of the cell.
+    """
+    bounds = geohash_bounds(geohash)
+    return {
+        "lat": (bounds["top_left_lat"] + bounds["bottom_right_lat"]) / 2.,
+        "lon": (bounds["top_left_lon"] + bounds["bottom_right_lon"]) / 2.
+        }
@@ -3,6 +3,9 @@
 
 from osgeo import ogr
 
+# Field with the tolerance of simplified shapes.
+TOLERANCE_FIELD = 'TOLERANCE'
+
 def filter_file(filter_func, infile, outfile):
     """
     Saves all infile shapes which pass through filter_func to outfile.
@@ -34,3 +37,39 @@ def filter_file(filter_func, infile, outfile):
         for field in feat.keys():
             outFeature.SetField(field, feat.GetField(field))
         outLayer.CreateFeature(outFeature)
+
+def simplify_file(infile, outfile, tolerance=0.01):
+    """
+    Saves all infile shapes simplified (Douglas-Peucker, preserving
+    topology) with given tolerance (in units of the layer) to outfile.
+    Simplified borders are within tolerance from the original ones, so
+    only points closer to them need testing against original shapes.
+    The tolerance is saved to TOLERANCE_FIELD of each shape.
+    
+    Example:
+    simplify_file('TM_WORLD_BORDERS-0.3.shp', 'TM_WORLD_BORDERS-0.3.simplified.shp', 0.01)
+    """
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    
+    inDS = driver.Open(infile)
+    inLayer = inDS.GetLayer()
+    
+    outDS = driver.CreateDataSource(outfile)
+    outLayer = outDS.CreateLayer('simplified')
+    
+    feat = inLayer.GetFeature(0) # first feature
+    for field in feat.keys():
+        outLayer.CreateField(feat.GetFieldDefnRef(field))
+    del feat
+    outLayer.CreateField(ogr.FieldDefn(TOLERANCE_FIELD, ogr.OFTReal))
+    
+    featureDefn = outLayer.GetLayerDefn()
+    for i in range(inLayer.GetFeatureCount()):
+        feat = inLayer.GetFeature(i)
+        
+        outFeature = ogr.Feature(featureDefn)
+        outFeature.SetGeometry(feat.GetGeometryRef().SimplifyPreserveTopology(tolerance))
+        for field in feat.keys():
+            outFeature.SetField(field, feat.GetField(field))
+        outFeature.SetField(TOLERANCE_FIELD, tolerance)
+        outLayer.CreateFeature(outFeature)
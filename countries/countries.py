@@ -1,19 +1,55 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+
+import numpy
 from osgeo import ogr
 
+from countries.index import PolygonIndex
+from countries.grid import CountryGrid, BORDER
+from countries.copyshapes import TOLERANCE_FIELD
+
 class Point(object):
     """ Wrapper for ogr point """
     def __init__(self, lat, lng):
         """ Coordinates are in degrees """
-        self.point = ogr.Geometry(ogr.wkbPoint)
-        self.point.AddPoint(lng, lat)
+        self.lat = lat
+        self.lng = lng
+        self.point = None
     
     def getOgr(self):
+        if self.point is None:
+            self.point = ogr.Geometry(ogr.wkbPoint)
+            self.point.AddPoint(self.lng, self.lat)
         return self.point
     ogr = property(getOgr)
 
+def geometry_rings(geometry):
+    """
+    Splits ogr (multi)polygon into polygons.
+    Output is a list of polygons, each is a list of (n, 2) arrays of
+    ring vertices (exterior ring first, then holes)
+    """
+    geometry_type = ogr.GT_Flatten(geometry.GetGeometryType())
+    if geometry_type == ogr.wkbPolygon:
+        parts = [geometry]
+    elif geometry_type == ogr.wkbMultiPolygon:
+        parts = [geometry.GetGeometryRef(i) for i in range(geometry.GetGeometryCount())]
+    else:
+        return []
+    
+    polygons = []
+    for part in parts:
+        rings = []
+        for i in range(part.GetGeometryCount()):
+            points = part.GetGeometryRef(i).GetPoints()
+            if points:
+                rings.append(numpy.array(points, dtype=numpy.float64)[:, :2])
+        if rings:
+            polygons.append(rings)
+    return polygons
+
 class Country(object):
     """ Wrapper for ogr country shape. Not meant to be instantiated directly. """
     def __init__(self, shape):
@@ -29,24 +65,128 @@ class Country(object):
     def contains(self, point):
         return self.shape.geometry().Contains(point.ogr)
 
+def read_polygons(layer):
+    """
+    Reads all features of a layer.
+    Output is a tuple (features, polygons for PolygonIndex)
+    """
+    features, polygons = [], []
+    for i in range(layer.GetFeatureCount()):
+        feature = layer.GetFeature(i)
+        features.append(feature)
+        for rings in geometry_rings(feature.GetGeometryRef()):
+            polygons.append((i, rings))
+    return features, polygons
+
 class CountryChecker(object):
-    """ Loads a country shape file, checks coordinates for country location. """
+    """
+    Loads a country shape file, checks coordinates for country location.
+    Shapes are read once and indexed by bounding boxes (see
+    countries.index), so a lookup tests only a few candidate polygons.
+    
+    Lookups go through (whichever is available):
+        - country grid (see countries.grid), for points far from borders;
+        - simplified shapes (see copyshapes.simplify_file), for points
+          farther than the simplification tolerance from their borders;
+        - full shapes.
+    """
     
-    def __init__(self, country_file):
+    def __init__(self, country_file, grid_file=None, simplified_file=None):
         driver = ogr.GetDriverByName('ESRI Shapefile')
         self.countryFile = driver.Open(country_file)
         self.layer = self.countryFile.GetLayer()
+        
+        features, polygons = read_polygons(self.layer)
+        self.countries = [Country(x) for x in features]
+        self.index = PolygonIndex(polygons)
+        
+        self.grid = None
+        if grid_file and os.path.exists(grid_file):
+            self.grid = CountryGrid.load(grid_file)
+        
+        self.simplified = None
+        self.tolerance = 0.
+        if simplified_file and os.path.exists(simplified_file):
+            simplified = driver.Open(simplified_file)
+            features, polygons = read_polygons(simplified.GetLayer())
+            if len(features) != len(self.countries):
+                raise ValueError("%s doesn't match %s" % (simplified_file, country_file))
+            self.simplified = PolygonIndex(polygons)
+            self.tolerance = max(x.GetField(TOLERANCE_FIELD) for x in features)
     
     def getCountry(self, point):
         """
         Checks given gps-incoming coordinates for country.
-        Output is either country shape index or None
+        Output is either Country or None
+        """
+        return self.get_country(point.lat, point.lng)
+    
+    def get_country(self, lat, lng):
+        """ Output is either Country or None """
+        return self.get_countries([lat], [lng])[0]
+    
+    def get_countries(self, lats, lngs):
         """
+        Batch version of get_country.
+        Output is a list of Country or None, one per point
+        """
+        return [self.countries[idx] if idx >= 0 else None
+                for idx in self.lookup_many(lats, lngs)]
+    
+    def lookup_many(self, lats, lngs):
+        """
+        Output is an array of indexes of countries, -1 if not found
+        """
+        lats = numpy.asarray(lats, dtype=numpy.float64).ravel()
+        lngs = numpy.asarray(lngs, dtype=numpy.float64).ravel()
+        if self.grid is None:
+            refs = numpy.full(len(lats), BORDER - 1, dtype=numpy.int64)
+        else:
+            refs = self.grid.lookup_many(lats, lngs) - 1
         
-        for i in range(self.layer.GetFeatureCount()):
-            country = self.layer.GetFeature(i)
-            if country.geometry().Contains(point.ogr):
-                return Country(country)
+        exact = refs == BORDER - 1
+        if self.simplified is not None and exact.any():
+            # Simplified borders are within tolerance from the real ones.
+            pts = numpy.flatnonzero(exact)
+            refs[pts] = self.simplified.query_many(lngs[pts], lats[pts])
+            exact[pts] = self.simplified.near_boundary(
+                lngs[pts], lats[pts], self.tolerance)
         
-        # nothing found
-        return None
+        if exact.any():
+            refs[exact] = self.index.query_many(lngs[exact], lats[exact])
+        return refs
+
+class RegionChecker(object):
+    """
+    Loads a shape file of administrative regions (e.g. NUTS), checks
+    coordinates for region. Shapes must be in lat/lng (EPSG:4326).
+    Without the file every lookup gives None.
+    """
+    
+    def __init__(self, region_file, field):
+        """ field is the name of the shape field that identifies a region """
+        self.regions = []
+        polygons = []
+        if region_file and os.path.exists(region_file):
+            driver = ogr.GetDriverByName('ESRI Shapefile')
+            self.regionFile = driver.Open(region_file)
+            features, polygons = read_polygons(self.regionFile.GetLayer())
+            self.regions = [x.GetField(field) for x in features]
+        self.index = PolygonIndex(polygons)
+    
+    def __len__(self):
+        return len(self.regions)
+    
+    def get_region(self, lat, lng):
+        """ Output is either region id (str) or None """
+        return self.get_regions([lat], [lng])[0]
+    
+    def get_regions(self, lats, lngs):
+        """
+        Batch version of get_region.
+        Output is a list of region ids or None, one per point
+        """
+        if not self.regions:
+            return [None] * len(lats)
+        return [self.regions[idx] if idx >= 0 else None
+                for idx in self.index.query_many(lngs, lats)]
@@ -0,0 +1,183 @@
+"""
+Precomputed country grid.
+
+The world is divided into the cells of geohashes of a given precision
+(a regular grid of 2**lat_bits x 2**lon_bits cells, see `grid_shape`).
+Each cell holds:
+    - NONE: no country (sea);
+    - BORDER: a border crosses the cell - exact lookup is required;
+    - index of the country feature in the layer + 1.
+So most of points are resolved by a single array lookup. The grid is
+stored as .npy and memory-mapped, so worker processes share it.
+
+Build it offline (takes a while for precision > 4):
+    python -m countries.grid -p 4 countries/TM_WORLD_BORDERS-0.3.shp \
+        countries/TM_WORLD_BORDERS-0.3.grid.npy
+
+The grid refers to features by their order in the layer, so it must be
+rebuilt whenever the borders file changes.
+"""
+import math
+import optparse
+
+import numpy
+
+
+NONE = 0
+BORDER = numpy.iinfo(numpy.uint16).max
+
+
+def grid_shape(precision):
+    """
+    Geohash of a given precision has 5*precision bits, alternating
+    longitude and latitude (longitude first).
+
+    :return: tuple (rows, cols) - number of cells by latitude and longitude.
+    """
+    bits = 5 * precision
+    return 2**(bits // 2), 2**((bits + 1) // 2)
+
+
+def grid_precision(shape):
+    """
+    :return: int - geohash precision of a grid of a given shape.
+    """
+    rows, cols = shape
+    bits = int(round(math.log(rows, 2) + math.log(cols, 2)))
+    if bits % 5 or grid_shape(bits // 5) != tuple(shape):
+        raise ValueError("Wrong shape of the country grid: {}".format(shape))
+    return bits // 5
+
+
+def cell_index(lats, lons, shape):
+    """
+    :return: tuple of numpy.arrays (rows, cols) - cells of points.
+    """
+    rows, cols = shape
+    lats = numpy.asarray(lats, dtype=numpy.float64)
+    lons = numpy.asarray(lons, dtype=numpy.float64)
+    row = numpy.floor((lats + 90.) / 180. * rows).astype(numpy.int64)
+    col = numpy.floor((lons + 180.) / 360. * cols).astype(numpy.int64)
+    return numpy.clip(row, 0, rows - 1), numpy.clip(col, 0, cols - 1)
+
+
+def cell_centers(rows, cols, shape):
+    """
+    :return: tuple of numpy.arrays (lats, lons) - centers of cells.
+    """
+    return ((numpy.asarray(rows) + .5) * 180. / shape[0] - 90.,
+            (numpy.asarray(cols) + .5) * 360. / shape[1] - 180.)
+
+
+def mark_borders(grid, rings):
+    """
+    Marks cells crossed by rings as BORDER.
+
+    Edges are sampled at a step of quarter a cell, and the cells of
+    samples are dilated by one cell, so that every cell touched by an
+    edge is marked, however small the touching part is.
+
+    :param grid: numpy.array of shape (rows, cols).
+    :param rings: iterable of (n, 2) arrays of (lon, lat) vertices.
+    """
+    shape = grid.shape
+    step = min(180. / shape[0], 360. / shape[1]) / 4.
+    touched = numpy.zeros(shape, dtype=bool)
+    for ring in rings:
+        start = ring
+        end = numpy.roll(ring, -1, axis=0)
+        length = numpy.hypot(*(end - start).T)
+        n_samples = numpy.ceil(length / step).astype(numpy.int64) + 1
+        edge = numpy.repeat(numpy.arange(len(ring)), n_samples)
+        # Position of a sample along its edge, 0..1.
+        offset = numpy.arange(len(edge)) - numpy.repeat(
+            numpy.cumsum(n_samples) - n_samples, n_samples)
+        t = (offset / numpy.maximum(n_samples - 1, 1)[edge])[:, None]
+        points = start[edge] + t * (end[edge] - start[edge])
+        touched[cell_index(points[:, 1], points[:, 0], shape)] = True
+
+    dilated = touched.copy()
+    dilated[1:, :] |= touched[:-1, :]
+    dilated[:-1, :] |= touched[1:, :]
+    touched = dilated.copy()
+    dilated[:, 1:] |= touched[:, :-1]
+    dilated[:, :-1] |= touched[:, 1:]
+    grid[dilated] = BORDER
+
+
+def build_grid(index, precision):
+    """
+    :param index: countries.index.PolygonIndex - country polygons,
+        refs are indexes of features in the layer.
+    :param precision: int - geohash precision.
+    :return: numpy.array of uint16.
+    """
+    from scipy import ndimage
+
+    grid = numpy.zeros(grid_shape(precision), dtype=numpy.uint16)
+    mark_borders(grid, (ring for rings in index.rings for ring in rings))
+
+    # Cells between borders form regions, and each region is either
+    # inside one country or outside all of them: test one cell per region.
+    labels, n_regions = ndimage.label(grid != BORDER)
+    if not n_regions:
+        return grid
+    rows, cols = numpy.nonzero(labels)
+    regions, first = numpy.unique(labels[rows, cols], return_index=True)
+    lats, lons = cell_centers(rows[first], cols[first], grid.shape)
+    refs = index.query_many(lons, lats)
+
+    values = numpy.zeros(n_regions + 1, dtype=numpy.uint16)
+    values[regions] = refs + 1
+    inside = labels > 0
+    grid[inside] = values[labels[inside]]
+    return grid
+
+
+class CountryGrid(object):
+    """
+    Memory-mapped country grid.
+    """
+    def __init__(self, grid):
+        """
+        :param grid: numpy.array (see `build_grid`).
+        """
+        self.grid = grid
+        self.precision = grid_precision(grid.shape)
+
+    @classmethod
+    def load(cls, fname):
+        return cls(numpy.load(fname, mmap_mode="r"))
+
+    def lookup_many(self, lats, lons):
+        """
+        :return: numpy.array of int - indexes of features + 1, NONE or BORDER.
+        """
+        rows, cols = cell_index(lats, lons, self.grid.shape)
+        return numpy.asarray(self.grid[rows, cols], dtype=numpy.int64)
+
+
+def main(*args, **kwargs):
+    if len(args) != 2:
+        raise Exception("Borders file and output file are required!")
+
+    from countries.countries import CountryChecker
+
+    checker = CountryChecker(args[0])
+    grid = build_grid(checker.index, kwargs["precision"])
+    numpy.save(args[1], grid)
+    print("Grid {}x{}: {:.1%} border cells".format(
+        grid.shape[0], grid.shape[1], (grid == BORDER).mean()))
+
+
+if __name__ == '__main__':
+    cmdparser = optparse.OptionParser(
+        usage="usage: python -m countries.grid [OPTIONS] borders_file output_file")
+    cmdparser.add_option("-p", "--precision",
+                         action="store",
+                         dest="precision",
+                         default=4,
+                         type=int,
+                         help="Geohash precision of cells [default \'%default\']")
+    opts, args = cmdparser.parse_args()
+    main(*args, **opts.__dict__)
@@ -0,0 +1,241 @@
+"""
+Spatial index for point-in-polygon lookups.
+
+Polygons are kept as numpy arrays of ring vertices (exterior ring first,
+then holes), which are tested with a vectorized crossing number, so no
+geometry objects are built per lookup. Bounding boxes of polygons are
+packed into a two-level STR (Sort-Tile-Recursive) tree: a point is
+tested only against polygons whose boxes contain it.
+
+Coordinates are (x, y), i.e. (lon, lat) for geographic layers.
+"""
+import math
+
+import numpy
+
+
+# Max number of polygons in a leaf of the tree.
+NODE_SIZE = 16
+
+# Max size of (points x vertices) matrices in crossing number tests.
+CHUNK_SIZE = 2**20
+
+
+def ring_contains(ring, xs, ys):
+    """
+    Crossing number test (points on the boundary are ambiguous).
+
+    :param ring: numpy.array of shape (n, 2) - vertices of a ring.
+    :param xs: numpy.array of x coordinates of points.
+    :param ys: numpy.array of y coordinates of points.
+    :return: numpy.array of bool.
+    """
+    x1, y1 = ring[:, 0], ring[:, 1]
+    x2, y2 = numpy.roll(x1, -1), numpy.roll(y1, -1)
+    inside = numpy.zeros(len(xs), dtype=bool)
+    step = max(1, CHUNK_SIZE // len(ring))
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        for start in range(0, len(xs), step):
+            px = xs[start:start+step, None]
+            py = ys[start:start+step, None]
+            crosses = ((y1 > py) != (y2 > py)) \
+                & (px < (x2 - x1) * (py - y1) / (y2 - y1) + x1)
+            inside[start:start+step] = crosses.sum(axis=1) % 2 == 1
+    return inside
+
+
+def ring_distance(ring, xs, ys):
+    """
+    :param ring: numpy.array of shape (n, 2) - vertices of a ring.
+    :return: numpy.array of float - distances from points to the ring.
+    """
+    x1, y1 = ring[:, 0], ring[:, 1]
+    dx, dy = numpy.roll(x1, -1) - x1, numpy.roll(y1, -1) - y1
+    length = numpy.maximum(dx*dx + dy*dy, 1e-24)
+    distance = numpy.zeros(len(xs))
+    step = max(1, CHUNK_SIZE // len(ring))
+    for start in range(0, len(xs), step):
+        px = xs[start:start+step, None]
+        py = ys[start:start+step, None]
+        # Projection of a point on an edge, clipped to the edge.
+        t = numpy.clip(((px - x1) * dx + (py - y1) * dy) / length, 0., 1.)
+        distance[start:start+step] = numpy.hypot(
+            px - x1 - t*dx, py - y1 - t*dy).min(axis=1)
+    return distance
+
+
+def ring_bounds(ring):
+    """
+    :return: tuple (min_x, min_y, max_x, max_y).
+    """
+    return tuple(ring.min(axis=0)) + tuple(ring.max(axis=0))
+
+
+class PolygonIndex(object):
+    """
+    STR tree over polygons.
+    """
+    def __init__(self, polygons, node_size=NODE_SIZE):
+        """
+        :param polygons: iterable of tuples (ref, rings), where ref is
+            int (e.g. index of a feature in the layer) and rings is
+            a list of (n, 2) arrays: exterior ring, then holes.
+            A multipolygon is represented by several polygons with the
+            same ref.
+        :param node_size: int - max number of polygons in a leaf.
+        """
+        refs, rings, bounds = [], [], []
+        for ref, rings_ in polygons:
+            rings_ = [numpy.asarray(x, dtype=numpy.float64)[:, :2] for x in rings_]
+            if not rings_ or len(rings_[0]) < 3:
+                continue
+            refs.append(ref)
+            rings.append(rings_)
+            bounds.append(ring_bounds(rings_[0]))
+
+        bounds = numpy.array(bounds, dtype=numpy.float64).reshape(-1, 4)
+        order = self.str_order(bounds, node_size)
+        self.node_size = node_size
+        self.refs = numpy.array(refs, dtype=numpy.int64)[order]
+        self.rings = [rings[i] for i in order]
+        self.bounds = bounds[order]
+
+        # Leaves: bounding boxes of consecutive groups of polygons.
+        self.leaves = numpy.array([
+            numpy.concatenate((
+                self.bounds[i:i+node_size, :2].min(axis=0),
+                self.bounds[i:i+node_size, 2:].max(axis=0)
+                ))
+            for i in range(0, len(self.bounds), node_size)
+            ]).reshape(-1, 4)
+
+    def __len__(self):
+        return len(self.refs)
+
+    @staticmethod
+    def str_order(bounds, node_size):
+        """
+        Sort-Tile-Recursive packing: polygons are sorted by x of their
+        centers into vertical slices, then by y within each slice.
+
+        :return: numpy.array - order of polygons.
+        """
+        if not len(bounds):
+            return numpy.arange(0)
+        centers = (bounds[:, :2] + bounds[:, 2:]) / 2.
+        n_leaves = int(math.ceil(len(bounds) / float(node_size)))
+        slice_size = node_size * int(math.ceil(math.sqrt(n_leaves)))
+        by_x = numpy.argsort(centers[:, 0], kind="mergesort")
+        order = []
+        for start in range(0, len(by_x), slice_size):
+            slice_ = by_x[start:start+slice_size]
+            order.append(slice_[numpy.argsort(centers[slice_, 1], kind="mergesort")])
+        return numpy.concatenate(order)
+
+    def candidates(self, xs, ys, margin=0.):
+        """
+        Pairs of points and polygons whose bounding boxes contain them.
+
+        :param margin: float - expand bounding boxes by this distance.
+        :return: tuple of numpy.arrays (point indexes, polygon indexes).
+        """
+        points, polygons = [], []
+        leaves = self.leaves + (-margin, -margin, margin, margin)
+        step = max(1, CHUNK_SIZE // max(1, len(leaves)))
+        for start in range(0, len(xs), step):
+            px = xs[start:start+step, None]
+            py = ys[start:start+step, None]
+            pt, leaf = numpy.nonzero(
+                (leaves[:, 0] <= px) & (px <= leaves[:, 2])
+                & (leaves[:, 1] <= py) & (py <= leaves[:, 3])
+                )
+            # Expand leaves to their polygons.
+            pt = numpy.repeat(pt, self.node_size)
+            poly = (leaf[:, None] * self.node_size
+                    + numpy.arange(self.node_size)).ravel()
+            valid = poly < len(self.bounds)
+            pt, poly = pt[valid], poly[valid]
+            box = self.bounds[poly] + (-margin, -margin, margin, margin)
+            x, y = xs[start + pt], ys[start + pt]
+            hit = (box[:, 0] <= x) & (x <= box[:, 2]) \
+                & (box[:, 1] <= y) & (y <= box[:, 3])
+            points.append(start + pt[hit])
+            polygons.append(poly[hit])
+
+        if not points:
+            return numpy.arange(0), numpy.arange(0)
+        return numpy.concatenate(points), numpy.concatenate(polygons)
+
+    def polygon_contains(self, idx, xs, ys):
+        """
+        :param idx: int - index of a polygon in the tree.
+        :return: numpy.array of bool.
+        """
+        rings = self.rings[idx]
+        inside = ring_contains(rings[0], xs, ys)
+        for hole in rings[1:]:
+            if not inside.any():
+                break
+            inside[inside] &= ~ring_contains(hole, xs[inside], ys[inside])
+        return inside
+
+    def query_many(self, xs, ys):
+        """
+        :param xs: sequence of x coordinates of points.
+        :param ys: sequence of y coordinates of points.
+        :return: numpy.array of refs of polygons containing points (the
+            lowest ref if there are several), -1 for points outside.
+        """
+        xs = numpy.asarray(xs, dtype=numpy.float64).ravel()
+        ys = numpy.asarray(ys, dtype=numpy.float64).ravel()
+        result = numpy.full(len(xs), -1, dtype=numpy.int64)
+        points, polygons = self.candidates(xs, ys)
+        if not len(points):
+            return result
+
+        # Test points grouped by polygons, in the order of refs.
+        order = numpy.lexsort((points, polygons, self.refs[polygons]))
+        points, polygons = points[order], polygons[order]
+        bounds = numpy.flatnonzero(numpy.diff(polygons)) + 1
+        for group in numpy.split(numpy.arange(len(points)), bounds):
+            idx = polygons[group[0]]
+            pts = points[group]
+            pts = pts[result[pts] < 0]
+            if len(pts):
+                inside = self.polygon_contains(idx, xs[pts], ys[pts])
+                result[pts[inside]] = self.refs[idx]
+        return result
+
+    def near_boundary(self, xs, ys, distance):
+        """
+        :param xs: sequence of x coordinates of points.
+        :param ys: sequence of y coordinates of points.
+        :param distance: float.
+        :return: numpy.array of bool - points within the distance from
+            the boundary of any polygon.
+        """
+        xs = numpy.asarray(xs, dtype=numpy.float64).ravel()
+        ys = numpy.asarray(ys, dtype=numpy.float64).ravel()
+        result = numpy.zeros(len(xs), dtype=bool)
+        points, polygons = self.candidates(xs, ys, margin=distance)
+        if not len(points):
+            return result
+
+        order = numpy.lexsort((points, polygons))
+        points, polygons = points[order], polygons[order]
+        bounds = numpy.flatnonzero(numpy.diff(polygons)) + 1
+        for group in numpy.split(numpy.arange(len(points)), bounds):
+            pts = points[group]
+            for ring in self.rings[polygons[group[0]]]:
+                pts = pts[~result[pts]]
+                if not len(pts):
+                    break
+                result[pts] = ring_distance(ring, xs[pts], ys[pts]) <= distance
+        return result
+
+    def query(self, x, y):
+        """
+        :return: int - ref of the polygon containing a point, or None.
+        """
+        ref = self.query_many([x], [y])[0]
+        return None if ref < 0 else int(ref)
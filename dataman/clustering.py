@@ -0,0 +1,318 @@
+"""
+Engines of cluster builders.
+
+    - "es" (ClusterBuilder, GeoClusterBuilder): segments are aggregated
+      by Elasticsearch, then docs are fetched with one search per segment.
+    - "scan" (ScanClusterBuilder, ScanGeoClusterBuilder): the filtered
+      window is fetched once with scroll (only the fields that are
+      necessary), and docs are grouped by terms (and geohash) in-process.
+      One pass instead of hundreds of searches pays off for windows with
+      many small segments; for big windows with few segments "es" is
+      cheaper. Windows of more than CLUSTER_SCAN_MAX_DOCS docs are always
+      clustered by "es".
+
+Both engines return the same structure of clusters.
+"""
+import re
+
+import numpy
+import pandas
+
+from django.conf import settings
+
+from dataman.elastic import search, scroll, FilterConverter
+from dataman.processors import ClusterBuilder, GeoClusterBuilder
+from core.utils import RecordDict, geohash_encode_many
+
+
+ENGINE_ES = "es"
+ENGINE_SCAN = "scan"
+CLUSTER_ENGINES = (ENGINE_ES, ENGINE_SCAN)
+
+# Fixed intervals of date_histogram, in milliseconds.
+INTERVAL_UNITS = {
+    "ms": 1,
+    "s": 1000,
+    "m": 60*1000,
+    "h": 60*60*1000,
+    "d": 24*60*60*1000,
+    }
+INTERVAL_NAMES = {
+    "second": "1s",
+    "minute": "1m",
+    "hour": "1h",
+    "day": "1d",
+    }
+
+
+def interval_to_ms(interval):
+    """
+    :param interval: str - fixed interval of date_histogram (e.g. "5m").
+    :return: int - interval in milliseconds.
+    """
+    interval = INTERVAL_NAMES.get(interval, interval)
+    match = re.match(r"^(\d+)(ms|s|m|h|d)$", str(interval))
+    if match is None:
+        raise ValueError("Unsupported interval: {}".format(interval))
+    return int(match.group(1)) * INTERVAL_UNITS[match.group(2)]
+
+
+def is_fixed_interval(interval):
+    """
+    :return: bool - True if the interval is supported by `interval_to_ms`.
+    """
+    try:
+        interval_to_ms(interval)
+    except ValueError:
+        return False
+    return True
+
+
+def get_cluster_builder(*terms, **filters):
+    """
+    :terms: list of terms to group by ('location' means clustering by
+        geolocation).
+    :filters: filters for the builder. Special keys:
+        - 'engine' is one of CLUSTER_ENGINES (settings.CLUSTER_ENGINE by
+          default). Segmenting by timestamp with calendar intervals
+          (e.g. "1M", "week") is always done by "es" engine.
+    :return: instance of a cluster builder.
+    """
+    engine = filters.pop("engine", settings.CLUSTER_ENGINE)
+    if engine not in CLUSTER_ENGINES:
+        raise ValueError("Wrong engine! Must be one of: {}".format(
+            ", ".join(CLUSTER_ENGINES)))
+    if (settings.ES_TIMESTAMP_FIELD in terms) \
+       and not is_fixed_interval(filters.get("interval", "5m")):
+        engine = ENGINE_ES
+
+    if settings.ES_GEO_FIELD in terms:
+        # Clustering tweets by geolocation.
+        terms = tuple(x for x in terms if x != settings.ES_GEO_FIELD)
+        builder = ScanGeoClusterBuilder if engine == ENGINE_SCAN else GeoClusterBuilder
+    else:
+        builder = ScanClusterBuilder if engine == ENGINE_SCAN else ClusterBuilder
+    return builder(*terms, **filters)
+
+
+class ScanClusterBuilder(ClusterBuilder):
+    """
+    Groups docs of a single scroll pass by terms.
+    """
+    def get_scan_fields(self, normalize_text):
+        """
+        :return: list of fields to fetch.
+        """
+        return self.get_source_fields(normalize_text) + list(self.terms)
+
+    def scan_hits(self, normalize_text):
+        """
+        Scrolls through all docs matching filters.
+
+        :return: list of hits, None if there are more than
+            settings.CLUSTER_SCAN_MAX_DOCS of them.
+        """
+        # Segment queries of "es" engine always have filters, which
+        # require timestamp and location.
+        filters = self.filters or FilterConverter().get_exist_filters()
+        query = self.build_query(
+            filters=filters, size=settings.ES_SCROLL_BATCHSIZE,
+            source=self.get_scan_fields(normalize_text)
+            )
+        try:
+            response = search(query, scroll=True)
+        except Exception as err:
+            self.errors.append({"query": query, "error": err})
+            return []
+        if response is None:
+            return []
+
+        total = response["hits"]["total"]
+        if total > settings.CLUSTER_SCAN_MAX_DOCS:
+            return None
+
+        hits = []
+        while response and response["hits"]["hits"]:
+            hits.extend(response["hits"]["hits"])
+            response = scroll(response["_scroll_id"])
+        if (response is None) and (len(hits) < total):
+            self.errors.append({
+                "query": query,
+                "error": "Scroll stopped after {} of {} docs".format(len(hits), total)
+                })
+        return hits
+
+    def get_term_values(self, hit, term):
+        """
+        :return: list of values of a term in a hit as aggregation keys:
+            timestamps are put into buckets of date_histogram (epoch
+            milliseconds).
+        """
+        value = hit["_source"].get(term)
+        values = [x for x in (value if isinstance(value, list) else [value])
+                  if x is not None]
+        if term == settings.ES_TIMESTAMP_FIELD:
+            interval = interval_to_ms(self.raw_filters.get("interval", "5m"))
+            millis = [pandas.Timestamp(x).value // 10**6 for x in values]
+            values = [int(x - x % interval) for x in millis]
+        return values
+
+    def build_frame(self, hits):
+        """
+        :return: pandas.DataFrame - values of terms, column "hit" is
+            a position in `hits`. Docs with several values of a term get
+            a row per value, docs without a term get no rows (like in
+            composite aggregation).
+        """
+        rows = []
+        for pos, hit in enumerate(hits):
+            rows.extend(_product(
+                [[pos]] + [self.get_term_values(hit, term) for term in self.terms]))
+        return pandas.DataFrame(rows, columns=["hit"] + list(self.terms))
+
+    def group_segments(self, frame, hits):
+        """
+        :return: list of tuples (segment, positions of hits), in the order
+            of segments in composite aggregation.
+        """
+        if not self.terms:
+            return [({}, frame["hit"].values)]
+
+        groups = frame.groupby(list(self.terms), sort=True)["hit"]
+        segments = []
+        for key, positions in sorted(groups.indices.items()):
+            key = key if isinstance(key, tuple) else (key,)
+            segment = dict(zip(self.terms, (_scalar(x) for x in key)))
+            segments.append((segment, frame["hit"].values[positions]))
+        return segments
+
+    def get_clusters(self, normalize_text=True):
+        hits = self.scan_hits(normalize_text)
+        if hits is None:
+            # The window is too big to be processed in memory.
+            return super().get_clusters(normalize_text)
+
+        self.clusters = []
+        for segment, positions in self.group_segments(self.build_frame(hits), hits):
+            positions = numpy.unique(positions)
+            # Cluster is a collection of more than N docs.
+            if len(positions) < settings.HOTSPOT_MIN_ENTRIES:
+                continue
+
+            # The same number of docs as a search returns.
+            positions = positions[:settings.ES_MAX_RESULTS]
+            segment.update(docs=self._hits_to_docs(
+                [hits[x] for x in positions], normalize_text))
+            self.clusters.append(segment)
+        return RecordDict(clusters=self.clusters, errors=self.errors)
+
+
+class ScanGeoClusterBuilder(ScanClusterBuilder, GeoClusterBuilder):
+    """
+    Groups docs of a single scroll pass by geohash cells, then by terms.
+
+    Docs of a segment are docs of its cell (in "es" engine a segment
+    query by bounding box of the cell may get docs of neighbouring cells).
+    """
+    def get_scan_fields(self, normalize_text):
+        return super().get_scan_fields(normalize_text) + [settings.ES_GEO_FIELD]
+
+    def build_frame(self, hits):
+        """
+        :return: pandas.DataFrame - a row per hit, with coordinates and
+            geohash cells of the max precision in use.
+        """
+        locations = [hit["_source"][settings.ES_GEO_FIELD] for hit in hits]
+        frame = pandas.DataFrame({
+            "hit": numpy.arange(len(hits)),
+            "lat": numpy.array([x["lat"] for x in locations], dtype=numpy.float64),
+            "lon": numpy.array([x["lon"] for x in locations], dtype=numpy.float64)
+            })
+        precision = settings.GEO_CLUSTER_MAX_PRECISION if self.adaptive else self.precision
+        frame["cell"] = geohash_encode_many(frame["lat"].values, frame["lon"].values,
+                                            precision)
+        return frame
+
+    def get_cells(self, frame):
+        """
+        Groups hits by geohash cells. In adaptive mode cells are split
+        until they have at most settings.GEO_CLUSTER_MAX_SIZE docs or
+        reach settings.GEO_CLUSTER_MAX_PRECISION.
+
+        :return: list of numpy.arrays - positions of hits by cells.
+        """
+        if not self.adaptive:
+            return [x for _, x in sorted(frame.groupby("cell").indices.items())]
+
+        cells = []
+        split = [numpy.arange(len(frame))]
+        precision = self.precision
+        while split:
+            hits = numpy.concatenate(split)
+            prefixes = frame["cell"].str[:precision].values[hits]
+            split = []
+            for _, idx in sorted(pandas.Series(hits).groupby(prefixes).indices.items()):
+                if (precision < settings.GEO_CLUSTER_MAX_PRECISION) \
+                   and (len(idx) > settings.GEO_CLUSTER_MAX_SIZE):
+                    split.append(hits[idx])
+                else:
+                    cells.append(hits[idx])
+            precision += 1
+        return cells
+
+    def group_segments(self, frame, hits):
+        cells = self.get_cells(frame)
+        cell_of_hit = numpy.zeros(len(frame), dtype=numpy.int64)
+        for i, cell in enumerate(cells):
+            cell_of_hit[cell] = i
+
+        # Segments are by cells and each term separately.
+        groups = [[] for _ in cells]
+        for term in self.terms:
+            term_frame = pandas.DataFrame(
+                [(pos, value) for pos, hit in enumerate(hits)
+                 for value in self.get_term_values(hit, term)],
+                columns=["hit", "value"]
+                )
+            if not len(term_frame):
+                # No doc has the term (or no docs at all).
+                continue
+            term_frame["cell"] = cell_of_hit[term_frame["hit"].values]
+            indices = term_frame.groupby(["cell", "value"]).indices
+            for (cell, value), idx in sorted(indices.items()):
+                groups[cell].append((term, value, term_frame["hit"].values[idx]))
+
+        segments = []
+        for cell, cell_groups in zip(cells, groups):
+            if not cell_groups:
+                continue
+            # Bounds of the points in the cell (like geo_bounds aggregation).
+            bounds = self._check_lat_long({
+                "top_left_lat": float(frame["lat"].values[cell].max()),
+                "top_left_lon": float(frame["lon"].values[cell].min()),
+                "bottom_right_lat": float(frame["lat"].values[cell].min()),
+                "bottom_right_lon": float(frame["lon"].values[cell].max())
+                })
+            for term, value, positions in cell_groups:
+                segment = bounds.copy()
+                segment[term] = _scalar(value)
+                segments.append((segment, positions))
+        return segments
+
+
+def _product(values):
+    """
+    :param values: list of lists.
+    :return: list of lists - cartesian product.
+    """
+    rows = [[]]
+    for options in values:
+        rows = [row + [x] for row in rows for x in options]
+    return rows
+
+
+def _scalar(value):
+    """
+    Converts numpy scalars to python ones (segments are serialized).
+    """
+    return value.item() if isinstance(value, numpy.generic) else value
@@ -4,9 +4,11 @@ from django.conf import settings
 from django.db.models.constants import LOOKUP_SEP
 
 from elasticsearch import NotFoundError
+from elasticsearch.helpers import streaming_bulk
 
 from core.utils import get_val_by_path, build_filters_geo, build_filters_time, \
      QUERY_TERMS
+from dataman import resultcache
 
 
 es = settings.ES_CLIENT
@@ -131,6 +133,9 @@ ES_INDEX_MAPPING = {
                 }
             }
         },
+        "region": {
+            "type": "keyword"
+        },
         "text": {
             "type": "text",
             "fields": {
@@ -178,6 +183,16 @@ ES_INDEX_MAPPING = {
                     "ignore_above": 256
                 }
             }
+        },
+        "normalized_text": {
+            "type": "text",
+            "index": False
+        },
+        "fingerprint": {
+            "type": "long"
+        },
+        "geo_pending": {
+            "type": "boolean"
         }
     }
 }
@@ -242,14 +257,72 @@ def _do_create_or_update_doc(id_, body):
 @index_required
 def create_or_update_doc(id_, body):
     response = _do_create_or_update_doc(id_, body)
+    resultcache.invalidate([body])
     return response["result"]
 
 
+def _do_bulk(actions):
+    """
+    :param actions: list of dicts - bulk actions.
+    :return: list of str - results of actions ("created", "updated",
+        "noop" or "failed"), in the same order.
+    """
+    results = []
+    for ok, item in streaming_bulk(es, actions, raise_on_error=False,
+                                   raise_on_exception=False):
+        _, info = item.popitem()
+        results.append(info.get("result", "updated") if ok else "failed")
+    return results
+
+
+def bulk_create_or_update(docs):
+    """
+    Indexes many docs in bulk requests (the index must exist, see
+    `ensure_mapping`).
+
+    :param docs: list of tuples (id, body).
+    :return: list of str - "created", "updated" or "failed" per doc.
+    """
+    results = _do_bulk([{
+        "_op_type": "index",
+        "_index": settings.ES_INDEX,
+        "_type": settings.ES_DOC_TYPE,
+        "_id": id_,
+        "_source": body
+        } for id_, body in docs])
+    resultcache.invalidate(body for _, body in docs)
+    return results
+
+
+def bulk_update(updates, invalidate=True):
+    """
+    Partially updates many docs in bulk requests.
+
+    :param updates: list of tuples (id, dict of fields to update).
+    :param invalidate: bool - invalidate cached results of the docs, like
+        `create_or_update_doc` (fields should include the timestamp,
+        otherwise all results are invalidated). Updates of fields that
+        don't change clusters (e.g. flags) keep them.
+    :return: list of str - "updated", "noop" or "failed" per doc.
+    """
+    results = _do_bulk([{
+        "_op_type": "update",
+        "_index": settings.ES_INDEX,
+        "_type": settings.ES_DOC_TYPE,
+        "_id": id_,
+        "doc": fields
+        } for id_, fields in updates])
+    if invalidate:
+        resultcache.invalidate(fields for _, fields in updates)
+    return results
+
+
 @index_required
 def delete_doc(id_):
     response = es.delete(
         index=settings.ES_INDEX, doc_type=settings.ES_DOC_TYPE, id=id_
         )
+    resultcache.invalidate_all()
     return response["result"]
 
 
@@ -272,6 +345,43 @@ def search(query, scroll=False):
         return response
 
 
+@index_required
+def msearch(queries):
+    """
+    Runs many searches in one request.
+
+    :param queries: list of dicts - search bodies.
+    :return: list of responses in the same order (failed searches are
+        dicts with the key "error").
+    """
+    body = []
+    for query in queries:
+        body.extend([{}, query])
+    response = es.msearch(
+        index=settings.ES_INDEX, doc_type=settings.ES_DOC_TYPE, body=body
+        )
+    return response["responses"]
+
+
+@index_required
+def get_sources(ids, fields):
+    """
+    Fetches fields of many docs in one request.
+
+    :param ids: list of str.
+    :param fields: list of str - fields of _source.
+    :return: dict {id: _source} of docs found.
+    """
+    if not ids:
+        return {}
+    response = es.mget(
+        index=settings.ES_INDEX, doc_type=settings.ES_DOC_TYPE,
+        body={"ids": list(ids)}, _source=fields
+        )
+    return dict((doc["_id"], doc["_source"])
+                for doc in response["docs"] if doc.get("found"))
+
+
 @index_required
 def scroll(scroll_id):
     try:
@@ -282,6 +392,17 @@ def scroll(scroll_id):
         return response
 
 
+def clear_scroll(scroll_id):
+    """
+    Frees the search context of a scroll that isn't read to the end.
+    """
+    try:
+        es.clear_scroll(scroll_id=scroll_id)
+    except Exception:
+        # The context expires anyway.
+        pass
+
+
 def search_id(id_):
     query = {"query": {"match" : {"_id": id_}}}
     res = search(query)
@@ -299,8 +420,9 @@ def update_doc(id_, **data):
     res = search_id(id_)
     doc = res["hits"]["hits"][0]["_source"]
     doc.update(data)
-    response = create_or_update_doc(id_, doc)
-    return response
+    # Updates of flags don't change clusters: cached results stay valid.
+    response = _do_create_or_update_doc(id_, doc)
+    return response["result"]
 
 
 def return_all(size=settings.ES_MAX_RESULTS):
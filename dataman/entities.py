@@ -0,0 +1,84 @@
+"""
+Extraction of entities (hashtags, media urls, etc.) from raw tweets.
+
+A tweet is walked once, every string and list value is passed to all
+registered extractors, and results are accumulated in sets. Nested
+retweets and quoted tweets are covered by the same walk.
+"""
+from collections.abc import MutableMapping
+
+
+def extract_hatshtags(val):
+    tags = []
+    if isinstance(val, str):
+        if "#" not in val:
+            return tags
+        tags = [x.strip("#.,-\"\'&*^!") for x in val.split()
+                if (x.startswith("#") and len(x) < 256)]
+    elif isinstance(val, list):
+        for entity in val:
+            if not isinstance(entity, dict):
+                continue
+
+            if "hashtags" in entity:
+                try:
+                    tags.extend(entity["hashtags"])
+                except:
+                    pass
+            else:
+                try:
+                    tags = [x["text"].strip() for x in val]
+                except (KeyError, AttributeError, TypeError):
+                    pass
+    return tags
+
+
+def extract_media_urls(val):
+    urls = []
+    if not isinstance(val, list):
+        return urls
+
+    for item in val:
+        try:
+            urls.append(item["media_url"])
+        except (KeyError, TypeError):
+            pass
+        try:
+            urls.append(item["media_url_https"])
+        except (KeyError, TypeError):
+            pass
+    return urls
+
+
+# Entity name -> function, that receives a string or list value of any
+# key of a tweet and returns a list of entities found in it.
+ENTITY_EXTRACTORS = {
+    "hashtags": extract_hatshtags,
+    "media_urls": extract_media_urls,
+    }
+
+
+def collect_entities(data, extractors=None):
+    """
+    Collects entities from all keys of a tweet in a single walk.
+
+    :param data: dict - raw tweet.
+    :param extractors: dict {name: function} (ENTITY_EXTRACTORS by default).
+    :return: dict {name: set of entities}.
+    """
+    if extractors is None:
+        extractors = ENTITY_EXTRACTORS
+    extractors = list(extractors.items())
+    entities = dict((name, set()) for name, _ in extractors)
+
+    stack = [data]
+    while stack:
+        for val in stack.pop().values():
+            if isinstance(val, (str, list)):
+                for name, extract in extractors:
+                    found = extract(val)
+                    if found:
+                        entities[name].update(found)
+            elif isinstance(val, MutableMapping):
+                stack.append(val)
+    return entities
@@ -0,0 +1,83 @@
+"""
+Parallel categorization of clusters across a process pool.
+
+Categorization is CPU-bound pure Python, so threads do not help.
+Clusters are submitted to a pool of processes, the largest ones
+first (they take the longest), and results are returned in the
+original order of clusters.
+"""
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+
+from dataman.processors import categorize_repr_docs
+
+
+LOG = logging.getLogger("tasks")
+
+_EXECUTOR = None
+
+
+def get_executor():
+    """
+    Process pool is created once per process and reused by requests.
+    Its size is capped by settings.CATEGORIZE_PROCESSES (every web
+    worker has its own pool).
+    """
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        _EXECUTOR = ProcessPoolExecutor(max_workers=settings.CATEGORIZE_PROCESSES)
+    return _EXECUTOR
+
+
+def shutdown_executor():
+    global _EXECUTOR
+    if _EXECUTOR is not None:
+        _EXECUTOR.shutdown(wait=False)
+        _EXECUTOR = None
+
+
+def _categorize_serial(clusters, centrality):
+    return [categorize_repr_docs(cluster["docs"], centrality=centrality)
+            for cluster in clusters]
+
+
+def categorize_clusters(clusters, centrality=None):
+    """
+    Runs `categorize_repr_docs` for every cluster.
+
+    Small workloads (fewer than settings.CATEGORIZE_PARALLEL_MIN_DOCS
+    docs in total, or a single cluster) are processed in the current
+    process: pickling docs to the pool would cost more than it saves.
+    So are all workloads if settings.CATEGORIZE_PROCESSES is 0.
+    So are the workloads in processes that cannot have children
+    (e.g. daemonic workers of celery prefork pool).
+
+    :param clusters: list of dicts with key "docs".
+    :param centrality: str - one of CENTRALITY_MODES
+        (settings.REPR_CENTRALITY by default).
+    :return: list of dicts (see `categorize_repr_docs`) in the order
+        of `clusters`.
+    """
+    centrality = centrality or settings.REPR_CENTRALITY
+    total = sum(len(cluster["docs"]) for cluster in clusters)
+    if (not settings.CATEGORIZE_PROCESSES) or (len(clusters) < 2) \
+            or (total < settings.CATEGORIZE_PARALLEL_MIN_DOCS):
+        return _categorize_serial(clusters, centrality)
+
+    order = sorted(range(len(clusters)),
+                   key=lambda i: len(clusters[i]["docs"]), reverse=True)
+    try:
+        executor = get_executor()
+        futures = dict(
+            (i, executor.submit(categorize_repr_docs, clusters[i]["docs"], centrality))
+            for i in order
+            )
+        return [futures[i].result() for i in range(len(clusters))]
+    except (AssertionError, OSError, BrokenProcessPool) as exc:
+        # AssertionError: daemonic processes are not allowed to have children.
+        LOG.warning("Parallel categorization failed, falling back to serial: {}".format(exc))
+        shutdown_executor()
+        return _categorize_serial(clusters, centrality)
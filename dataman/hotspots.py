@@ -0,0 +1,202 @@
+"""
+Hotspots: density-based clusters of geotagged docs.
+
+Unlike geohash_grid cells, hotspots don't depend on the grid: a hotspot
+is a DBSCAN cluster of docs, i.e. docs within `eps` meters of each other
+with at least `min_entries` docs around. Its location is the centroid
+of its docs, its bounds are the extent of its docs.
+
+DBSCAN runs on a grid: points (as 3D vectors, so distances don't depend
+on latitude) are snapped into cubes of eps/GRID_RATIO, and the cubes are
+clustered with their numbers of points as weights. Docs of the same
+place share a cube, so the cost depends on the number of distinct
+places rather than docs. Distances are off by the diagonal of a cube at
+most.
+"""
+import numpy
+import pandas
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+from django.conf import settings
+
+from dataman.elastic import search, scroll, clear_scroll
+from core.utils import geohash_encode, EARTH_RADIUS
+
+
+ENGINE_ES = "es"
+ENGINE_DBSCAN = "dbscan"
+HOTSPOT_ENGINES = (ENGINE_ES, ENGINE_DBSCAN)
+
+# Size of grid cubes is eps/GRID_RATIO.
+GRID_RATIO = 4.
+# Precision of geohashes of centroids (keys of hotspots).
+KEY_PRECISION = 7
+NOISE = -1
+
+
+def to_xyz(lats, lons):
+    """
+    :return: numpy.array of shape (n, 3) - points on the sphere of
+        EARTH_RADIUS (meters).
+    """
+    lats = numpy.radians(numpy.asarray(lats, dtype=numpy.float64))
+    lons = numpy.radians(numpy.asarray(lons, dtype=numpy.float64))
+    return EARTH_RADIUS * numpy.column_stack((
+        numpy.cos(lats) * numpy.cos(lons),
+        numpy.cos(lats) * numpy.sin(lons),
+        numpy.sin(lats)
+        ))
+
+
+def to_latlon(xyz):
+    """
+    :param xyz: numpy.array of shape (n, 3) - vectors (of any length).
+    :return: tuple of numpy.arrays (lats, lons).
+    """
+    x, y, z = xyz[:, 0], xyz[:, 1], xyz[:, 2]
+    return (numpy.degrees(numpy.arctan2(z, numpy.hypot(x, y))),
+            numpy.degrees(numpy.arctan2(y, x)))
+
+
+def grid_dbscan(lats, lons, eps, min_entries):
+    """
+    :param lats: sequence of latitudes.
+    :param lons: sequence of longitudes.
+    :param eps: float - max distance between neighbours (meters).
+    :param min_entries: int - min number of points in the neighbourhood
+        of a core point (including the point).
+    :return: numpy.array of int - labels of clusters (0, 1, ...) of
+        points, NOISE for points out of clusters.
+    """
+    xyz = to_xyz(lats, lons)
+    if not len(xyz):
+        return numpy.arange(0)
+
+    # Cubes of the grid, their weights and centers.
+    keys = numpy.floor(xyz / (eps / GRID_RATIO)).astype(numpy.int64)
+    _, cube, weights = numpy.unique(keys, axis=0, return_inverse=True,
+                                    return_counts=True)
+    cube = cube.ravel()
+    n_cubes = len(weights)
+    centers = numpy.column_stack([
+        numpy.bincount(cube, weights=xyz[:, i]) / weights for i in range(3)])
+
+    tree = cKDTree(centers)
+    pairs = tree.query_pairs(eps, output_type="ndarray").reshape(-1, 2)
+    density = weights \
+        + numpy.bincount(pairs[:, 0], weights=weights[pairs[:, 1]], minlength=n_cubes) \
+        + numpy.bincount(pairs[:, 1], weights=weights[pairs[:, 0]], minlength=n_cubes)
+    core = density >= min_entries
+
+    # Clusters are connected components of core cubes.
+    labels = numpy.full(n_cubes, NOISE, dtype=numpy.int64)
+    if not core.any():
+        return labels[cube]
+    linked = pairs[core[pairs[:, 0]] & core[pairs[:, 1]]]
+    graph = sparse.coo_matrix(
+        (numpy.ones(len(linked)), (linked[:, 0], linked[:, 1])),
+        shape=(n_cubes, n_cubes)
+        )
+    _, components = connected_components(graph, directed=False)
+    _, labels[core] = numpy.unique(components[core], return_inverse=True)
+
+    # Border cubes join the cluster of the nearest core cube.
+    border = numpy.flatnonzero(~core)
+    if len(border):
+        core_idx = numpy.flatnonzero(core)
+        distance, nearest = cKDTree(centers[core_idx]).query(
+            centers[border], distance_upper_bound=eps)
+        found = numpy.isfinite(distance)
+        labels[border[found]] = labels[core_idx[nearest[found]]]
+    return labels[cube]
+
+
+def find_hotspots(lats, lons, eps, min_entries, size=None):
+    """
+    :param size: int - max number of hotspots (the biggest ones).
+    :return: list of dicts - hotspots in the format of geohash_grid
+        buckets: {
+            "key": <geohash of the centroid>,
+            "doc_count": <int>,
+            "location": {"lat": <float>, "lon": <float>},
+            "bounds": {"top_left": {...}, "bottom_right": {...}}
+            }
+        sorted by doc_count (descending).
+    """
+    lats = numpy.asarray(lats, dtype=numpy.float64)
+    lons = numpy.asarray(lons, dtype=numpy.float64)
+    labels = grid_dbscan(lats, lons, eps, min_entries)
+    clustered = labels != NOISE
+    if not clustered.any():
+        return []
+
+    xyz = to_xyz(lats[clustered], lons[clustered])
+    frame = pandas.DataFrame({
+        "label": labels[clustered],
+        "lat": lats[clustered], "lon": lons[clustered],
+        "x": xyz[:, 0], "y": xyz[:, 1], "z": xyz[:, 2]
+        })
+    stats = frame.groupby("label").agg({
+        "lat": ["min", "max", "count"], "lon": ["min", "max"],
+        "x": "sum", "y": "sum", "z": "sum"
+        })
+    stats = stats.sort_values(("lat", "count"), ascending=False, kind="mergesort")
+    if size is not None:
+        stats = stats.iloc[:size]
+
+    centers_lat, centers_lon = to_latlon(
+        stats[[("x", "sum"), ("y", "sum"), ("z", "sum")]].values)
+    hotspots = []
+    for (_, row), lat, lon in zip(stats.iterrows(), centers_lat, centers_lon):
+        hotspots.append({
+            "key": geohash_encode(lat, lon, KEY_PRECISION),
+            "doc_count": int(row[("lat", "count")]),
+            "location": {"lat": float(lat), "lon": float(lon)},
+            "bounds": {
+                "top_left": {"lat": float(row[("lat", "max")]),
+                             "lon": float(row[("lon", "min")])},
+                "bottom_right": {"lat": float(row[("lat", "min")]),
+                                 "lon": float(row[("lon", "max")])}
+                }
+            })
+    return hotspots
+
+
+def get_hotspots(query, eps, min_entries, size=None):
+    """
+    Finds hotspots of docs matching a query. Locations of docs are
+    fetched with scroll.
+
+    :param query: dict - ES query (the value of "query").
+    :return: list of dicts (see `find_hotspots`), None if more than
+        settings.HOTSPOTS_MAX_DOCS docs match.
+    """
+    body = {
+        "query": {
+            "bool": {
+                "must": query,
+                "filter": {"exists": {"field": settings.ES_GEO_FIELD}}
+                }
+            },
+        "_source": [settings.ES_GEO_FIELD],
+        "size": settings.ES_SCROLL_BATCHSIZE
+        }
+    lats, lons = [], []
+    response = search(body, scroll=True)
+    if response and (response["hits"]["total"] > settings.HOTSPOTS_MAX_DOCS):
+        clear_scroll(response["_scroll_id"])
+        return None
+
+    scroll_id = None
+    while response and response["hits"]["hits"]:
+        for hit in response["hits"]["hits"]:
+            location = hit["_source"][settings.ES_GEO_FIELD]
+            lats.append(location["lat"])
+            lons.append(location["lon"])
+        scroll_id = response["_scroll_id"]
+        response = scroll(scroll_id)
+    if scroll_id is not None:
+        clear_scroll(scroll_id)
+    return find_hotspots(lats, lons, eps, min_entries, size=size)
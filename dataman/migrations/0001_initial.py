@@ -0,0 +1,23 @@
+# Generated by Django 2.0.6 on 2026-10-17 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SegmentState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255, unique=True)),
+                ('state', models.TextField(default='[]')),
+                ('updated', models.DateTimeField(auto_now=True, db_index=True)),
+            ],
+        ),
+    ]
@@ -1,3 +1,28 @@
+import json
+
 from django.db import models
 
-# Create your models here.
+
+class SegmentState(models.Model):
+    """
+    Representative tweets of a segment (cluster) between runs of
+    incremental categorization.
+
+    `state` is a JSON list of representatives: dicts with keys
+    "_id", "text" (normalized), "fingerprint" (LSH band keys),
+    "multiplicity" and "seen" (timestamp of the last match).
+    """
+    key = models.CharField(max_length=255, unique=True)
+    state = models.TextField(default="[]")
+    updated = models.DateTimeField(auto_now=True, db_index=True)
+
+    def __str__(self):
+        return self.key
+
+    @property
+    def representatives(self):
+        return json.loads(self.state)
+
+    @representatives.setter
+    def representatives(self, value):
+        self.state = json.dumps(value)
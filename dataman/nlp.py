@@ -0,0 +1,74 @@
+"""
+NLP stage: language detection and location entities of tweet texts.
+
+Polyglot loads NER models lazily, on the first text of every language,
+which makes the first tweets of every process pay seconds of loading.
+Models of supported languages (settings.LANGS) are loaded once per
+process by `warm_up`, which is called at worker boot.
+"""
+import logging
+from collections import namedtuple
+from functools import lru_cache
+
+from polyglot.text import Text
+from polyglot.tag import get_ner_tagger
+
+from django.conf import settings
+
+
+LOG = logging.getLogger("tweet")
+
+LOCATION_TAG = "I-LOC"
+
+# Result of the analysis of a text:
+#   lang - language code;
+#   places - tuple of str, location entities (empty for texts in
+#            unsupported languages).
+Analysis = namedtuple("Analysis", ["lang", "places"])
+
+
+def warm_up(langs=None):
+    """
+    Loads NER models into the process.
+
+    :param langs: list of language codes (settings.LANGS by default).
+    :return: list of language codes with models loaded.
+    """
+    loaded = []
+    for lang in langs or settings.LANGS:
+        try:
+            get_ner_tagger(lang=lang)
+        except Exception as exc:
+            # Missing model shouldn't prevent worker from starting.
+            LOG.warning("Failed to load NER model for '{}': {}".format(lang, exc))
+        else:
+            loaded.append(lang)
+    return loaded
+
+
+@lru_cache(maxsize=settings.NLP_CACHE_SIZE)
+def analyze(text):
+    """
+    Detects language of a text and extracts location entities.
+    Results are cached: retweets are analyzed only once per process.
+
+    :param text: str
+    :return: Analysis
+    """
+    text = Text(text)
+    lang = text.language.code
+    if lang not in settings.LANGS:
+        return Analysis(lang, ())
+
+    places = tuple(" ".join(x) for x in text.entities if x.tag == LOCATION_TAG)
+    return Analysis(lang, places)
+
+
+def analyze_many(texts):
+    """
+    Analyzes a batch of texts.
+
+    :param texts: iterable of str
+    :return: list of Analysis, in the same order.
+    """
+    return [analyze(text) for text in texts]
@@ -1,79 +1,134 @@
 import re
 import json
-import copy
 import logging
 import geopy
-import dpath.util
-from collections import MutableMapping
+from functools import lru_cache
 from decimal import Decimal
-from Levenshtein import ratio
-from polyglot.text import Text
+from collections.abc import MutableMapping
 
 from django.conf import settings
 from django.utils import timezone
 
-from dataman.elastic import search, tokenize, FilterConverter, QueryConverter, \
-     ES_INDEX_MAPPING, ES_KEYWORDS
+from dataman.elastic import search, msearch, tokenize, FilterConverter, \
+     QueryConverter, ES_INDEX_MAPPING, ES_KEYWORDS
+from dataman.entities import collect_entities
+from dataman.nlp import analyze
+from dataman.similarity import SimilarityKernel, near_duplicate_pairs, \
+     tfidf_centrality, MINHASHER, CENTRALITY_EDIT, CENTRALITY_TFIDF, \
+     CENTRALITY_MODES
 from countries import countries
+from core.geocoding import geocode_cached, enqueue
 from core.utils import RecordDict, get_val_by_path, flatten_dict, \
-     get_place_coords, avg_coords_list, meters, get_parsed_datetime, \
-     build_filters_geo, build_filters_time, ensure_dict, \
+     get_place_coords, avg_coords_list, nearest_location, get_parsed_datetime, \
+     build_filters_geo, ensure_dict, geohash_bounds, \
      UnsupportedValueError, MissingDataError
 
 
-cc = countries.CountryChecker(settings.WORLD_BORDERS)
+cc = countries.CountryChecker(
+    settings.WORLD_BORDERS,
+    grid_file=settings.COUNTRY_GRID_FILE,
+    simplified_file=settings.WORLD_BORDERS_SIMPLIFIED
+    )
+rc = countries.RegionChecker(settings.REGIONS_FILE, settings.REGIONS_FIELD)
 
 LOG = logging.getLogger("tweet")
-SIMILAR_PREDICTION_EDIT_DISTANCE_MAX = 0.8
 
 
-def normalize_aggressive(text):
-    """
-    Performs aggressive normalization of text
-    """
+# Aggressive normalization steps, in order: (compiled pattern, replacement).
+NORMALIZE_PIPELINE = [
     # Ampersand
-    text = re.sub(r'\s+&amp;?\s+', ' and ', text)
+    (re.compile(r'\s+&amp;?\s+'), ' and '),
     # User mentions
-    text = re.sub(r'@[A-Za-z0-9_]+\b', '_USER_ ', text)
+    (re.compile(r'@[A-Za-z0-9_]+\b'), '_USER_ '),
     # Time
-    text = re.sub(r"\b\d\d?:\d\d\s*[ap]\.?m\.?\b", '_TIME_', text, flags=re.IGNORECASE)
-    text = re.sub(r"\b\d\d?\s*[ap]\.?m\.?\b", '_TIME_', text, flags=re.IGNORECASE)
-    text = re.sub(r"\b\d\d?:\d\d:\d\d\b", '_TIME_', text, flags=re.IGNORECASE)
-    text = re.sub(r"\b\d\d?:\d\d\b", '_TIME_', text, flags=re.IGNORECASE)
+    (re.compile(r"\b\d\d?:\d\d\s*[ap]\.?m\.?\b", flags=re.IGNORECASE), '_TIME_'),
+    (re.compile(r"\b\d\d?\s*[ap]\.?m\.?\b", flags=re.IGNORECASE), '_TIME_'),
+    (re.compile(r"\b\d\d?:\d\d:\d\d\b", flags=re.IGNORECASE), '_TIME_'),
+    (re.compile(r"\b\d\d?:\d\d\b", flags=re.IGNORECASE), '_TIME_'),
     # URLs
-    text = re.sub(r'\bhttps?:\S+', ' _URL_ ', text, flags=re.IGNORECASE)
+    (re.compile(r'\bhttps?:\S+', flags=re.IGNORECASE), ' _URL_ '),
     # Broken URL at the end of a line
-    text = re.sub(r'\s+https?$', ' _URL_', text, flags=re.IGNORECASE)
+    (re.compile(r'\s+https?$', flags=re.IGNORECASE), ' _URL_'),
     # Non-alpha non-punctuation non-digit characters
-    text = re.sub(r'[^\w\d\s:\'",.\(\)#@\?!/’_]+', '', text)
-    # Newlines and double spaces
-    text = re.sub(r'\n', ' ', text)
-    text = re.sub(r'\s{2,}', ' ', text)
+    (re.compile(r'[^\w\d\s:\'",.\(\)#@\?!/’_]+'), ''),
+    # Newlines and double spaces (in one pass: replacing newlines with
+    # spaces and then collapsing whitespace gives the same result)
+    (re.compile(r'\s{2,}|\n'), ' '),
+    ]
+
+
+@lru_cache(maxsize=settings.NORMALIZE_CACHE_SIZE)
+def normalize_aggressive(text):
+    """
+    Performs aggressive normalization of text.
+    Results are cached: retweets and repeated texts are normalized
+    only once per process.
+    """
+    for pattern, replacement in NORMALIZE_PIPELINE:
+        text = pattern.sub(replacement, text)
     # Strip
-    text = text.strip()
-    return text
+    return text.strip()
+
 
+def normalize_many(texts):
+    """
+    Batch version of `normalize_aggressive`.
+
+    :param texts: iterable of str
+    :return: list of str
+    """
+    return [normalize_aggressive(text) for text in texts]
 
-def categorize_repr_docs(docs):
+
+def categorize_repr_docs(docs, centrality=CENTRALITY_EDIT):
+    """
+    Splits docs into representative and non-representative (duplicates).
+
+    :param docs: list of dicts with keys "_id", "_normalized_text"
+        (and "tokens" for TF-IDF centrality, optionally "_fingerprint" -
+        stored LSH fingerprint of normalized text).
+    :param centrality: str - one of CENTRALITY_MODES:
+        - "edit" (default): sum of edit-distance ratios to all docs;
+        - "tfidf": similarity of TF-IDF vectors of tokens to the
+          centroid of docs (much faster for big clusters).
+    :return: dict.
+    """
     def incr(container, key, inc_by=1):
         try:
             container[key] += inc_by
         except KeyError:
             container[key] = inc_by
 
+    if centrality not in CENTRALITY_MODES:
+        raise UnsupportedValueError(
+            "Centrality '{}' is not supported!".format(centrality)
+            )
+
     is_duplicate = {}
+    texts = [doc["_normalized_text"] for doc in docs]
+    if centrality == CENTRALITY_TFIDF:
+        # Exact ratios are only needed for candidate duplicates.
+        similarities = tfidf_centrality([doc["tokens"] for doc in docs])
+        fingerprints = [doc.get("_fingerprint", None) for doc in docs]
+        if not all(fingerprints):
+            fingerprints = None
+        duplicates = near_duplicate_pairs(texts, fingerprints=fingerprints)
+    else:
+        # Every unordered pair is compared once, the same similarities
+        # feed both multiplicity and centrality.
+        similarities, duplicates = SimilarityKernel(texts).scan()
 
     # Remove docs that have similar probability to another and very similar text
     # This exploits the fact that similar docs will have similar probabilities
     multiplicity = {}
-    for tu in docs:
-        for tv in docs:
-            similarity = ratio(tu["_normalized_text"], tv["_normalized_text"])
-            if similarity > SIMILAR_PREDICTION_EDIT_DISTANCE_MAX:
-                # The newer doc (larger id) is marked as a duplicate of the older (smaller id) doc
-                # Count the == in case there are duplicate ids in the
-                if int(tu["_id"]) < int(tv["_id"]):
-                    incr(multiplicity, tu["_id"])
+    for i, j in duplicates:
+        tu, tv = docs[i], docs[j]
+        if int(tv["_id"]) < int(tu["_id"]):
+            tu, tv = tv, tu
+        # The newer doc (larger id) is marked as a duplicate of the older (smaller id) doc
+        if int(tu["_id"]) < int(tv["_id"]):
+            incr(multiplicity, tu["_id"])
+            is_duplicate[tv["_id"]] = tu["_id"]
 
     # Add multiplicity for doc in docs:
     for doc in docs:
@@ -82,24 +137,16 @@ def categorize_repr_docs(docs):
         else:
             doc["_multiplicity"] = 1
 
-    # Create set for second pass (centrality)
-    centrality = {}
-    for tu in docs:
-        for tv in docs:
-            similarity = ratio(tu["_normalized_text"], tv["_normalized_text"])
-            # Compute centrality as sum of similarities
-            incr(centrality, tu["_id"], similarity)
-            incr(centrality, tv["_id"], similarity)
-
-            # Discard duplicates
-            if similarity > SIMILAR_PREDICTION_EDIT_DISTANCE_MAX:
-                if int(tu["_id"]) < int(tv["_id"]):
-                    is_duplicate[tv["_id"]] = tu["_id"]
+    # Compute centrality as sum of similarities (every pair counts
+    # for both of its docs).
+    centralities = {}
+    for doc, similarity in zip(docs, similarities):
+        incr(centralities, doc["_id"], 2*float(similarity))
 
     # Add centrality and mark centrality=0.0 for duplicates
     for doc in docs:
-        if doc["_id"] in centrality and not doc["_id"] in is_duplicate:
-            doc["_centrality"] = centrality[doc["_id"]]
+        if doc["_id"] in centralities and not doc["_id"] in is_duplicate:
+            doc["_centrality"] = centralities[doc["_id"]]
         else:
             doc["_centrality"] = 0.
 
@@ -125,66 +172,113 @@ def categorize_repr_docs(docs):
         }
 
 
-def extract_hatshtags(val):
-    tags = []
-    if isinstance(val, str):
-        tags = [x.strip("#.,-\"\'&*^!") for x in val.split()
-                if (x.startswith("#") and len(x) < 256)]
-    elif isinstance(val, list):
-        for entity in val:
-            if not isinstance(entity, dict):
-                continue
+# Marks missing values in projections.
+_MISSING = object()
 
-            if "hashtags" in entity:
-                try:
-                    tags.extend(entity["hashtags"])
-                except:
-                    pass
-            else:
-                try:
-                    tags = [x["text"].strip() for x in val]
-                except (KeyError, AttributeError, TypeError):
-                    pass
-    return tags
 
+def _get_path(doc, keys):
+    for key in keys:
+        try:
+            doc = doc[key]
+        except (KeyError, TypeError, IndexError):
+            return _MISSING
+    return doc
 
-def collect_hashtags(data, hashtags):
+
+class ProjectionPlan(object):
     """
-    Recursively collects hashtags from the all keys of a tweet.
+    Projection of a normalized tweet onto the fields of ES_INDEX_MAPPING,
+    compiled once from paths to preserve and fields excluded from
+    flattening.
+
+    Only the fields of the mapping are read, straight into the output
+    dict. A preserved path ("user/id") is read into its flattened field
+    ("user_id"), missing preserved values are None. Other nested values
+    are dropped (no other nested keys of tweets flatten into fields of
+    the mapping).
     """
-    for val in data.values():
-        if isinstance(val, MutableMapping):
-            _hatshtags = collect_hashtags(val, hashtags)
-        else:
-            _hatshtags = extract_hatshtags(val)
+    def __init__(self, preserve_paths, exclude_from_flatten=(), flatten=True,
+                 properties=None):
+        """
+        :param preserve_paths: iterable of str - field names and paths.
+        :param exclude_from_flatten: iterable of field names, kept as is.
+        :param flatten: bool - if False, nested values are kept.
+        :param properties: dict - mapping properties (ES_INDEX_MAPPING
+            by default).
+        """
+        if properties is None:
+            properties = ES_INDEX_MAPPING["properties"]
+        paths = [tuple(path.split("/")) for path in sorted(set(preserve_paths))]
+        top_paths = set(keys[0] for keys in paths if len(keys) == 1)
+        nested_paths = [keys for keys in paths if len(keys) > 1]
+        exclude = set(exclude_from_flatten)
+
+        # Steps are tuples (field, list of paths to try, default value,
+        # keep nested value).
+        self.steps = []
+        # Subtrees are tuples (field, list of paths) - preserved paths
+        # nested in a field of the mapping, kept if not flattened.
+        self.subtrees = []
+        for field in sorted(properties.keys()):
+            default = None if field in top_paths else _MISSING
+            subtree = [keys for keys in nested_paths if keys[0] == field]
+            if subtree:
+                # The field is replaced by the subtree of preserved paths,
+                # which disappears in flattening.
+                if (not flatten) or (field in exclude):
+                    self.subtrees.append((field, subtree))
+                continue
+
+            if not flatten:
+                self.steps.append((field, [(field,)], default, True))
+                continue
+
+            sources = [keys for keys in nested_paths if "_".join(keys) == field]
+            if sources:
+                # Already flat docs (e.g. re-indexed) have the field itself.
+                self.steps.append((field, sources + [(field,)], None, False))
+            else:
+                self.steps.append((field, [(field,)], default, field in exclude))
 
-        hashtags.extend(_hatshtags)
-    return list(set(hashtags))
+    def project(self, doc):
+        """
+        :param doc: dict - normalized tweet.
+        :return: dict.
+        """
+        result = {}
+        for field, paths, default, keep_nested in self.steps:
+            val = default
+            for keys in paths:
+                found = _get_path(doc, keys)
+                if found is not _MISSING:
+                    val = found
+                    break
+
+            if val is _MISSING:
+                continue
+            if isinstance(val, MutableMapping) and not keep_nested:
+                continue
+            result[field] = val
 
+        for field, paths in self.subtrees:
+            subtree = result[field] = {}
+            for keys in paths:
+                node = subtree
+                for key in keys[1:-1]:
+                    node = node.setdefault(key, {})
+                val = _get_path(doc, keys)
+                node[keys[-1]] = None if val is _MISSING else val
+        return result
 
-def collect_media_urls(data, media_urls):
+
+@lru_cache(maxsize=None)
+def get_projection_plan(preserve_paths, exclude_from_flatten, flatten=True):
     """
-    Recursively collects media urls from all keys of a tweet.
+    :param preserve_paths: frozenset of str.
+    :param exclude_from_flatten: frozenset of str.
+    :return: ProjectionPlan, compiled once per arguments.
     """
-    for val in data.values():
-        if isinstance(val, MutableMapping):
-            _media_urls = collect_media_urls(val, media_urls)
-        elif isinstance(val, list):
-            _media_urls = []
-            for item in val:
-                try:
-                    _media_urls.append(item["media_url"])
-                except (KeyError, TypeError):
-                    pass
-                try:
-                    _media_urls.append(item["media_url_https"])
-                except (KeyError, TypeError):
-                    pass
-        else:
-            continue
-
-        media_urls.extend(_media_urls)
-    return list(set(media_urls))
+    return ProjectionPlan(preserve_paths, exclude_from_flatten, flatten)
 
 
 class TweetNormalizer(object):
@@ -200,8 +294,17 @@ class TweetNormalizer(object):
         ]
     exclude_from_flatten = ["location"]
 
-    def __init__(self, doc, **kwargs):
-        self.original = ensure_dict(doc)
+    def __init__(self, doc, geocode_async=False, **kwargs):
+        """
+        :param doc: dict or JSON string - original record.
+        :param geocode_async: bool - if True, places that haven't been
+            geocoded yet are submitted to the geocoding queue, instead
+            of waiting for Nominatim (see `set_geotag`).
+        """
+        self.geocode_async = geocode_async
+        self.geo_pending = []
+        # Shallow copies only: nested values are never modified in place.
+        self.original = dict(ensure_dict(doc))
         try:
             self.original["annotations"]
         except KeyError:
@@ -210,12 +313,9 @@ class TweetNormalizer(object):
 
         if "tweet" in self.original.keys():
             # Restrcture original doc: place everything at the same level.
-            tweet = ensure_dict(self.original["tweet"])
-            doc_tweet = copy.deepcopy(tweet)
-            del self.original["tweet"]
-            self.original.update(doc_tweet)
+            self.original.update(ensure_dict(self.original.pop("tweet")))
 
-        self.normalized = copy.deepcopy(self.original)
+        self.normalized = dict(self.original)
         self.normalized.update({
             "tweetid": str(self.original["id"]),
             "flood_probability": self.get_flood_prob(),
@@ -225,27 +325,24 @@ class TweetNormalizer(object):
                 )
             })
 
-    def restructure(self, **kwargs):
+    def project(self, **kwargs):
         """
-        Leaves in place only elements by given paths.
+        Projects normalized doc onto the fields of ES_INDEX_MAPPING.
 
-        :param preserve_paths: list of str - fields to preserve
+        :kwargs preserve_paths: list of str - fields to preserve
             (field names and paths).
-        :return: dict.
+        :kwargs flatten: bool - if True (default), flattens the final
+            structure.
+        :kwargs exclude_from_flatten: list of field names. Ignored if
+            `flatten` is False.
         """
-        paths = kwargs.get("preserve_paths", [])
-        paths.extend(self.preserve_paths)
-        paths = list(set(paths))
-
-        subtrees = {}
-        for path in paths:
-            val = get_val_by_path(path, **self.normalized)
-            if not "/" in path:
-                self.normalized[path] = val
-            else:
-                dpath.util.new(subtrees, path, val)
-
-        self.normalized.update(subtrees)
+        plan = get_projection_plan(
+            frozenset(kwargs.get("preserve_paths", [])) | frozenset(self.preserve_paths),
+            frozenset(kwargs.get("exclude_from_flatten", [])) \
+                | frozenset(self.exclude_from_flatten),
+            kwargs.get("flatten", True)
+            )
+        self.normalized = plan.project(self.normalized)
 
     def get_timestamp(self):
         try:
@@ -272,11 +369,10 @@ class TweetNormalizer(object):
     def set_country(self):
         country = self.normalized.get("country", None)
         if country is None:
-            self.normalized["country"] = str(
-                cc.getCountry(countries.Point(
-                    self.normalized["location"]["lat"],
-                    self.normalized["location"]["lon"]
-                    )))
+            self.normalized["country"] = str(cc.get_country(
+                self.normalized["location"]["lat"],
+                self.normalized["location"]["lon"]
+                ))
         place = self.normalized.get("place", None)
         if place is None:
             place = self.original.get("place", None)
@@ -297,11 +393,11 @@ class TweetNormalizer(object):
         if place:
             self.normalized["place"] = place.strip()
 
-    def get_locations_from_text(self, text):
+    def get_locations_from_text(self, places):
         """
-        Extracts locations from text and fills their geo-coordinates.
+        Fills geo-coordinates of locations extracted from text.
 
-        :param text: polyglot.text.Text
+        :param places: list of str - location entities (see `nlp.analyze`).
         :return: list of dicts {
             "place": <str>,
             "location": {
@@ -311,9 +407,8 @@ class TweetNormalizer(object):
             }
         """
         locations = []
-        places = [" ".join(x) for x in text.entities if x.tag == "I-LOC"]
         for place in places:
-            location = get_place_coords(place)
+            location = self.geocode(place)
             if location:
                 locations.append({
                     "place": place,
@@ -374,7 +469,7 @@ class TweetNormalizer(object):
         if not place:
             return {}
 
-        location = get_place_coords(place)
+        location = self.geocode(place)
         if location:
             return {"place": place, "location": location}
 
@@ -408,7 +503,7 @@ class TweetNormalizer(object):
         """
         place = self.get_place_from_user()
         if place:
-            location = get_place_coords(place)
+            location = self.geocode(place)
             if location:
                 return {
                     "place": place,
@@ -416,14 +511,49 @@ class TweetNormalizer(object):
                     }
         return {}
 
-    def set_geotag(self, text=None):
+    def geocode(self, place):
+        """
+        :param place: str
+        :return: dict {lat: <float>, lon: <float>} or empty dict, if
+            unsuccessfull or pending (in asynchronous mode).
+        """
+        if not self.geocode_async:
+            return get_place_coords(place)
+
+        location = geocode_cached(place)
+        if location is None:
+            self.geo_pending.append(place)
+            return {}
+        return location
+
+    def postpone_geotag(self):
+        """
+        Submits pending places to the geocoding queue and marks the doc
+        as pending (to be geotagged by `fill_geotags`).
         """
-        :param text: polyglot.text.Text
+        enqueue(self.geo_pending)
+        LOG.debug("Geotagging tweet {} postponed, pending places: {}".format(
+            self.original["id_str"], self.geo_pending))
+        self.normalized["geo_pending"] = True
+        return False
+
+    def set_geotag(self, analysis=None):
         """
-        if text is None:
-            text = Text(self.original["text"])
+        In asynchronous mode (`geocode_async`) the doc isn't geotagged
+        until all places it needs are geocoded, so that the result is the
+        same as in synchronous mode.
+
+        :param analysis: nlp.Analysis of the text (analyzed if not given).
+        :return: bool - True if geotagged.
+        """
+        if analysis is None:
+            analysis = analyze(self.original["text"])
+
+        self.geo_pending = []
+        locations = self.get_locations_from_text(analysis.places)
+        if self.geo_pending:
+            return self.postpone_geotag()
 
-        locations = self.get_locations_from_text(text)
         if len(locations) == 1:
             self.normalized.update(locations[0])
             return True
@@ -432,6 +562,8 @@ class TweetNormalizer(object):
         location_tweet = self.get_location_from_tweet()
         if not location_tweet:
             location_tweet = self.get_location_from_user()
+        if self.geo_pending:
+            return self.postpone_geotag()
 
         if len(locations) == 0:
             if location_tweet:
@@ -444,14 +576,12 @@ class TweetNormalizer(object):
 
         if len(locations) > 1:
             if location_tweet:
-                # longest distance on Earth in meters
-                distance = 20460000
-                location = None
-                for loc in locations:
-                    dist_ = meters(loc["location"], location_tweet["location"])
-                    if dist_ < distance:
-                        location = loc
-                        distance = dist_
+                idx, _ = nearest_location(
+                    [loc["location"] for loc in locations],
+                    location_tweet["location"],
+                    refine=True
+                    )
+                location = locations[idx]
             else:
                 location = locations[0]
 
@@ -462,22 +592,26 @@ class TweetNormalizer(object):
         return False
 
     def set_region(self):
-        # # TODO: administrative unit
-        # # https://drive.google.com/drive/folders/1mJV80c9xZS9RuogFS9oy59E43LaK-dvq
-        # from shapely.geometry import Point
-        # tweet_points = [Point(xy) for xy in zip(tweets.latlong[0], tweets.latlong[1])]
-        # region_shapes = regions[['geometry', 'ObjectID']]
-        # tweets_nuts = gpd.sjoin(tweet_points, region_shapes, how="inner", op='intersects')
-        pass
-
-    def set_language(self, text):
-        if text.language.code not in settings.LANGS:
+        """
+        Sets administrative region (see settings.REGIONS_FILE), if the
+        location is in any.
+        """
+        if self.normalized.get("region", None) is None:
+            region = rc.get_region(
+                self.normalized["location"]["lat"],
+                self.normalized["location"]["lon"]
+                )
+            if region is not None:
+                self.normalized["region"] = region
+
+    def set_language(self, analysis):
+        if analysis.lang not in settings.LANGS:
             raise UnsupportedValueError(
-                "Language '{}' is not supported!".format(text.language.code)
+                "Language '{}' is not supported!".format(analysis.lang)
                 )
 
-        if text.language.code != self.normalized["lang"]:
-            self.normalized.update({"lang": text.language.code})
+        if analysis.lang != self.normalized["lang"]:
+            self.normalized.update({"lang": analysis.lang})
 
     def set_timestamp(self):
         try:
@@ -495,65 +629,105 @@ class TweetNormalizer(object):
             pass
         self.normalized.update({"created_at": created_at})
 
-    def normalize(self, **kwargs):
+    def preprocess(self, analysis=None):
         """
-        :kwargs preserve_paths: list of str - path to values preserve
-            (e.g. ['user/id', 'user/description']).
-        :kwargs flatten: bool - if True (default), flattens the final
-            structure.
-        :kwargs exclude_from_flatten: list of field names. Ignored if
-            `flatten` is False.
+        Sets language, timestamp and geotag.
 
-        :return: dict.
+        :param analysis: nlp.Analysis of the text (analyzed if not given,
+            see `nlp.analyze_many` for batches).
+        :return: bool - True if geotagged.
         """
-        text = Text(self.original["text"])
-        self.set_language(text)
+        if analysis is None:
+            analysis = analyze(self.original["text"])
+        self.set_language(analysis)
         self.set_timestamp()
 
         try:
-            geotagged = self.set_geotag(text)
-        except geopy.exc.GeocoderQuotaExceeded as exc:
-            # Exceeded geopy quota, cannot set location reliably.
-            # This will be filled later and asynchronously.
+            return self.set_geotag(analysis)
+        except geopy.exc.GeopyError as exc:
+            # Exceeded geopy quota or Nominatim failed, cannot set location
+            # reliably. This will be filled later by `fill_geotags`.
             LOG.warning("Failed to set geotag: {}".format(exc))
-            pass
-        except Exception:
-            raise
-        else:
-            if geotagged:
-                self.set_country()
-                self.set_region()
-
-        # Call prior to `self.restructure` to collect hashtags from all fields!
-        hashtags, media_urls = [], []
-        hashtags = collect_hashtags(self.original, hashtags)
-        media_urls = collect_media_urls(self.original, media_urls)
-        self.restructure(**kwargs)
-        if kwargs.get("flatten", True):
-            exclude = kwargs.get("exclude_from_flatten", [])
-            exclude.extend(self.exclude_from_flatten)
-            to_flatten = dict((k, v) for k, v in self.normalized.items()
-                              if k not in exclude)
-            to_flatten = flatten_dict(to_flatten)
-            normalized = dict((k, v) for k, v in self.normalized.items()
-                              if k in exclude)
-            normalized.update(to_flatten)
-            self.normalized = normalized
+            self.normalized["geo_pending"] = True
+            return False
+
+    def postprocess(self, **kwargs):
+        """
+        Projects the doc onto the index mapping and fills tokens
+        (see `normalize` for kwargs).
+
+        :return: dict.
+        """
+        # Call prior to `self.project` to collect hashtags from all fields!
+        entities = collect_entities(self.original)
+        self.project(**kwargs)
 
         # TODO: use polyglot for tokenization
         #       (self.normalized["text"].words -> clean stop-words)
         tokens = tokenize(self.normalized["text"],
                           self.normalized.get("lang", None))
-        tokens.extend(hashtags)
+        tokens.extend(entities["hashtags"])
+        normalized_text = normalize_aggressive(self.normalized["text"])
         self.normalized.update({
             "tokens": list(set(tokens)),
-            "media_urls": list(set(media_urls))
+            "media_urls": list(entities["media_urls"]),
+            "normalized_text": normalized_text,
+            "fingerprint": MINHASHER.fingerprint(normalized_text)
             })
-
-        self.normalized = dict((key, val) for key, val in self.normalized.items()
-                               if key in ES_INDEX_MAPPING["properties"].keys())
         return self.normalized
 
+    def normalize(self, analysis=None, **kwargs):
+        """
+        In batches use `preprocess`, `set_countries` and `postprocess`
+        instead, to look up countries of all docs at once.
+
+        :param analysis: nlp.Analysis of the text (analyzed if not given,
+            see `nlp.analyze_many` for batches).
+        :kwargs preserve_paths: list of str - path to values preserve
+            (e.g. ['user/id', 'user/description']).
+        :kwargs flatten: bool - if True (default), flattens the final
+            structure.
+        :kwargs exclude_from_flatten: list of field names. Ignored if
+            `flatten` is False.
+
+        :return: dict.
+        """
+        if self.preprocess(analysis):
+            self.set_country()
+            self.set_region()
+        return self.postprocess(**kwargs)
+
+
+def set_countries(norms):
+    """
+    Batch version of `TweetNormalizer.set_country` and `set_region`:
+    countries and regions of all geotagged docs are looked up at once.
+    Call it between `TweetNormalizer.preprocess` and `postprocess`.
+
+    :param norms: list of geotagged TweetNormalizer instances.
+    """
+    missing = [norm for norm in norms
+               if norm.normalized.get("country", None) is None]
+    found = cc.get_countries(
+        [norm.normalized["location"]["lat"] for norm in missing],
+        [norm.normalized["location"]["lon"] for norm in missing]
+        )
+    for norm, country in zip(missing, found):
+        norm.normalized["country"] = str(country)
+
+    for norm in norms:
+        norm.set_country()
+
+    missing = [norm for norm in norms
+               if norm.normalized.get("region", None) is None]
+    found = rc.get_regions(
+        [norm.normalized["location"]["lat"] for norm in missing],
+        [norm.normalized["location"]["lon"] for norm in missing]
+        )
+    for norm, region in zip(missing, found):
+        if region is not None:
+            norm.normalized["region"] = region
+
 
 class ClusterBuilder(object):
     def __init__(self, *terms, **filters):
@@ -572,6 +746,7 @@ class ClusterBuilder(object):
         self.filters = self._get_filters(**filters)
         self.query = {}
         self.errors = []
+        self.segments_fieldname = "segments"
 
     @property
     def query(self):
@@ -595,13 +770,19 @@ class ClusterBuilder(object):
     def _get_filters(self, **filters):
         return FilterConverter(**filters).convert()
 
-    def build_query(self, match=None, filters=None, size=settings.ES_MAX_RESULTS):
+    def build_query(self, match=None, filters=None, size=settings.ES_MAX_RESULTS,
+                    source=None):
+        """
+        :param source: list of fields to return (all if None).
+        """
         match = match or self.match
         filters = filters or self.filters
         qry = {
             "query": {},
             "size": size
             }
+        if source is not None:
+            qry["_source"] = source
         if filters:
             qry["query"].update({
                 "bool": {
@@ -614,49 +795,43 @@ class ClusterBuilder(object):
 
         return qry
 
-    def get_clusters(self, normalize_text=True):
-        self.query = self.build_query()
-        self.query = self.define_aggregations()
-        segments = self.get_segments(self.query)
-        return {
-            "clusters": self.collect_clusters(segments, normalize_text),
-            "errors": self.errors
-            }
-
-    def build_aggregation(self):
+    def build_aggregation(self, after=None):
         """
-        Builds nested aggregations according to the order of self.terms.
+        Builds composite aggregation by self.terms (in this order), which
+        returns segments by pages of settings.ES_COMPOSITE_SIZE.
+
+        :param after: dict - key of the last segment of the previous page.
         """
-        aggregations = {}
-        branch = aggregations
+        sources = []
         for term in self.terms:
             assert term != settings.ES_GEO_FIELD, \
               "Cannot aggregate by {}, use GeoClusterBuilder for this purpose!".format(settings.ES_GEO_FIELD)
 
-            name = "agg_{}".format(term)
             if term == settings.ES_TIMESTAMP_FIELD:
-                agg = {
-                    name: {
-                        "date_histogram": {
-                            "field": term,
-                            "interval": self.raw_filters.get("interval", "5m")
-                            }
+                source = {
+                    "date_histogram": {
+                        "field": term,
+                        "interval": self.raw_filters.get("interval", "5m")
                         }
                     }
             else:
-                if term in ES_KEYWORDS:
-                    term = "{}.keyword".format(term)
-                agg = {
-                    name: {
-                        "terms": {
-                            "field": term,
-                            }
-                        }
-                    }
-            branch.update({"aggregations": agg})
-            branch = branch["aggregations"][name]
+                field = "{}.keyword".format(term) if term in ES_KEYWORDS else term
+                source = {"terms": {"field": field}}
+            sources.append({term: source})
 
-        return aggregations
+        composite = {
+            "size": settings.ES_COMPOSITE_SIZE,
+            "sources": sources
+            }
+        if after:
+            composite["after"] = after
+        return {
+            "aggregations": {
+                self.segments_fieldname: {
+                    "composite": composite
+                    }
+                }
+            }
 
     def define_aggregations(self, query=None):
         query = query or self.query
@@ -673,48 +848,116 @@ class ClusterBuilder(object):
                 })
             return None
 
-    def _buckets_to_segments(self, segments, buckets, chunk, term, agg_keys):
-        for bucket in buckets:
-            chunk[term] = bucket["key"]
+    def _do_msearch(self, queries):
+        """
+        Runs searches in batches of settings.ES_MSEARCH_BATCHSIZE.
+
+        :return: list of responses, None for failed searches.
+        """
+        responses = []
+        batch_size = settings.ES_MSEARCH_BATCHSIZE
+        for start in range(0, len(queries), batch_size):
+            batch = queries[start:start+batch_size]
             try:
-                agg_key = [k for k in bucket.keys() if k in agg_keys][0]
-            except IndexError:
-                if bucket["doc_count"] >= settings.HOTSPOT_MIN_ENTRIES:
-                    chunk_ = chunk.copy()
-                    segments.append(chunk_)
-            else:
-                self._buckets_to_segments(
-                    segments,
-                    bucket[agg_key]["buckets"],
-                    chunk,
-                    agg_key.split("_")[1],
-                    agg_keys
-                    )
-        return segments
+                results = msearch(batch)
+            except Exception as err:
+                self.errors.extend({"query": query, "error": err} for query in batch)
+                responses.extend([None] * len(batch))
+                continue
+
+            for query, result in zip(batch, results):
+                if "error" in result:
+                    self.errors.append({"query": query, "error": result["error"]})
+                    result = None
+                responses.append(result)
+        return responses
+
+    def iter_segments(self, query):
+        """
+        Pages through segments with the after key of composite
+        aggregation, so that no segment is left out.
+
+        :return: generator of lists of segments (dicts {term: value}).
+        """
+        if not self.terms:
+            yield [{}]
+            return
+
+        after = None
+        while True:
+            query.update(self.build_aggregation(after))
+            queryset = self._do_search(query)
+            if queryset is None:
+                return
+
+            aggregation = queryset["aggregations"][self.segments_fieldname]
+            buckets = aggregation["buckets"]
+            segments = [dict(bucket["key"]) for bucket in buckets
+                        if bucket["doc_count"] >= settings.HOTSPOT_MIN_ENTRIES]
+            if segments:
+                yield segments
+            if len(buckets) < settings.ES_COMPOSITE_SIZE:
+                return
+            # ES < 6.3 doesn't return "after_key".
+            after = aggregation.get("after_key", buckets[-1]["key"])
 
     def get_segments(self, query):
-        queryset = self._do_search(query)
-        if queryset is None:
-            return []
+        return [segment for segments in self.iter_segments(query)
+                for segment in segments]
 
-        segments = []
-        chunk = {}
-        keys = ["agg_{}".format(term) for term in self.terms]
-        key = "agg_{}".format(self.terms[0])
-        data = queryset["aggregations"][key]["buckets"]
-        term = self.terms[0]
-        return self._buckets_to_segments(segments, data, chunk, term, keys)
+    def _hits_to_docs(self, hits, normalize_text):
+        """
+        Retains only fields necessary for text analysis. Normalized text
+        and fingerprint are stored at ingest time, they are only computed
+        here for docs indexed before that.
+        """
+        docs = []
+        for hit in hits:
+            doc = RecordDict(
+                _id=hit["_id"],
+                text=hit["_source"]["text"],
+                tokens=hit["_source"]["tokens"]
+                )
+            if normalize_text:
+                doc.update(
+                    _normalized_text=hit["_source"].get("normalized_text", None),
+                    _fingerprint=hit["_source"].get("fingerprint", None)
+                    )
+            docs.append(doc)
+
+        missing = [doc for doc in docs
+                   if normalize_text and doc._normalized_text is None]
+        for doc, text in zip(missing, normalize_many(x.text for x in missing)):
+            doc.update(_normalized_text=text)
+        return docs
+
+    def get_source_fields(self, normalize_text):
+        """
+        :return: list of fields necessary for text analysis.
+        """
+        fields = ["text", "tokens"]
+        if normalize_text:
+            fields.extend(["normalized_text", "fingerprint"])
+        return fields
+
+    def build_segment_query(self, segment, normalize_text):
+        # Segment's terms (or geo_bounding_box) are added to filters.
+        segment_filters = self.raw_filters.copy()
+        segment_filters.update(segment)
+        segment_filters = self._get_filters(**segment_filters)
+        return self.build_query(
+            filters=segment_filters,
+            source=self.get_source_fields(normalize_text)
+            )
 
     def collect_clusters(self, segments, normalize_text):
+        """
+        Docs of all segments are fetched with multi-search requests.
+        """
+        queries = [self.build_segment_query(segment, normalize_text)
+                   for segment in segments]
         clusters = []
-        for segment in segments:
-            # Replace geo_bounding_box in self.filters with a box
-            # that defines a current segment.
-            segment_filters = self.raw_filters.copy()
-            segment_filters.update(segment)
-            segment_filters = self._get_filters(**segment_filters)
-            query = self.build_query(filters=segment_filters)
-            queryset = self._do_search(query)
+        for segment, queryset in zip(segments, self._do_msearch(queries)):
             if queryset is None:
                 continue
 
@@ -722,27 +965,18 @@ class ClusterBuilder(object):
             if queryset["hits"]["total"] < settings.HOTSPOT_MIN_ENTRIES:
                 continue
 
-            docs = []
-            for doc in queryset["hits"]["hits"]:
-                # Retain only fields necessary for text analysis.
-                doc = RecordDict(
-                    _id=doc["_id"],
-                    text=doc["_source"]["text"],
-                    tokens=doc["_source"]["tokens"]
-                    )
-                if normalize_text:
-                    doc.update(_normalized_text=normalize_aggressive(doc.text))
-                docs.append(doc)
+            docs = self._hits_to_docs(queryset["hits"]["hits"], normalize_text)
             segment.update({"docs": docs})
             clusters.append(segment)
 
         return clusters
 
     def get_clusters(self, normalize_text=True):
-        self.query = self.build_query()
-        self.query = self.define_aggregations()
-        segments = self.get_segments(self.query)
-        self.clusters = self.collect_clusters(segments, normalize_text)
+        # Only aggregations are needed, not hits.
+        self.query = self.build_query(size=0)
+        self.clusters = []
+        for segments in self.iter_segments(self.query):
+            self.clusters.extend(self.collect_clusters(segments, normalize_text))
         return RecordDict(clusters=self.clusters, errors=self.errors)
 
 
@@ -757,12 +991,17 @@ class GeoClusterBuilder(ClusterBuilder):
                     this key means {"match_all": {}}.
                   - 'precision' defines geohash precision (by default 5,
                     i.e. the least accurate for getting bigger clusters).
+                  - 'adaptive' (bool): start with coarse cells
+                    (settings.GEO_CLUSTER_MIN_PRECISION by default) and
+                    split only those with more than
+                    settings.GEO_CLUSTER_MAX_SIZE docs.
         """
+        self.adaptive = str(filters.pop("adaptive", "")).lower() in ("1", "true")
+        default_precision = settings.GEO_CLUSTER_MIN_PRECISION if self.adaptive else 5
+        self.precision = int(filters.pop("precision", default_precision))
         super().__init__(*terms, **filters)
-        self.precision = filters.pop("precision", 5)
-        self.segments_fieldname = "segments"
 
-    def build_aggregation(self):
+    def build_aggregation(self, precision=None):
         aggs = {
             "cell": {
                 "geo_bounds": {
@@ -781,7 +1020,7 @@ class GeoClusterBuilder(ClusterBuilder):
                 self.segments_fieldname: {
                     "geohash_grid": {
                         "field": settings.ES_GEO_FIELD,
-                        "precision": self.precision,
+                        "precision": precision or self.precision,
                         },
                     "aggs": aggs
                     }
@@ -800,42 +1039,6 @@ class GeoClusterBuilder(ClusterBuilder):
             box["bottom_right_lon"] += 0.001
         return box
 
-    def collect_clusters(self, segments, normalize_text):
-        """
-        Adapted to segment by geo-location.
-        """
-        clusters = []
-        for segment in segments:
-            # Replace geo_bounding_box in self.filters with a box
-            # that defines a current segment.
-            segment_filters = self.raw_filters.copy()
-            segment_filters.update(segment)
-            segment_filters = self._get_filters(**segment_filters)
-            query = self.build_query(filters=segment_filters)
-            queryset = self._do_search(query)
-            if queryset is None:
-                continue
-
-            # Cluster is a collection of more than N docs.
-            if queryset["hits"]["total"] < settings.HOTSPOT_MIN_ENTRIES:
-                continue
-
-            docs = []
-            for doc in queryset["hits"]["hits"]:
-                # Retain only fields necessary for text analysis.
-                doc = RecordDict(
-                    _id=doc["_id"],
-                    text=doc["_source"]["text"],
-                    tokens=doc["_source"]["tokens"]
-                    )
-                if normalize_text:
-                    doc.update(_normalized_text=normalize_aggressive(doc.text))
-                docs.append(doc)
-            segment.update({"docs": docs})
-            clusters.append(segment)
-
-        return clusters
-
     def _buckets_to_segments(self, buckets):
         """
         Converts an ES buckets format to plain list of geo-cells.
@@ -856,6 +1059,65 @@ class GeoClusterBuilder(ClusterBuilder):
 
         return segments
 
+    def build_cell_query(self, geohash, precision):
+        """
+        Query for sub-cells of a geohash cell.
+        """
+        filters = self.raw_filters.copy()
+        cell = geohash_bounds(geohash)
+        if build_filters_geo(filters):
+            # Intersection with the bounding box from filters.
+            cell["top_left_lat"] = min(cell["top_left_lat"], float(filters["top_left_lat"]))
+            cell["top_left_lon"] = max(cell["top_left_lon"], float(filters["top_left_lon"]))
+            cell["bottom_right_lat"] = max(cell["bottom_right_lat"], float(filters["bottom_right_lat"]))
+            cell["bottom_right_lon"] = min(cell["bottom_right_lon"], float(filters["bottom_right_lon"]))
+        filters.update(cell)
+        query = self.build_query(filters=self._get_filters(**filters), size=0)
+        query.update(self.build_aggregation(precision))
+        return query
+
+    def iter_segments(self, query):
+        """
+        In adaptive mode cells are split level by level (sub-cells of
+        all cells of a level are requested with multi-search), until
+        they have at most settings.GEO_CLUSTER_MAX_SIZE docs or reach
+        settings.GEO_CLUSTER_MAX_PRECISION.
+        """
+        if not self.adaptive:
+            yield self.get_segments(self.define_aggregations(query))
+            return
+
+        queryset = self._do_search(self.define_aggregations(query))
+        if queryset is None:
+            return
+
+        buckets = queryset["aggregations"][self.segments_fieldname]["buckets"]
+        precision = self.precision
+        while buckets:
+            split, keep = [], []
+            for bucket in buckets:
+                if (precision < settings.GEO_CLUSTER_MAX_PRECISION) \
+                   and (bucket["doc_count"] > settings.GEO_CLUSTER_MAX_SIZE):
+                    split.append(bucket)
+                else:
+                    keep.append(bucket)
+
+            segments = self._buckets_to_segments(keep)
+            if segments:
+                yield segments
+
+            precision += 1
+            queries = [self.build_cell_query(x["key"], precision) for x in split]
+            buckets = []
+            for parent, queryset in zip(split, self._do_msearch(queries)):
+                if queryset is None:
+                    continue
+                # Points on the edges of a cell get to neighbouring cells, too.
+                buckets.extend(
+                    x for x in queryset["aggregations"][self.segments_fieldname]["buckets"]
+                    if x["key"].startswith(parent["key"])
+                    )
+
     def get_segments(self, query):
         queryset = self._do_search(query)
         if queryset is None:
@@ -0,0 +1,157 @@
+"""
+Incremental maintenance of representative tweets.
+
+Instead of re-categorizing the whole window every run, every segment
+keeps its current representatives (normalized text and LSH fingerprint)
+in `SegmentState`. New tweets are compared only against those
+representatives and against each other, which costs
+O(new * representatives) instead of O(window^2).
+"""
+import json
+import time
+import hashlib
+from collections import defaultdict
+
+from django.conf import settings
+
+from dataman.models import SegmentState
+from dataman.processors import ClusterBuilder
+from dataman.similarity import MINHASHER, LSH_MIN_DOCS, is_similar
+
+
+def segment_key(segment):
+    """
+    Canonical key of a segment (cluster without docs).
+    """
+    key = json.dumps(
+        dict((k, v) for k, v in segment.items() if k != "docs"),
+        sort_keys=True
+        )
+    if len(key) > 255:
+        key = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    return key
+
+
+class UncategorizedClusterBuilder(ClusterBuilder):
+    """
+    Clusters only docs that have not been flagged as representative or
+    non-representative yet.
+    """
+    def _get_filters(self, **filters):
+        es_filters = super()._get_filters(**filters) or []
+        es_filters.append({
+            "bool": {
+                "must_not": {
+                    "exists": {
+                        "field": "representative"
+                        }
+                    }
+                }
+            })
+        return es_filters
+
+
+class SegmentRepresentatives(object):
+    """
+    Representatives of one segment.
+    """
+    def __init__(self, key, representatives=None):
+        self.key = key
+        self.representatives = representatives or []
+        self.index = defaultdict(set)
+        for idx, rep in enumerate(self.representatives):
+            self._index(idx, rep["fingerprint"])
+
+    @classmethod
+    def load(cls, key):
+        try:
+            obj = SegmentState.objects.get(key=key)
+        except SegmentState.DoesNotExist:
+            return cls(key)
+
+        # Forget representatives that haven't been seen for a long time.
+        expire = time.time() - settings.REPR_STATE_TTL * 60
+        return cls(key, [rep for rep in obj.representatives if rep["seen"] >= expire])
+
+    def save(self):
+        # Keep the most recently seen representatives only.
+        representatives = sorted(
+            self.representatives, key=lambda x: x["seen"], reverse=True
+            )[:settings.REPR_STATE_MAX_SIZE]
+        obj, _ = SegmentState.objects.get_or_create(key=self.key)
+        obj.representatives = representatives
+        obj.save()
+
+    def _index(self, idx, fingerprint):
+        for band, key in enumerate(fingerprint):
+            self.index[(band, key)].add(idx)
+
+    def _candidates(self, fingerprint):
+        if len(self.representatives) < LSH_MIN_DOCS:
+            return range(len(self.representatives))
+
+        candidates = set()
+        for band, key in enumerate(fingerprint):
+            candidates.update(self.index.get((band, key), ()))
+        return sorted(candidates)
+
+    def find(self, text, fingerprint):
+        """
+        :return: index of the representative similar to text, or None.
+        """
+        for idx in self._candidates(fingerprint):
+            if is_similar(text, self.representatives[idx]["text"]):
+                return idx
+        return None
+
+    def update(self, docs):
+        """
+        Categorizes new docs against representatives (and each other).
+        A doc that is similar to a representative is its duplicate,
+        otherwise the doc becomes a representative itself. As in
+        `categorize_repr_docs`, the older doc (smaller id) wins.
+
+        :param docs: list of dicts with keys "_id", "_normalized_text"
+            and optionally "_fingerprint".
+        :return: dict {
+            "representative_docs": [<doc>, ...],
+            "non_representative_docs": [<doc>, ...],
+            "demoted": [<_id of former representatives>, ...]
+            }
+        """
+        now = time.time()
+        repr_docs, non_repr_docs, demoted = [], [], []
+        for doc in sorted(docs, key=lambda x: int(x["_id"])):
+            text = doc["_normalized_text"]
+            fingerprint = doc.get("_fingerprint", None) or MINHASHER.fingerprint(text)
+            idx = self.find(text, fingerprint)
+            if idx is None:
+                self.representatives.append({
+                    "_id": doc["_id"],
+                    "text": text,
+                    "fingerprint": fingerprint,
+                    "multiplicity": 1,
+                    "seen": now
+                    })
+                self._index(len(self.representatives) - 1, fingerprint)
+                repr_docs.append(doc)
+                continue
+
+            rep = self.representatives[idx]
+            rep["multiplicity"] += 1
+            rep["seen"] = now
+            if int(rep["_id"]) <= int(doc["_id"]):
+                non_repr_docs.append(doc)
+                continue
+
+            # The new doc is older than the representative: swap them.
+            demoted.append(rep["_id"])
+            rep.update(_id=doc["_id"], text=text, fingerprint=fingerprint)
+            self._index(idx, fingerprint)
+            repr_docs.append(doc)
+
+        return {
+            "representative_docs": repr_docs,
+            "non_representative_docs": non_repr_docs,
+            "demoted": demoted
+            }
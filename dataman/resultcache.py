@@ -0,0 +1,221 @@
+"""
+Cache of cluster and categorization results.
+
+Identical requests (dashboards polling the same filters) shouldn't
+rebuild the same clusters. Results are kept in CLUSTER_CACHE under a key
+made of the kind of the result, terms and canonical filters:
+    - params that aren't filters (credentials, format) are dropped, so
+      that all users of a view share the result;
+    - values of filters are strings, keys are sorted;
+    - time filters of any form are resolved into an absolute range.
+      The range isn't rounded: results are queried with canonical
+      filters and hold exactly the docs of the requested range.
+
+Invalidation is done by versions rather than by deleting keys (keys of
+all cached results are unknown): the key of a result includes versions
+of the time buckets of its range, and indexing a doc changes the version
+of its bucket. Results of ranges that are open or longer than
+CLUSTER_CACHE_MAX_BUCKETS depend on a single "indexed" version, changed
+by any doc. Deletions and updates of docs without timestamps change the
+"all" version, which every key includes.
+
+New docs are searchable only after ES_REFRESH_INTERVAL, so results
+computed earlier than that after a change of their versions are not
+cached (they may lack the new docs).
+"""
+import json
+import math
+import time
+import uuid
+import hashlib
+import logging
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.core.cache import caches
+
+from core.utils import build_filters_time, localize_timestamp, TS_GTE, TS_LTE
+
+
+LOG = logging.getLogger("default")
+
+VERSION_ALL = "all"
+VERSION_INDEXED = "indexed"
+
+# Request params that don't change results.
+NON_FILTER_PARAMS = frozenset(["username", "api_key", "format", "callback"])
+
+
+def get_cache():
+    return caches[settings.CLUSTER_CACHE]
+
+
+def bucket_size():
+    """
+    :return: int - size of time buckets in seconds.
+    """
+    return settings.CLUSTER_CACHE_BUCKET * 60
+
+
+def canonical_filters(filters):
+    """
+    :param filters: dict - raw filters (e.g. GET params).
+    :return: dict - filters (without NON_FILTER_PARAMS) with str values
+        and the time range (if any) resolved into ISO timestamps (e.g.
+        TS_GTE and TS_LTE).
+    """
+    result = dict(
+        (key, str(val)) for key, val in filters.items()
+        if (settings.ES_TIMESTAMP_FIELD not in key) and (key not in NON_FILTER_PARAMS)
+        )
+    time_range = build_filters_time(filters)
+    if time_range:
+        for op, val in time_range["range"][settings.ES_TIMESTAMP_FIELD].items():
+            result["{}__{}".format(settings.ES_TIMESTAMP_FIELD, op)] = val
+    return result
+
+
+def get_buckets(filters):
+    """
+    :param filters: dict - canonical filters.
+    :return: list of int - time buckets overlapping the range of filters,
+        None if the range is open or too long.
+    """
+    prefix = settings.ES_TIMESTAMP_FIELD + "__"
+    start = filters.get(TS_GTE, filters.get(prefix + "gt"))
+    end = filters.get(TS_LTE, filters.get(prefix + "lt"))
+    if (start is None) or (end is None):
+        return None
+    size = bucket_size()
+    start, _ = localize_timestamp(start)
+    end, _ = localize_timestamp(end)
+    start = int(start.timestamp() // size)
+    end = int(math.ceil(end.timestamp() / size))
+    if end - start > settings.CLUSTER_CACHE_MAX_BUCKETS:
+        return None
+    return list(range(start, max(end, start + 1)))
+
+
+def version_key(name):
+    return "clusters:version:{}".format(name)
+
+
+def get_versions(filters):
+    """
+    :param filters: dict - canonical filters.
+    :return: list - versions the result of filters depends on (None for
+        versions that haven't been changed recently).
+    """
+    buckets = get_buckets(filters)
+    names = [VERSION_ALL]
+    if buckets is None:
+        names.append(VERSION_INDEXED)
+    else:
+        names.extend(buckets)
+    keys = [version_key(x) for x in names]
+    versions = get_cache().get_many(keys)
+    return [versions.get(x) for x in keys]
+
+
+def is_settled(versions, started):
+    """
+    :param versions: list - see `get_versions`.
+    :param started: float - time the result was started being computed.
+    :return: bool - True if all docs of the versions were searchable.
+    """
+    changed = [float(x.split(":")[0]) for x in versions if x is not None]
+    return all(x + settings.ES_REFRESH_INTERVAL <= started for x in changed)
+
+
+def result_key(kind, terms, filters, versions):
+    """
+    :param kind: str - kind of the result (e.g. "categorized").
+    :param terms: iterable of str.
+    :param filters: dict - canonical filters.
+    :param versions: list - see `get_versions`.
+    :return: str.
+    """
+    key = json.dumps([kind, list(terms), sorted(filters.items()), versions])
+    return "clusters:result:" + hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def cached(kind, terms, filters, compute):
+    """
+    Returns cached result, or computes and caches it.
+
+    :param kind: str - kind of the result (e.g. "categorized").
+    :param terms: iterable of str.
+    :param filters: dict - canonical filters (see `canonical_filters`).
+    :param compute: callable without arguments, returns the result.
+    :return: the result.
+    """
+    if not settings.CLUSTER_CACHE_TTL:
+        return compute()
+
+    started = time.time()
+    try:
+        versions = get_versions(filters)
+        key = result_key(kind, terms, filters, versions)
+        result = get_cache().get(key)
+    except DatabaseError as exc:
+        LOG.warning("Cluster cache is not available: {}".format(exc))
+        return compute()
+    if result is not None:
+        return result
+
+    result = compute()
+    if not is_settled(versions, started):
+        return result
+    try:
+        get_cache().set(key, result, settings.CLUSTER_CACHE_TTL)
+    except DatabaseError as exc:
+        LOG.warning("Cluster cache is not available: {}".format(exc))
+    return result
+
+
+def set_versions(names):
+    """
+    Changes versions, so that keys of results depending on them change.
+    Versions outlive results, otherwise an expired version could be
+    re-created with the value of a cached result.
+    """
+    if not settings.CLUSTER_CACHE_TTL:
+        return
+    # Time of the change, then unique part.
+    version = "{:.3f}:{}".format(time.time(), uuid.uuid4().hex)
+    try:
+        get_cache().set_many(
+            dict((version_key(x), version) for x in names),
+            2 * settings.CLUSTER_CACHE_TTL
+            )
+    except DatabaseError as exc:
+        LOG.warning("Cluster cache is not available: {}".format(exc))
+
+
+def invalidate(docs):
+    """
+    Invalidates results of time ranges including docs (to call after
+    indexing them).
+
+    :param docs: iterable of dicts.
+    """
+    size = bucket_size()
+    names = set()
+    for doc in docs:
+        try:
+            timestamp, _ = localize_timestamp(doc[settings.ES_TIMESTAMP_FIELD])
+        except (KeyError, TypeError, ValueError, AssertionError):
+            # Time of the doc is unknown.
+            names.add(VERSION_ALL)
+        else:
+            names.add(int(timestamp.timestamp() // size))
+    if names:
+        names.add(VERSION_INDEXED)
+        set_versions(names)
+
+
+def invalidate_all():
+    """
+    Invalidates all results (e.g. after deleting docs).
+    """
+    set_versions([VERSION_ALL])
@@ -0,0 +1,292 @@
+"""
+Near-duplicate detection for short texts (tweets).
+
+Comparing every text against every other one with `Levenshtein.ratio`
+is quadratic, which is prohibitive for clusters of several thousands
+documents. Candidate pairs are generated with MinHash signatures over
+character shingles and Locality Sensitive Hashing (banding), and only
+candidates are checked with the exact `ratio`.
+"""
+import zlib
+from itertools import combinations
+from collections import defaultdict
+
+import numpy
+from scipy import sparse
+from Levenshtein import ratio
+
+
+SIMILAR_PREDICTION_EDIT_DISTANCE_MAX = 0.8
+
+# Character shingles of this size are used for MinHash signatures.
+SHINGLE_SIZE = 4
+# Signature length is LSH_BANDS * LSH_ROWS. With 32 bands of 2 rows
+# pairs with Jaccard similarity of shingles >= 0.5 become candidates
+# with probability > 0.9999, >= 0.3 - with probability ~0.95.
+LSH_BANDS = 32
+LSH_ROWS = 2
+# Below this number of texts all pairs are compared directly
+# (exact result, signatures do not pay off).
+LSH_MIN_DOCS = 100
+
+# Centrality modes: sum of edit-distance ratios, or cosine similarity
+# of TF-IDF vectors of tokens.
+CENTRALITY_EDIT = "edit"
+CENTRALITY_TFIDF = "tfidf"
+CENTRALITY_MODES = (CENTRALITY_EDIT, CENTRALITY_TFIDF)
+
+MERSENNE_PRIME = (1 << 31) - 1
+MAX_HASH = (1 << 32) - 1
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    """
+    Splits text into a set of overlapping character n-grams.
+
+    :param text: str
+    :param size: int - shingle length.
+    :return: set of str
+    """
+    if len(text) <= size:
+        return {text}
+    return set(text[i:i+size] for i in range(len(text) - size + 1))
+
+
+class MinHasher(object):
+    """
+    Computes MinHash signatures of texts and splits them into LSH bands.
+
+    Hash functions are seeded deterministically, so that signatures
+    are comparable between processes (and can be stored).
+    """
+    def __init__(self, bands=LSH_BANDS, rows=LSH_ROWS,
+                 shingle_size=SHINGLE_SIZE, seed=1):
+        self.bands = bands
+        self.rows = rows
+        self.shingle_size = shingle_size
+        num_perm = bands * rows
+        rnd = numpy.random.RandomState(seed)
+        self.a = rnd.randint(1, MERSENNE_PRIME, size=num_perm).astype(numpy.uint64)
+        self.b = rnd.randint(0, MERSENNE_PRIME, size=num_perm).astype(numpy.uint64)
+
+    def signature(self, text):
+        """
+        :param text: str
+        :return: numpy.array of uint64, length bands*rows.
+        """
+        hashes = numpy.fromiter(
+            (zlib.crc32(x.encode("utf-8")) & MAX_HASH
+             for x in shingles(text, self.shingle_size)),
+            dtype=numpy.uint64
+            )
+        perm = (self.a[:, None] * hashes[None, :] + self.b[:, None]) % MERSENNE_PRIME
+        return perm.min(axis=1)
+
+    def band_keys(self, signature):
+        """
+        Hashes every band of a signature.
+
+        :param signature: numpy.array (see `signature`).
+        :return: list of int - one key per band.
+        """
+        return [
+            zlib.crc32(signature[i*self.rows:(i+1)*self.rows].tobytes()) & MAX_HASH
+            for i in range(self.bands)
+            ]
+
+    def fingerprint(self, text):
+        return self.band_keys(self.signature(text))
+
+
+MINHASHER = MinHasher()
+
+
+def candidate_pairs(texts, hasher=None, fingerprints=None):
+    """
+    Generates pairs of texts that are likely to be similar: those
+    sharing at least one LSH band.
+
+    :param texts: list of str
+    :param hasher: MinHasher instance (default one if not given).
+    :param fingerprints: list of precomputed fingerprints of texts
+        (see `MinHasher.fingerprint`), computed if not given.
+    :return: set of tuples (i, j), i < j - indexes in `texts`.
+    """
+    if fingerprints is None:
+        hasher = hasher or MINHASHER
+        fingerprints = [hasher.fingerprint(text) for text in texts]
+
+    buckets = defaultdict(list)
+    for idx, fingerprint in enumerate(fingerprints):
+        for band, key in enumerate(fingerprint):
+            buckets[(band, key)].append(idx)
+
+    pairs = set()
+    for bucket in buckets.values():
+        if len(bucket) > 1:
+            pairs.update(combinations(bucket, 2))
+    return pairs
+
+
+def is_similar(text_a, text_b, threshold=SIMILAR_PREDICTION_EDIT_DISTANCE_MAX):
+    """
+    Checks if ratio(text_a, text_b) is above threshold, skipping the
+    exact computation when lengths alone rule it out.
+    """
+    total = len(text_a) + len(text_b)
+    if total and (2. * min(len(text_a), len(text_b)) / total <= threshold):
+        return False
+    return ratio(text_a, text_b) > threshold
+
+
+class SimilarityKernel(object):
+    """
+    Pairwise `Levenshtein.ratio` of a collection of texts. The ratio is
+    symmetric, so every unordered pair is computed at most once.
+    """
+    def __init__(self, texts, threshold=SIMILAR_PREDICTION_EDIT_DISTANCE_MAX):
+        """
+        :param texts: list of str
+        :param threshold: float - pairs with ratio above it are duplicates.
+        """
+        self.texts = texts
+        self.lengths = [len(text) for text in texts]
+        self.threshold = threshold
+
+    def real_quick_ratio(self, i, j):
+        """
+        Upper bound of ratio(texts[i], texts[j]), based on lengths only
+        (at least the difference in lengths has to be inserted or deleted).
+        """
+        total = self.lengths[i] + self.lengths[j]
+        if total == 0:
+            return 1.
+        return 2. * min(self.lengths[i], self.lengths[j]) / total
+
+    def scan(self):
+        """
+        Single symmetric pass over all pairs.
+
+        :return: tuple (similarities, duplicates):
+            similarities - list of float, sum of ratios of every text
+                to all texts (itself included);
+            duplicates - list of tuples (i, j), i < j, with ratio
+                above threshold.
+        """
+        texts = self.texts
+        size = len(texts)
+        similarities = [ratio(text, text) for text in texts]
+        duplicates = []
+        for i in range(size):
+            text = texts[i]
+            for j in range(i + 1, size):
+                similarity = ratio(text, texts[j])
+                similarities[i] += similarity
+                similarities[j] += similarity
+                if similarity > self.threshold:
+                    duplicates.append((i, j))
+        return similarities, duplicates
+
+    def duplicates(self, pairs=None):
+        """
+        Finds pairs with ratio above threshold. Exact ratio is not needed
+        here, so pairs ruled out by `real_quick_ratio` are skipped.
+
+        :param pairs: iterable of tuples (i, j) to check. If None, all
+            pairs are checked: texts are sorted by length, and comparing
+            a text stops as soon as longer texts cannot be similar.
+        :return: list of tuples (i, j), i < j.
+        """
+        texts = self.texts
+        duplicates = []
+        if pairs is not None:
+            for i, j in pairs:
+                if self.real_quick_ratio(i, j) <= self.threshold:
+                    continue
+                if ratio(texts[i], texts[j]) > self.threshold:
+                    duplicates.append((min(i, j), max(i, j)))
+            return duplicates
+
+        order = sorted(range(len(texts)), key=lambda x: self.lengths[x])
+        for pos, i in enumerate(order):
+            for j in order[pos+1:]:
+                if self.real_quick_ratio(i, j) <= self.threshold:
+                    break
+                if ratio(texts[i], texts[j]) > self.threshold:
+                    duplicates.append((min(i, j), max(i, j)))
+        return duplicates
+
+
+def near_duplicate_pairs(texts, threshold=SIMILAR_PREDICTION_EDIT_DISTANCE_MAX,
+                         fingerprints=None):
+    """
+    Finds pairs of texts with `Levenshtein.ratio` above threshold.
+
+    For small collections all pairs are compared, otherwise only LSH
+    candidates (see `candidate_pairs`).
+
+    :param texts: list of str
+    :param fingerprints: list of precomputed fingerprints of texts (optional).
+    :return: list of tuples (i, j), i < j - indexes in `texts`.
+    """
+    kernel = SimilarityKernel(texts, threshold)
+    if len(texts) < LSH_MIN_DOCS:
+        return sorted(kernel.duplicates())
+    return kernel.duplicates(sorted(candidate_pairs(texts, fingerprints=fingerprints)))
+
+
+def tfidf_matrix(token_lists):
+    """
+    Builds sparse L2-normalized TF-IDF matrix (smoothed idf).
+
+    :param token_lists: list of lists of str.
+    :return: scipy.sparse.csr_matrix, shape (len(token_lists), vocabulary size).
+    """
+    vocabulary = {}
+    indices, data, indptr = [], [], [0]
+    for tokens in token_lists:
+        counts = {}
+        for token in tokens:
+            col = vocabulary.setdefault(token, len(vocabulary))
+            counts[col] = counts.get(col, 0) + 1
+        indices.extend(counts.keys())
+        data.extend(counts.values())
+        indptr.append(len(indices))
+
+    matrix = sparse.csr_matrix(
+        (numpy.array(data, dtype=numpy.float64), indices, indptr),
+        shape=(len(token_lists), len(vocabulary))
+        )
+    doc_freq = numpy.bincount(matrix.indices, minlength=len(vocabulary))
+    idf = numpy.log((1. + len(token_lists)) / (1. + doc_freq)) + 1.
+    matrix.data *= idf[matrix.indices]
+
+    norms = numpy.sqrt(numpy.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.
+    matrix.data /= numpy.repeat(norms, numpy.diff(matrix.indptr))
+    return matrix
+
+
+def tfidf_centrality(token_lists):
+    """
+    Scores docs by cosine similarity of their TF-IDF vectors to the
+    centroid of the collection, in O(n*k) (k - tokens per doc).
+
+    The score is scaled to the sum of cosine similarities of a doc to
+    all docs (itself included), which makes it comparable to the sums
+    of edit-distance ratios in `SimilarityKernel.scan`. A doc without
+    tokens is only similar to itself.
+
+    :param token_lists: list of lists of str.
+    :return: numpy.array of float.
+    """
+    if not token_lists:
+        return numpy.zeros(0)
+
+    matrix = tfidf_matrix(token_lists)
+    centroid = numpy.asarray(matrix.sum(axis=0)).ravel()
+    centrality = matrix.dot(centroid)
+    # Empty docs have zero vectors, but are still similar to themselves.
+    empty = numpy.diff(matrix.indptr) == 0
+    centrality[empty] = 1.
+    return centrality
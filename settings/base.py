@@ -79,6 +79,25 @@ DATABASES = {
 }
 
 
+# Cache
+# SHARED_CACHE coordinates processes (e.g. geocoding in-flight requests
+# and rate limit). Create its table with `python manage.py createcachetable`.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'cache_shared',
+        'OPTIONS': {
+            # Versions of cluster cache buckets must not be culled early.
+            'MAX_ENTRIES': 100000,
+        },
+    },
+}
+SHARED_CACHE = 'shared'
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
 AUTH_PASSWORD_VALIDATORS = [
@@ -245,6 +264,12 @@ ES_INDEX = 'anywhere_v1'
 ES_DOC_TYPE = 'tweet'
 ES_SCROLL_BATCHSIZE = 5000
 ES_MAX_RESULTS = 5000
+# Seconds until indexed docs are searchable (refresh_interval of the index).
+ES_REFRESH_INTERVAL = 1
+# Max number of searches in one multi-search request.
+ES_MSEARCH_BATCHSIZE = 20
+# Number of segments (clusters) per page of composite aggregation.
+ES_COMPOSITE_SIZE = 500
 ES_TIMESTAMP_FIELD = 'created_at'
 ES_GEO_FIELD = 'location'
 ES_BOUNDING_BOX_FIELDS = [
@@ -258,6 +283,20 @@ HOTSPOTS_MAX_NUMBER = 1000
 # Available precision indexes:
 # https://www.elastic.co/guide/en/elasticsearch/reference/6.2//search-aggregations-bucket-geohashgrid-aggregation.html
 HOTSPOTS_PRECISION = 4
+# Engine of hotspots (agg_hotspot__engine): "es" - geohash_grid cells with
+# at least HOTSPOT_MIN_ENTRIES docs, "dbscan" - density-based clusters of
+# docs within HOTSPOTS_EPS meters of each other (see dataman/hotspots.py).
+HOTSPOTS_ENGINE = "es"
+HOTSPOTS_EPS = 5000
+# Max number of geotagged docs in the window for "dbscan" engine ("es" is
+# used for bigger windows).
+HOTSPOTS_MAX_DOCS = 100000
+# Adaptive geo clustering (GeoClusterBuilder with `adaptive`): geohash cells
+# are split until they have at most GEO_CLUSTER_MAX_SIZE docs, starting from
+# GEO_CLUSTER_MIN_PRECISION up to GEO_CLUSTER_MAX_PRECISION.
+GEO_CLUSTER_MAX_SIZE = 1000
+GEO_CLUSTER_MIN_PRECISION = 3
+GEO_CLUSTER_MAX_PRECISION = 7
 
 
 # Geo settings:
@@ -265,6 +304,9 @@ HOTSPOTS_PRECISION = 4
 GEO_CRS = "EPSG:4326"
 # Interval to check non-geotagged documents, in minutes.
 GEO_TAG_INTERVAL = 5
+# Max number of docs without location and without the "geo_pending" mark
+# (e.g. indexed before it) checked per run, the oldest first.
+GEO_TAG_UNMARKED_BATCH = 1000
 
 
 # Timestamp interval
@@ -273,6 +315,43 @@ TIMESTAMP_INTERVAL = "10m"
 
 # World borders reference file
 WORLD_BORDERS = rel('countries', 'TM_WORLD_BORDERS-0.3.dbf')
+# Precomputed grid of countries by geohash cells, built from WORLD_BORDERS
+# with `python -m countries.grid` (see countries/grid.py). Countries are
+# looked up in polygons only near borders. Ignored if the file doesn't exist.
+COUNTRY_GRID_FILE = rel('countries', 'TM_WORLD_BORDERS-0.3.grid.npy')
+# World borders simplified with `copyshapes.simplify_file`: points are checked
+# against full-resolution borders only within the simplification tolerance.
+# Ignored if the file doesn't exist.
+WORLD_BORDERS_SIMPLIFIED = rel('countries', 'TM_WORLD_BORDERS-0.3.simplified.shp')
+# Administrative regions (e.g. NUTS from
+# https://ec.europa.eu/eurostat/web/gisco/geodata/reference-data/administrative-units-statistical-units/nuts,
+# in EPSG:4326) and the shape field stored as "region" of geotagged docs.
+# Ignored if the file doesn't exist.
+REGIONS_FILE = rel('countries', 'NUTS_RG_01M_2016_4326_LEVL_2.shp')
+REGIONS_FIELD = 'NUTS_ID'
+
+
+# Geocoding cache: max number of places cached per process, time to keep
+# places with coordinates and unresolvable places (minutes).
+GEOCODE_CACHE_SIZE = 10000
+GEOCODE_CACHE_TTL = 30*24*60
+GEOCODE_NEGATIVE_TTL = 24*60
+# Offline gazetteer: GeoNames dump (txt or zip, e.g. cities15000.zip from
+# http://download.geonames.org/export/dump/), consulted before Nominatim.
+# Disabled if the file doesn't exist.
+GEONAMES_FILE = rel('countries', 'cities15000.zip')
+GEONAMES_MIN_POPULATION = 0
+GEONAMES_ALTERNATE_NAMES = True
+# Asynchronous geocoding: if GEOCODE_ASYNC, ingest doesn't wait for
+# Nominatim. Unknown places are geocoded by celery tasks in
+# GEOCODE_QUEUE (run a worker with `-Q geocoding`), docs get
+# "geo_pending" and are completed by `fill_geotags`.
+GEOCODE_ASYNC = True
+GEOCODE_QUEUE = "geocoding"
+# Min delay between requests to Nominatim from all processes (seconds),
+# max time to wait for a place in the queue (seconds).
+GEOCODE_MIN_DELAY = 1
+GEOCODE_INFLIGHT_TIMEOUT = 10*60
 
 
 # Celery
@@ -281,6 +360,8 @@ CELERY_ACCEPT_CONTENT = ['application/json', 'pickle']
 
 # Available languages
 LANGS = ["en", "fr", "es", "de"]
+# Max number of texts with language and location entities cached per process.
+NLP_CACHE_SIZE = 100000
 
 
 # API settings
@@ -292,6 +373,39 @@ API_OBJECTS_KEY = "features"
 #
 # Collect and segment incoming tweets every N minutes.
 STREAM_TIMEFRAME = 15
+# Centrality of tweets in a cluster: "edit" (sum of edit-distance
+# ratios, quadratic) or "tfidf" (cosine similarity of tokens to the
+# cluster centroid, linear).
+REPR_CENTRALITY = "edit"
+# Max number of normalized texts cached per process.
+NORMALIZE_CACHE_SIZE = 100000
+# Number of processes for categorizing clusters in parallel (0 - serial),
+# and minimal number of docs in all clusters to go parallel. Every process
+# that categorizes (e.g. each web worker) has its own pool: N workers fork
+# up to N * CATEGORIZE_PROCESSES processes.
+CATEGORIZE_PROCESSES = 2
+CATEGORIZE_PARALLEL_MIN_DOCS = 2000
+# Incremental categorization: terms to segment incoming tweets by,
+# time to keep representatives of a segment (minutes) and max number
+# of representatives per segment.
+REPR_SEGMENT_TERMS = ["country"]
+REPR_STATE_TTL = 6*60
+REPR_STATE_MAX_SIZE = 1000
+# Cache of cluster and categorization results (see dataman/resultcache.py):
+# cache alias, time to keep results (seconds, 0 - no caching) and size of
+# time buckets that new docs invalidate results of (minutes). Results of
+# ranges longer than CLUSTER_CACHE_MAX_BUCKETS are invalidated by any new doc.
+CLUSTER_CACHE = SHARED_CACHE
+CLUSTER_CACHE_TTL = 60
+CLUSTER_CACHE_BUCKET = 5
+CLUSTER_CACHE_MAX_BUCKETS = 288
+# Engine of cluster builders (see dataman/clustering.py): "es" aggregates
+# segments in Elasticsearch and fetches docs with a search per segment,
+# "scan" fetches the window with a single scroll and groups it in-process.
+CLUSTER_ENGINE = "es"
+# Max number of docs in the window for "scan" engine ("es" is used for
+# bigger windows).
+CLUSTER_SCAN_MAX_DOCS = 100000
 
 
 # Load local settings
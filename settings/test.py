@@ -19,6 +19,14 @@ ES_CLIENT = Elasticsearch(
     retry_on_timeout=True
     )
 
+# No cache table in the test database.
+CACHES[SHARED_CACHE] = {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'shared',
+}
+# Results of the same filters must reflect docs changed between requests.
+CLUSTER_CACHE_TTL = 0
+
 # Print emails to the console.
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
@@ -2,6 +2,9 @@
 import time
 import json
 import pytest
+from mock import patch
+
+from django.core.cache import caches
 
 from fixtures import *
 
@@ -170,6 +173,43 @@ def test_tweets__agg_hotspot(tweets, test_user, client):
     assert len(content["aggregations"]["agg_hotspot"]) == 1
 
 
+def test_tweets__agg_hotspot_dbscan(tweets, test_user, staff_user, client, settings):
+    # Results are cached.
+    settings.CLUSTER_CACHE_TTL = 60
+    settings.CLUSTER_CACHE_BUCKET = 5
+    settings.ES_REFRESH_INTERVAL = 0
+    caches[settings.CLUSTER_CACHE].clear()
+    params = get_params(test_user)
+    params.update({
+        "created_at__gte": "2018-06-23T18:30:00",
+        "created_at__lte": "2018-06-23T19:20:00",
+        "agg_hotspot": 1,
+        "agg_hotspot__engine": "dbscan",
+        "agg_hotspot__eps": 10000,
+        "agg_hotspot__min_entries": 2,
+        "size": 0
+        })
+    resp = client.get(API_TWEETS, params)
+    content = json.loads(resp.content.decode('utf-8'))
+    assert len(content["aggregations"]["agg_hotspot"]) == 1
+    assert content["aggregations"]["agg_hotspot"][0]["doc_count"] == 2
+
+    # The same cache bucket, but the doc of 18:33:05 is out of the range.
+    params.update({"created_at__gte": "2018-06-23T18:34:00"})
+    resp = client.get(API_TWEETS, params)
+    content = json.loads(resp.content.decode('utf-8'))
+    assert content["aggregations"]["agg_hotspot"] == []
+
+    # Other user gets the cached result.
+    params.update(get_credentials(staff_user))
+    params.update({"created_at__gte": "2018-06-23T18:30:00"})
+    with patch("dataman.hotspots.get_hotspots") as get_hotspots_mock:
+        resp = client.get(API_TWEETS, params)
+    content = json.loads(resp.content.decode('utf-8'))
+    assert content["aggregations"]["agg_hotspot"][0]["doc_count"] == 2
+    assert not get_hotspots_mock.called
+
+
 # TODO
 # - /tweet/ PATCH
 # - other endpoints
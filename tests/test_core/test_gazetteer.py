@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import zipfile
+
+from core import gazetteer
+
+
+GEONAMES = [
+    # geonameid, name, asciiname, alternatenames, lat, lon, fclass, fcode,
+    # country, cc2, admin1, admin2, admin3, admin4, population, ...
+    ["2643743", "London", "London", "Londres,Londra,LON", "51.50853", "-0.12574",
+     "P", "PPLC", "GB", "", "ENG", "GLA", "", "", "7556900", "", "25",
+     "Europe/London", "2018-07-29"],
+    ["6058560", "London", "London", "", "42.98339", "-81.23304",
+     "P", "PPL", "CA", "", "08", "", "", "", "346765", "", "252",
+     "America/Toronto", "2016-06-22"],
+    ["4699066", "Houston", "Houston", "Hjuston", "29.76328", "-95.36327",
+     "P", "PPLA2", "US", "", "TX", "201", "", "", "2296224", "", "15",
+     "America/Chicago", "2017-03-09"],
+    ["5128581", "New York City", "New York City", "New York,NYC", "40.71427", "-74.00597",
+     "P", "PPL", "US", "", "NY", "", "", "", "8175133", "", "10",
+     "America/New_York", "2017-03-09"],
+    ["1", "broken line"],
+    ]
+
+
+def write_geonames(path):
+    with open(path, "w", encoding="utf-8") as f:
+        for row in GEONAMES:
+            f.write("\t".join(row) + "\n")
+    return path
+
+
+def test_lookup(tmpdir):
+    gaz = gazetteer.Gazetteer.load(write_geonames(str(tmpdir.join("cities.txt"))))
+    assert len(gaz) == 4
+    london = {"lat": 51.50853, "lon": -0.12574}
+    assert gaz.lookup("London") == london
+    assert gaz.lookup("london, UK") == london
+    assert gaz.lookup("Londres") == london
+    assert gaz.lookup("London, CA") == {"lat": 42.98339, "lon": -81.23304}
+    assert gaz.lookup("London, Ontario") == {}
+    assert gaz.lookup("Houston, TX") == {"lat": 29.76328, "lon": -95.36327}
+    assert gaz.lookup("Houston area") == {"lat": 29.76328, "lon": -95.36327}
+    assert gaz.lookup("Houston metro area") == {"lat": 29.76328, "lon": -95.36327}
+    # Other trailing words make another place.
+    assert gaz.lookup("London Bridge") == {}
+    assert gaz.lookup("Houston County") == {}
+    assert gaz.lookup("New York Mills") == {}
+    assert gaz.lookup("area") == {}
+    assert gaz.lookup("NYC") == {"lat": 40.71427, "lon": -74.00597}
+    assert gaz.lookup("Atlantis") == {}
+    # Too short names are not indexed.
+    assert gaz.candidates("lo") == []
+
+
+def test_load_zip(tmpdir):
+    txt = write_geonames(str(tmpdir.join("cities.txt")))
+    fname = str(tmpdir.join("cities15000.zip"))
+    with zipfile.ZipFile(fname, "w") as archive:
+        archive.write(txt, "cities15000.txt")
+    gaz = gazetteer.Gazetteer.load(fname, min_population=1000000)
+    assert len(gaz) == 3
+    assert gaz.lookup("London, CA") == {}
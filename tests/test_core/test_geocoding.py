@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+import geopy
+import pytest
+from mock import patch
+
+from django.conf import settings
+from django.utils import timezone
+
+from core import geocoding
+from core.models import GeocodeCache
+
+
+pytestmark = pytest.mark.django_db
+
+LONDON = {"lat": 51.5073219, "lon": -0.1276474}
+
+
+@pytest.fixture(autouse=True)
+def clean_cache():
+    geocoding.MEMORY_CACHE.clear()
+    geocoding.STATS.clear()
+    # Don't depend on the local gazetteer.
+    with patch("core.gazetteer.lookup", return_value={}):
+        yield
+    geocoding.MEMORY_CACHE.clear()
+    geocoding.STATS.clear()
+
+
+def test_normalize_place():
+    assert geocoding.normalize_place("  London,\n UK! ") == "london, uk"
+    assert geocoding.normalize_place("#Jakarta") == "jakarta"
+    assert len(geocoding.place_key("x" * 300)) == 40
+
+
+def test_lru_cache():
+    cache = geocoding.LRUCache(2)
+    cache.set("a", 1, 60)
+    cache.set("b", 2, 60)
+    assert cache.get("a") == 1
+    cache.set("c", 3, 60)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    cache.set("d", 4, -1)
+    assert cache.get("d") is None
+
+
+@patch("core.geocoding.geocode_nominatim")
+def test_geocode(nominatim_mock):
+    nominatim_mock.return_value = LONDON
+    assert geocoding.geocode("London") == LONDON
+    assert geocoding.geocode("london ") == LONDON
+    assert nominatim_mock.call_count == 1
+    assert geocoding.get_stats()["memory_hits"] == 1
+
+    # Other processes find it in the persistent cache.
+    geocoding.MEMORY_CACHE.clear()
+    assert geocoding.geocode("LONDON!") == LONDON
+    assert nominatim_mock.call_count == 1
+    assert GeocodeCache.objects.get(key="london").hits == 1
+
+    stats = geocoding.get_stats()
+    assert (stats["memory_hits"], stats["db_hits"], stats["misses"]) == (1, 1, 1)
+
+
+@patch("core.geocoding.geocode_nominatim")
+def test_geocode__negative(nominatim_mock):
+    nominatim_mock.return_value = {}
+    assert geocoding.geocode("my couch") == {}
+    assert geocoding.geocode("My Couch") == {}
+    assert nominatim_mock.call_count == 1
+    assert geocoding.get_stats()["unresolved"] == 2
+    assert geocoding.geocode("   ") == {}
+    assert nominatim_mock.call_count == 1
+
+    # Expired negative entry is geocoded again.
+    geocoding.MEMORY_CACHE.clear()
+    expired = timezone.now() - timezone.timedelta(minutes=settings.GEOCODE_NEGATIVE_TTL + 1)
+    GeocodeCache.objects.filter(key="my couch").update(updated=expired)
+    nominatim_mock.return_value = LONDON
+    assert geocoding.geocode("my couch") == LONDON
+    assert nominatim_mock.call_count == 2
+    assert GeocodeCache.objects.get(key="my couch").location == LONDON
+
+
+@patch("core.geocoding.geocode_nominatim")
+def test_geocode__error(nominatim_mock):
+    # Failures of Nominatim are not taken for unresolvable places.
+    nominatim_mock.side_effect = geopy.exc.GeocoderTimedOut("Timed out")
+    with pytest.raises(geopy.exc.GeopyError):
+        geocoding.geocode("London")
+    assert geocoding.geocode_cached("London") is None
+    assert not GeocodeCache.objects.exists()
+
+    nominatim_mock.side_effect = None
+    nominatim_mock.return_value = LONDON
+    assert geocoding.geocode("London") == LONDON
+
+
+@patch("core.geocoding.geocode_nominatim")
+def test_geocode__gazetteer(nominatim_mock):
+    with patch("core.gazetteer.lookup", return_value=LONDON):
+        assert geocoding.geocode("London") == LONDON
+    assert nominatim_mock.call_count == 0
+    assert not GeocodeCache.objects.filter(key="london").exists()
+    assert geocoding.get_stats()["gazetteer_hits"] == 1
+
+
+@patch("celerytasks.geocode_places")
+def test_enqueue(task_mock):
+    assert geocoding.enqueue(["Jakarta", "jakarta ", "Bandung"]) == ["Bandung", "Jakarta"]
+    task_mock.delay.assert_called_once()
+
+    # Identical requests in flight are coalesced.
+    assert geocoding.enqueue(["JAKARTA", "Bandung"]) == []
+    assert task_mock.delay.call_count == 1
+
+    geocoding.release("Jakarta")
+    assert geocoding.enqueue(["JAKARTA", "Bandung"]) == ["JAKARTA"]
+    geocoding.release("Jakarta")
+    geocoding.release("Bandung")
+
+
+@patch("core.geocoding.geocode_nominatim")
+def test_geocode_cached(nominatim_mock):
+    assert geocoding.geocode_cached("Jakarta") is None
+    nominatim_mock.return_value = {"lat": -6.21462, "lon": 106.84513}
+    geocoding.geocode("Jakarta")
+    assert geocoding.geocode_cached("jakarta") == {"lat": -6.21462, "lon": 106.84513}
+    assert nominatim_mock.call_count == 1
@@ -112,3 +112,68 @@ def test_convert_timestamp_range__exceptions():
     with pytest.raises(utils.MalformedValueError) as excinfo:
         assert utils.convert_time_range('2 hours ago')
         assert str(excinfo.value) == 'Cannot parse datetime range: wrong format!'
+
+
+def test_get_val_by_path():
+    doc = {
+        "place": None,
+        "user": {"id": 1, "location": ""},
+        "coordinates": {"coordinates": [-80.8, 35.2]}
+        }
+    assert utils.get_val_by_path("user/id", **doc) == 1
+    assert utils.get_val_by_path("user/location", "user/id", **doc) == ""
+    assert utils.get_val_by_path("place/name", "user/id", **doc) == 1
+    assert utils.get_val_by_path("coordinates/coordinates/1", **doc) == 35.2
+    assert utils.get_val_by_path("user/name", "coordinates/coordinates/2", **doc) is None
+    assert utils.get_val_by_path("user/i?", **doc) == 1
+
+
+def test_haversine():
+    london = {"lat": 51.5074, "lon": -0.1278}
+    paris = {"lat": 48.8566, "lon": 2.3522}
+    dist = utils.haversine(london["lat"], london["lon"], paris["lat"], paris["lon"])
+    assert abs(dist - utils.meters(london, paris)) < utils.meters(london, paris) * utils.HAVERSINE_ERROR
+
+    dists = utils.haversine([51.5074, 48.8566], [-0.1278, 2.3522], 51.5074, -0.1278)
+    assert dists.shape == (2, )
+    assert dists[0] == 0.
+    assert abs(dists[1] - dist) < 1e-6
+
+
+def test_nearest_location():
+    point = {"lat": 51.5074, "lon": -0.1278}
+    candidates = [
+        {"lat": 40.7128, "lon": -74.0060},
+        {"lat": 51.4545, "lon": -2.5879},
+        {"lat": 48.8566, "lon": 2.3522},
+        ]
+    idx, dist = utils.nearest_location(candidates, point)
+    assert idx == 1
+    assert 170000 < dist < 175000
+
+    idx, dist = utils.nearest_location(candidates, point, refine=True)
+    assert idx == 1
+    assert dist == utils.meters(candidates[1], point)
+
+    assert utils.nearest_location([], point) == (None, None)
+
+
+def test_geohash():
+    assert utils.geohash_encode(57.64911, 10.40744, 11) == "u4pruydqqvj"
+    assert utils.geohash_bounds("u") == {
+        "top_left_lat": 90., "top_left_lon": 0.,
+        "bottom_right_lat": 45., "bottom_right_lon": 45.
+        }
+    center = utils.geohash_decode("u4pruydqqvj")
+    assert abs(center["lat"] - 57.64911) < 1e-5
+    assert abs(center["lon"] - 10.40744) < 1e-5
+    assert utils.geohash_encode(center["lat"], center["lon"], 5) == "u4pru"
+
+
+def test_geohash_encode_many():
+    lats = [57.64911, -90., 90., 0.]
+    lons = [10.40744, -180., 180., 0.]
+    assert list(utils.geohash_encode_many(lats, lons, 7)) == [
+        utils.geohash_encode(lat, lon, 7) for lat, lon in zip(lats, lons)
+        ]
+    assert len(utils.geohash_encode_many([], [], 5)) == 0
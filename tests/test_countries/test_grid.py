@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import numpy
+
+from countries import grid
+from countries.index import PolygonIndex
+
+
+def test_grid_shape():
+    assert grid.grid_shape(1) == (4, 8)
+    assert grid.grid_shape(4) == (1024, 1024)
+    assert grid.grid_precision((4, 8)) == 1
+    assert grid.grid_precision((4096, 8192)) == 5
+
+    # Geohash "u" (precision 1): lat 45..90, lon 0..45.
+    rows, cols = grid.cell_index([50., 90.], [10., 180.], (4, 8))
+    assert rows.tolist() == [3, 3]
+    assert cols.tolist() == [4, 7]
+
+
+def test_build_grid(tmpdir):
+    polygons = [
+        # A country with a lake, and an island of another one in it.
+        (0, [[(-20, -10), (20, -10), (20, 30), (-20, 30)], [(0, 0), (10, 0), (10, 10), (0, 10)]]),
+        (1, [[(3, 3), (7, 3), (7, 7), (3, 7)]]),
+        (1, [[(60.3, 40.1), (80.7, 40.1), (70, 60.9)]]),
+        ]
+    index = PolygonIndex(polygons)
+    data = grid.build_grid(index, 3)
+    assert data.shape == grid.grid_shape(3)
+    assert set(numpy.unique(data)) == {grid.NONE, grid.BORDER, 1, 2}
+
+    fname = str(tmpdir.join("grid.npy"))
+    numpy.save(fname, data)
+    country_grid = grid.CountryGrid.load(fname)
+    assert country_grid.precision == 3
+
+    # Cells that aren't border ones agree with exact lookup.
+    rnd = numpy.random.RandomState(0)
+    lats, lons = rnd.uniform(-30, 70, 10000), rnd.uniform(-40, 100, 10000)
+    values = country_grid.lookup_many(lats, lons)
+    exact = index.query_many(lons, lats) + 1
+    resolved = values != grid.BORDER
+    assert resolved.mean() > 0.5
+    assert (values[resolved] == exact[resolved]).all()
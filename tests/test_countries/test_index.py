@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import numpy
+
+from countries.index import PolygonIndex, ring_contains, ring_distance
+
+
+def square(x, y, size):
+    return [(x, y), (x + size, y), (x + size, y + size), (x, y + size), (x, y)]
+
+
+def test_ring_contains():
+    ring = numpy.array(square(0, 0, 10), dtype=float)
+    xs = numpy.array([5., -1., 5., 11., 0.5])
+    ys = numpy.array([5., 5., 11., 5., 9.5])
+    assert ring_contains(ring, xs, ys).tolist() == [True, False, False, False, True]
+
+
+def test_polygon_index():
+    polygons = [
+        # Square with a hole.
+        (0, [square(0, 0, 10), square(4, 4, 2)]),
+        # Multipolygon: two islands.
+        (1, [square(20, 0, 5)]),
+        (1, [square(30, 30, 5)]),
+        # Inside the hole of the first one.
+        (2, [square(4.5, 4.5, 1)]),
+        ]
+    index = PolygonIndex(polygons, node_size=2)
+    assert len(index) == 4
+    assert index.query(1, 1) == 0
+    assert index.query(4.2, 4.2) is None
+    assert index.query(5, 5) == 2
+    assert index.query(22, 2) == 1
+    assert index.query(32, 32) == 1
+    assert index.query(15, 15) is None
+
+    xs = [1, 4.2, 5, 22, 32, 15]
+    ys = [1, 4.2, 5, 2, 32, 15]
+    assert index.query_many(xs, ys).tolist() == [0, -1, 2, 1, 1, -1]
+    assert index.query_many([], []).tolist() == []
+
+
+def test_polygon_index__grid():
+    # 10x10 grid of unit squares: ref is the number of the cell.
+    polygons = [(y*10 + x, [square(x, y, 1)]) for y in range(10) for x in range(10)]
+    index = PolygonIndex(polygons)
+    rnd = numpy.random.RandomState(0)
+    xs, ys = rnd.uniform(-1, 11, 1000), rnd.uniform(-1, 11, 1000)
+    expected = numpy.where((xs >= 0) & (xs < 10) & (ys >= 0) & (ys < 10),
+                           numpy.floor(ys)*10 + numpy.floor(xs), -1)
+    assert (index.query_many(xs, ys) == expected).all()
+
+
+def test_ring_distance():
+    ring = numpy.array(square(0, 0, 10), dtype=float)
+    xs = numpy.array([5., -3., 5., 13., 13.])
+    ys = numpy.array([5., 5., 9., 5., 14.])
+    assert numpy.allclose(ring_distance(ring, xs, ys), [5., 3., 1., 3., 5.])
+
+
+def test_near_boundary():
+    # Wiggly border and its simplification within 0.5.
+    t = numpy.linspace(0, 10, 200)
+    wiggly = [(x, 0.4*numpy.sin(x*5)) for x in t] + [(10, 10), (0, 10)]
+    full = PolygonIndex([(0, [wiggly])])
+    simplified = PolygonIndex([(0, [square(0, 0, 10)])])
+
+    rnd = numpy.random.RandomState(0)
+    xs, ys = rnd.uniform(-1, 11, 5000), rnd.uniform(-1, 11, 5000)
+    uncertain = simplified.near_boundary(xs, ys, 0.5)
+    assert 0 < uncertain.mean() < 0.5
+    refs = simplified.query_many(xs, ys)
+    refs[uncertain] = full.query_many(xs[uncertain], ys[uncertain])
+    assert (refs == full.query_many(xs, ys)).all()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import pytest
+from osgeo import ogr
+
+from countries.countries import RegionChecker
+
+
+REGIONS = [
+    ("DE1", "POLYGON ((8 47, 10 47, 10 50, 8 50, 8 47))"),
+    # Region with an enclave of another one.
+    ("FR1", "POLYGON ((1 48, 4 48, 4 50, 1 50, 1 48), (2 49, 3 49, 3 49.5, 2 49.5, 2 49))"),
+    ("FR2", "MULTIPOLYGON (((2 49, 3 49, 3 49.5, 2 49.5, 2 49)), ((5 43, 6 43, 6 44, 5 44, 5 43)))"),
+    ]
+
+
+@pytest.fixture
+def region_file(tmpdir):
+    fname = str(tmpdir.join("regions.shp"))
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    data_source = driver.CreateDataSource(fname)
+    layer = data_source.CreateLayer('regions', geom_type=ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn("NUTS_ID", ogr.OFTString))
+    for region, wkt in REGIONS:
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetField("NUTS_ID", region)
+        feature.SetGeometry(ogr.CreateGeometryFromWkt(wkt))
+        layer.CreateFeature(feature)
+    # Closing the data source writes the file.
+    data_source = None
+    return fname
+
+
+def test_region_checker(region_file):
+    checker = RegionChecker(region_file, "NUTS_ID")
+    assert len(checker) == 3
+    assert checker.get_region(48.5, 9.) == "DE1"
+    assert checker.get_region(48.5, 1.5) == "FR1"
+    assert checker.get_region(49.2, 2.5) == "FR2"
+    assert checker.get_region(43.5, 5.5) == "FR2"
+    # Between regions.
+    assert checker.get_region(48.5, 6.) is None
+
+    lats = [48.5, 49.2, 48.5, 0.]
+    lngs = [9., 2.5, 6., 0.]
+    assert checker.get_regions(lats, lngs) == ["DE1", "FR2", None, None]
+    assert checker.get_regions([], []) == []
+
+
+def test_region_checker__no_file(tmpdir):
+    for region_file in (None, str(tmpdir.join("missing.shp"))):
+        checker = RegionChecker(region_file, "NUTS_ID")
+        assert len(checker) == 0
+        assert checker.get_region(48.5, 9.) is None
+        assert checker.get_regions([48.5, 0.], [9., 0.]) == [None, None]
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+from mock import patch
+
+from dataman import clustering, processors
+
+
+def hit(_id, lang, country, lat=0., lon=0., created_at="2018-07-13T10:02:31+00:00"):
+    return {"_id": _id, "_source": {
+        "text": "text {}".format(_id), "tokens": [], "lang": lang,
+        "country": country, "created_at": created_at,
+        "location": {"lat": lat, "lon": lon}
+        }}
+
+
+def scroll_pages(search_mock, scroll_mock, *pages):
+    search_mock.return_value = {"_scroll_id": "1", "hits": {
+        "hits": pages[0], "total": sum(len(x) for x in pages)}}
+    scroll_mock.side_effect = [
+        {"_scroll_id": "1", "hits": {"hits": page}} for page in pages[1:]
+        ] + [{"_scroll_id": "1", "hits": {"hits": []}}]
+
+
+def test_get_cluster_builder(settings):
+    settings.CLUSTER_ENGINE = "es"
+    cb = clustering.get_cluster_builder("lang", "location", engine="scan")
+    assert isinstance(cb, clustering.ScanGeoClusterBuilder)
+    assert cb.terms == ("lang",)
+    assert type(clustering.get_cluster_builder("lang")) is processors.ClusterBuilder
+    # Calendar intervals are not supported in-process.
+    cb = clustering.get_cluster_builder("created_at", engine="scan", interval="1M")
+    assert type(cb) is processors.ClusterBuilder
+    cb = clustering.get_cluster_builder("created_at", engine="scan", interval="1h")
+    assert type(cb) is clustering.ScanClusterBuilder
+
+
+def test_interval_to_ms():
+    assert clustering.interval_to_ms("5m") == 5*60*1000
+    assert clustering.interval_to_ms("hour") == 60*60*1000
+
+
+@patch("dataman.clustering.scroll")
+@patch("dataman.clustering.search")
+def test_scan_cluster_builder(search_mock, scroll_mock, settings):
+    settings.HOTSPOT_MIN_ENTRIES = 2
+    scroll_pages(
+        search_mock, scroll_mock,
+        [hit("1", "en", "UK"), hit("2", "en", "UK"), hit("3", "fr", "UK")],
+        [hit("4", "en", ["UK", "Ireland"]), hit("5", "fr", "France"),
+         hit("6", "fr", "France"), hit("7", None, "UK")]
+        )
+    cb = clustering.ScanClusterBuilder("lang", "country")
+    result = cb.get_clusters(normalize_text=False)
+
+    # A single pass, only necessary fields.
+    assert search_mock.call_count == 1
+    assert search_mock.call_args[0][0]["_source"] == ["text", "tokens", "lang", "country"]
+    assert [(x["lang"], x["country"], [doc["_id"] for doc in x["docs"]])
+            for x in result["clusters"]] == [
+        ("en", "UK", ["1", "2", "4"]),
+        ("fr", "France", ["5", "6"]),
+        ]
+
+
+@patch("dataman.clustering.scroll")
+@patch("dataman.clustering.search")
+def test_scan_cluster_builder__timestamp(search_mock, scroll_mock, settings):
+    settings.HOTSPOT_MIN_ENTRIES = 2
+    scroll_pages(
+        search_mock, scroll_mock,
+        [hit("1", "en", "UK", created_at="2018-07-13T10:02:31+00:00"),
+         hit("2", "en", "UK", created_at="2018-07-13T10:04:59+00:00"),
+         hit("3", "en", "UK", created_at="2018-07-13T10:05:00+00:00")]
+        )
+    cb = clustering.ScanClusterBuilder("created_at", interval="5m")
+    clusters = cb.get_clusters(normalize_text=False)["clusters"]
+    assert [x["created_at"] for x in clusters] == [1531476000000]
+
+
+@patch("dataman.clustering.scroll")
+@patch("dataman.clustering.search")
+def test_scan_geo_cluster_builder(search_mock, scroll_mock, settings):
+    settings.HOTSPOT_MIN_ENTRIES = 2
+    settings.GEO_CLUSTER_MAX_SIZE = 2
+    settings.GEO_CLUSTER_MAX_PRECISION = 5
+    pages = [
+        # "u4pru" cell.
+        [hit("1", "en", "UK", 57.649, 10.407), hit("2", "en", "UK", 57.650, 10.408),
+         hit("3", "fr", "UK", 57.651, 10.409)],
+        # "u4prg" cell.
+        [hit("4", "en", "UK", 57.63, 10.34), hit("5", "en", "UK", 57.63, 10.34)]
+        ]
+    scroll_pages(search_mock, scroll_mock, *pages)
+    cb = clustering.ScanGeoClusterBuilder("lang", precision=4)
+    clusters = cb.get_clusters(normalize_text=False)["clusters"]
+    assert [(x["lang"], [doc["_id"] for doc in x["docs"]]) for x in clusters] == [
+        ("en", ["1", "2", "4", "5"])
+        ]
+    # Bounds of all points of the cell.
+    assert (clusters[0]["top_left_lat"], clusters[0]["top_left_lon"]) == (57.651, 10.34)
+    assert (clusters[0]["bottom_right_lat"], clusters[0]["bottom_right_lon"]) == (57.63, 10.409)
+
+    # Cells with more than GEO_CLUSTER_MAX_SIZE docs are split.
+    scroll_pages(search_mock, scroll_mock, *pages)
+    cb = clustering.ScanGeoClusterBuilder("lang", precision=4, adaptive="true")
+    clusters = cb.get_clusters(normalize_text=False)["clusters"]
+    assert [(x["lang"], [doc["_id"] for doc in x["docs"]]) for x in clusters] == [
+        ("en", ["4", "5"]), ("en", ["1", "2"])
+        ]
+
+
+@patch("dataman.clustering.scroll")
+@patch("dataman.clustering.search")
+def test_scan_geo_cluster_builder__empty(search_mock, scroll_mock, settings):
+    settings.HOTSPOT_MIN_ENTRIES = 2
+    scroll_pages(search_mock, scroll_mock, [])
+    cb = clustering.ScanGeoClusterBuilder("lang", precision=4)
+    assert cb.get_clusters(normalize_text=False)["clusters"] == []
+
+    # No doc has the term.
+    scroll_pages(search_mock, scroll_mock,
+                 [hit("1", None, "UK", 57.649, 10.407), hit("2", None, "UK", 57.65, 10.408)])
+    cb = clustering.ScanGeoClusterBuilder("lang", precision=4, adaptive="true")
+    assert cb.get_clusters(normalize_text=False)["clusters"] == []
+
+
+@patch("dataman.clustering.scroll")
+@patch("dataman.clustering.search")
+def test_scan_cluster_builder__limits(search_mock, scroll_mock, settings):
+    settings.HOTSPOT_MIN_ENTRIES = 2
+    settings.CLUSTER_SCAN_MAX_DOCS = 3
+    pages = [[hit("1", "en", "UK"), hit("2", "en", "UK")], [hit("3", "en", "UK")]]
+
+    # Scroll failed on the second page.
+    scroll_pages(search_mock, scroll_mock, *pages)
+    scroll_mock.side_effect = None
+    scroll_mock.return_value = None
+    result = clustering.ScanClusterBuilder("lang").get_clusters(normalize_text=False)
+    assert [len(x["docs"]) for x in result["clusters"]] == [2]
+    assert result["errors"][0]["error"] == "Scroll stopped after 2 of 3 docs"
+
+    # Too many docs for the memory - clustered by ES.
+    scroll_mock.reset_mock()
+    scroll_pages(search_mock, scroll_mock, *(pages + [[hit("4", "en", "UK")]]))
+    with patch.object(processors.ClusterBuilder, "get_clusters") as get_clusters_mock:
+        clustering.ScanClusterBuilder("lang").get_clusters(normalize_text=False)
+    assert get_clusters_mock.call_count == 1
+    assert scroll_mock.call_count == 0
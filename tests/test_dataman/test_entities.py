@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from dataman import entities
+
+
+def make_tweet():
+    media = [{
+        "media_url": "http://pbs.twimg.com/media/1.jpg",
+        "media_url_https": "https://pbs.twimg.com/media/1.jpg"
+        }]
+    return {
+        "id": 3,
+        "text": "RT @nws: Flash Flood Warning #flood #Houston!",
+        "entities": {"hashtags": [{"text": "flood"}, {"text": "Houston"}]},
+        "retweeted_status": {
+            "id": 2,
+            "text": "Flash Flood Warning #flood #Houston!",
+            "user": {"description": "Storm chaser #wx", "followers_count": 10},
+            "extended_entities": {"media": media},
+            "quoted_status": {
+                "id": 1,
+                "text": "Roads are closed",
+                "entities": {
+                    "hashtags": [{"text": "txwx"}],
+                    "media": [{"media_url": "http://pbs.twimg.com/media/0.jpg"}]
+                    }
+                }
+            }
+        }
+
+
+def test_collect_entities():
+    result = entities.collect_entities(make_tweet())
+    assert result == {
+        "hashtags": {"flood", "Houston", "wx", "txwx"},
+        "media_urls": {
+            "http://pbs.twimg.com/media/0.jpg",
+            "http://pbs.twimg.com/media/1.jpg",
+            "https://pbs.twimg.com/media/1.jpg"
+            }
+        }
+
+
+def test_collect_entities__custom_extractors():
+    def extract_mentions(val):
+        if not isinstance(val, str):
+            return []
+        return [x.strip(":") for x in val.split() if x.startswith("@")]
+
+    extractors = dict(entities.ENTITY_EXTRACTORS, mentions=extract_mentions)
+    result = entities.collect_entities(make_tweet(), extractors)
+    assert result["mentions"] == {"@nws"}
+    assert result["hashtags"] == {"flood", "Houston", "wx", "txwx"}
+    assert entities.collect_entities({}) == {"hashtags": set(), "media_urls": set()}
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import mock
+import pytest
+
+from dataman import executors
+
+
+TEXTS = [
+    "flood warning issued for the county until further notice",
+    "flood warning issued for the county until further notice!",
+    "our home was damaged by the flooding in south texas",
+    "river levels are rising after heavy rain",
+    ]
+
+
+def make_clusters(sizes):
+    clusters = []
+    id_ = 0
+    for size in sizes:
+        docs = []
+        for i in range(size):
+            docs.append({"_id": str(id_), "_normalized_text": TEXTS[i % len(TEXTS)]})
+            id_ += 1
+        clusters.append({"docs": docs})
+    return clusters
+
+
+def done(result=None, exception=None):
+    future = Future()
+    if exception is None:
+        future.set_result(result)
+    else:
+        future.set_exception(exception)
+    return future
+
+
+def patch_executor(executor):
+    return mock.patch("dataman.executors.get_executor", return_value=executor)
+
+
+@pytest.fixture
+def parallel(settings):
+    settings.CATEGORIZE_PROCESSES = 2
+    settings.CATEGORIZE_PARALLEL_MIN_DOCS = 1
+    yield settings
+    executors.shutdown_executor()
+
+
+def test_categorize_clusters(parallel):
+    sizes = [3, 8, 1, 5]
+    serial = executors._categorize_serial(make_clusters(sizes), "edit")
+    pooled = executors.categorize_clusters(make_clusters(sizes), centrality="edit")
+    assert pooled == serial
+    assert [len(x["representative_docs"]) + len(x["non_representative_docs"])
+            for x in pooled] == sizes
+
+
+def test_categorize_clusters__order(parallel):
+    executor = mock.Mock()
+    executor.submit.side_effect = lambda func, docs, centrality: done(len(docs))
+    with patch_executor(executor):
+        result = executors.categorize_clusters(make_clusters([1, 3, 2]), centrality="edit")
+    # The largest cluster is submitted first, results are in the order of clusters.
+    assert [len(x[0][1]) for x in executor.submit.call_args_list] == [3, 2, 1]
+    assert result == [1, 3, 2]
+
+
+def test_categorize_clusters__small(parallel):
+    parallel.CATEGORIZE_PARALLEL_MIN_DOCS = 10
+    with patch_executor(mock.Mock()) as get_executor:
+        result = executors.categorize_clusters(make_clusters([1, 3, 2]), centrality="edit")
+    assert not get_executor.called
+    assert len(result) == 3
+
+    # No pool.
+    parallel.CATEGORIZE_PARALLEL_MIN_DOCS = 1
+    parallel.CATEGORIZE_PROCESSES = 0
+    with patch_executor(mock.Mock()) as get_executor:
+        result = executors.categorize_clusters(make_clusters([1, 3, 2]), centrality="edit")
+    assert not get_executor.called
+    assert len(result) == 3
+
+
+@pytest.mark.parametrize("exception", [
+    BrokenProcessPool("A child process terminated abruptly"),
+    OSError("Cannot allocate memory"),
+    AssertionError("daemonic processes are not allowed to have children"),
+    ])
+def test_categorize_clusters__fallback(parallel, exception):
+    sizes = [3, 8, 1, 5]
+    executor = mock.Mock()
+    executor.submit.return_value = done(exception=exception)
+    with patch_executor(executor), \
+            mock.patch("dataman.executors.shutdown_executor") as shutdown:
+        result = executors.categorize_clusters(make_clusters(sizes), centrality="edit")
+    assert shutdown.called
+    assert result == executors._categorize_serial(make_clusters(sizes), "edit")
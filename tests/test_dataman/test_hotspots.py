@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import numpy
+from mock import patch
+
+from dataman import hotspots
+
+
+def points(lat, lon, n, spread=0.001, seed=0):
+    rng = numpy.random.RandomState(seed)
+    return (lat + rng.uniform(-spread, spread, n)).tolist(), \
+        (lon + rng.uniform(-spread, spread, n)).tolist()
+
+
+def test_grid_dbscan():
+    london = points(51.507, -0.128, 20)
+    paris = points(48.857, 2.352, 10, seed=1)
+    lats = london[0] + paris[0] + [40.]
+    lons = london[1] + paris[1] + [-3.]
+    labels = hotspots.grid_dbscan(lats, lons, eps=1000, min_entries=5)
+    assert len(set(labels[:20])) == 1
+    assert len(set(labels[20:30])) == 1
+    assert labels[0] != labels[20]
+    assert labels[30] == hotspots.NOISE
+
+    # Too sparse.
+    labels = hotspots.grid_dbscan(lats, lons, eps=1000, min_entries=50)
+    assert (labels == hotspots.NOISE).all()
+    assert len(hotspots.grid_dbscan([], [], eps=1000, min_entries=5)) == 0
+
+
+def test_grid_dbscan__chain():
+    # Points 500m apart along a meridian form a single cluster.
+    lats = (numpy.arange(10) * 500. / 111195.).tolist()
+    labels = hotspots.grid_dbscan(lats, [0.] * 10, eps=600, min_entries=3)
+    assert (labels == labels[0]).all() and labels[0] != hotspots.NOISE
+
+
+def test_find_hotspots():
+    london = points(51.507, -0.128, 20)
+    paris = points(48.857, 2.352, 10, seed=1)
+    found = hotspots.find_hotspots(london[0] + paris[0], london[1] + paris[1],
+                                   eps=1000, min_entries=5)
+    assert [x["doc_count"] for x in found] == [20, 10]
+    assert abs(found[0]["location"]["lat"] - 51.507) < 0.001
+    assert abs(found[0]["location"]["lon"] + 0.128) < 0.001
+    assert found[0]["bounds"]["top_left"]["lat"] == max(london[0])
+    assert found[0]["bounds"]["bottom_right"]["lon"] == max(london[1])
+    assert found[0]["key"].startswith("gcpv")
+
+    assert len(hotspots.find_hotspots(london[0] + paris[0], london[1] + paris[1],
+                                      eps=1000, min_entries=5, size=1)) == 1
+
+
+def scroll_pages(lats, lons, batch):
+    hits = [{"_source": {"location": {"lat": lat, "lon": lon}}} for lat, lon in zip(lats, lons)]
+    pages = [hits[i:i + batch] for i in range(0, len(hits), batch)] + [[]]
+    return [{"_scroll_id": "s", "hits": {"total": len(hits), "hits": page}} for page in pages]
+
+
+@patch("dataman.hotspots.clear_scroll")
+@patch("dataman.hotspots.scroll")
+@patch("dataman.hotspots.search")
+def test_get_hotspots(search_mock, scroll_mock, clear_mock, settings):
+    settings.ES_GEO_FIELD = "location"
+    settings.ES_SCROLL_BATCHSIZE = 10
+    settings.HOTSPOTS_MAX_DOCS = 30
+    london = points(51.507, -0.128, 20)
+    pages = scroll_pages(london[0], london[1], 10)
+    search_mock.return_value = pages[0]
+    scroll_mock.side_effect = pages[1:]
+    found = hotspots.get_hotspots({"match_all": {}}, eps=1000, min_entries=5)
+    assert [x["doc_count"] for x in found] == [20]
+    assert clear_mock.call_count == 1
+
+    # Too many docs.
+    settings.HOTSPOTS_MAX_DOCS = 10
+    scroll_mock.reset_mock()
+    assert hotspots.get_hotspots({"match_all": {}}, eps=1000, min_entries=5) is None
+    assert not scroll_mock.called
+    assert clear_mock.call_count == 2
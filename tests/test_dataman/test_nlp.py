@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from mock import patch, Mock
+
+from dataman import nlp
+
+
+class Chunk(list):
+    def __init__(self, words, tag):
+        super().__init__(words)
+        self.tag = tag
+
+
+def fake_text(lang, entities):
+    return Mock(language=Mock(code=lang), entities=entities)
+
+
+@patch("dataman.nlp.Text")
+def test_analyze_many(text_mock):
+    nlp.analyze.cache_clear()
+    text_mock.side_effect = lambda text: {
+        "Flooding in New Orleans": fake_text(
+            "en", [Chunk(["New", "Orleans"], "I-LOC"), Chunk(["FEMA"], "I-ORG")]),
+        "Inondations": fake_text("fr", []),
+        "Powódź w Krakowie": fake_text("pl", [Chunk(["Krakowie"], "I-LOC")]),
+        }[text]
+
+    texts = ["Flooding in New Orleans", "Inondations",
+             "Powódź w Krakowie", "Flooding in New Orleans"]
+    assert nlp.analyze_many(texts) == [
+        nlp.Analysis("en", ("New Orleans",)),
+        nlp.Analysis("fr", ()),
+        nlp.Analysis("pl", ()),
+        nlp.Analysis("en", ("New Orleans",)),
+        ]
+    # Repeated texts are analyzed once.
+    assert text_mock.call_count == 3
+    nlp.analyze.cache_clear()
+
+
+@patch("dataman.nlp.get_ner_tagger")
+def test_warm_up(tagger_mock):
+    def get_ner_tagger(lang):
+        if lang != "en":
+            raise ValueError("Package 'ner2.{}' not found".format(lang))
+        return Mock()
+
+    tagger_mock.side_effect = get_ner_tagger
+    assert nlp.warm_up(["en", "xx"]) == ["en"]
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+import re
+import random
+
+import geopy
+from mock import patch
+
+from dataman import processors, nlp
+
+
+def normalize_reference(text):
+    """
+    Step-by-step normalization, `normalize_aggressive` must match it exactly.
+    """
+    text = re.sub(r'\s+&amp;?\s+', ' and ', text)
+    text = re.sub(r'@[A-Za-z0-9_]+\b', '_USER_ ', text)
+    text = re.sub(r"\b\d\d?:\d\d\s*[ap]\.?m\.?\b", '_TIME_', text, flags=re.IGNORECASE)
+    text = re.sub(r"\b\d\d?\s*[ap]\.?m\.?\b", '_TIME_', text, flags=re.IGNORECASE)
+    text = re.sub(r"\b\d\d?:\d\d:\d\d\b", '_TIME_', text, flags=re.IGNORECASE)
+    text = re.sub(r"\b\d\d?:\d\d\b", '_TIME_', text, flags=re.IGNORECASE)
+    text = re.sub(r'\bhttps?:\S+', ' _URL_ ', text, flags=re.IGNORECASE)
+    text = re.sub(r'\s+https?$', ' _URL_', text, flags=re.IGNORECASE)
+    text = re.sub(r'[^\w\d\s:\'",.\(\)#@\?!/’_]+', '', text)
+    text = re.sub(r'\n', ' ', text)
+    text = re.sub(r'\s{2,}', ' ', text)
+    return text.strip()
+
+
+def test_normalize_aggressive():
+    text = "RT @isaabitch_: Flood Warning from 6/26/2018 2:12 PM CDT &amp; \n\n more at https://t.co/vKuSPSFI33 #flood 🌊"
+    assert processors.normalize_aggressive(text) == \
+        "RT _USER_ : Flood Warning from 6/26/2018 _TIME_ CDT and more at _URL_ #flood"
+    assert processors.normalize_aggressive(text) == normalize_reference(text)
+
+
+def test_normalize_many__same_as_reference():
+    rnd = random.Random(0)
+    pieces = ["12", ":", "30", "pm", "AM", "a.m.", "5", "1:23:45", " ", "\n", "\t",
+              "@bob", "&amp;", "&amp ", "http", "https://t.co/x", "http:", " https",
+              "x", "_", "é", "🌊", "#tag", "’", "-", "2:1", "07:05"]
+    texts = ["".join(rnd.choice(pieces) for _ in range(rnd.randint(1, 12)))
+             for _ in range(20000)]
+    assert processors.normalize_many(texts) == [normalize_reference(x) for x in texts]
+
+
+def test_projection_plan():
+    doc = {
+        "id": 1,
+        "tweetid": "1",
+        "text": "Flood in #Houston",
+        "location": {"lat": 29.76, "lon": -95.37},
+        "place": {"full_name": "Houston, TX", "name": "Houston"},
+        "entities": {"hashtags": [{"text": "Houston"}]},
+        "user": {"id": 2, "name": "nws", "lang": None},
+        }
+    plan = processors.ProjectionPlan(["id", "tweetid", "text", "place", "user/id",
+                                      "user/name", "user/location"], ["location"])
+    assert plan.project(doc) == {
+        "tweetid": "1",
+        "text": "Flood in #Houston",
+        "location": {"lat": 29.76, "lon": -95.37},
+        "user_id": 2,
+        "user_name": "nws",
+        "user_location": None
+        }
+
+    # Re-indexed docs are flat already.
+    flat = processors.ProjectionPlan(["user/id"]).project({"user_id": 2})
+    assert flat == {"user_id": 2}
+
+    nested = processors.ProjectionPlan(["text", "place/name"], flatten=False)
+    assert nested.project(doc) == {
+        "tweetid": "1",
+        "text": "Flood in #Houston",
+        "location": {"lat": 29.76, "lon": -95.37},
+        "place": {"name": "Houston"}
+        }
+    assert processors.get_projection_plan(frozenset(["text"]), frozenset()) \
+        is processors.get_projection_plan(frozenset(["text"]), frozenset())
+
+
+@patch("dataman.processors.enqueue")
+@patch("dataman.processors.geocode_cached")
+def test_set_geotag__async(cached_mock, enqueue_mock):
+    tweet = {
+        "id": 1,
+        "id_str": "1",
+        "text": "Flooding in Houston",
+        "lang": "en",
+        "annotations": {"flood_probability": 0.9},
+        "user": {"location": "Texas"}
+        }
+    analysis = nlp.Analysis("en", ("Houston",))
+
+    # Place is not known yet: submitted to the queue, doc is pending.
+    cached_mock.return_value = None
+    norm = processors.TweetNormalizer(tweet, geocode_async=True)
+    assert not norm.set_geotag(analysis)
+    assert norm.normalized["geo_pending"]
+    enqueue_mock.assert_called_once_with(["Houston"])
+
+    cached_mock.return_value = {"lat": 29.76328, "lon": -95.36327}
+    norm = processors.TweetNormalizer(tweet, geocode_async=True)
+    assert norm.set_geotag(analysis)
+    assert norm.normalized["place"] == "Houston"
+    assert norm.normalized["location"] == {"lat": 29.76328, "lon": -95.36327}
+    assert "geo_pending" not in norm.normalized
+    assert enqueue_mock.call_count == 1
+
+
+@patch.object(processors.TweetNormalizer, "set_geotag")
+def test_preprocess__geocode_error(set_geotag_mock):
+    tweet = {
+        "id": 1,
+        "id_str": "1",
+        "text": "Flooding in Houston",
+        "lang": "en",
+        "created_at": "Sat Jun 23 19:19:51 +0000 2018",
+        "annotations": {"flood_probability": 0.9}
+        }
+    # Nominatim failed: the doc is left to `fill_geotags`.
+    set_geotag_mock.side_effect = geopy.exc.GeocoderQuotaExceeded("Too many requests")
+    norm = processors.TweetNormalizer(tweet)
+    assert not norm.preprocess(nlp.Analysis("en", ("Houston",)))
+    assert norm.normalized["geo_pending"]
+
+
+@patch("dataman.processors.rc")
+@patch("dataman.processors.cc")
+def test_set_countries(cc_mock, rc_mock):
+    cc_mock.get_countries.return_value = ["United States", None]
+    rc_mock.get_regions.return_value = [None, None, "FR10"]
+    norms = []
+    for id_, location, country in [
+            (1, {"lat": 29.76328, "lon": -95.36327}, None),
+            (2, {"lat": 0., "lon": -160.}, None),
+            (3, {"lat": 48.85341, "lon": 2.3488}, "France")]:
+        tweet = {
+            "id": id_,
+            "id_str": str(id_),
+            "text": "Flooding",
+            "annotations": {"flood_probability": 0.9},
+            "place": "Somewhere"
+            }
+        norm = processors.TweetNormalizer(tweet)
+        norm.normalized.update({"location": location, "country": country})
+        norms.append(norm)
+
+    processors.set_countries(norms)
+    cc_mock.get_countries.assert_called_once_with(
+        [29.76328, 0.], [-95.36327, -160.])
+    assert [norm.normalized["country"] for norm in norms] == \
+        ["United States", "None", "France"]
+    assert all(norm.normalized["place"] == "Somewhere" for norm in norms)
+    assert [norm.normalized.get("region") for norm in norms] == [None, None, "FR10"]
+
+
+@patch("dataman.processors.msearch")
+def test_collect_clusters__msearch(msearch_mock, settings):
+    settings.ES_MSEARCH_BATCHSIZE = 2
+    settings.HOTSPOT_MIN_ENTRIES = 2
+
+    def response(n):
+        hits = [{
+            "_id": str(i),
+            "_source": {"text": "flood", "tokens": ["flood"],
+                        "normalized_text": "flood", "fingerprint": [1]}
+            } for i in range(n)]
+        return {"hits": {"total": n, "hits": hits}}
+
+    msearch_mock.side_effect = [
+        [response(3), {"error": "failed"}],
+        [response(1)]
+        ]
+    cb = processors.ClusterBuilder("country", lang="en")
+    segments = [{"country": "France"}, {"country": "Spain"}, {"country": "Italy"}]
+    clusters = cb.collect_clusters(segments, normalize_text=True)
+
+    assert msearch_mock.call_count == 2
+    queries = msearch_mock.call_args_list[0][0][0]
+    assert len(queries) == 2
+    assert queries[0]["_source"] == ["text", "tokens", "normalized_text", "fingerprint"]
+    assert [x["country"] for x in clusters] == ["France"]
+    assert len(clusters[0]["docs"]) == 3
+    assert clusters[0]["docs"][0]._normalized_text == "flood"
+    assert len(cb.errors) == 1
+
+
+@patch("dataman.processors.search")
+def test_iter_segments__composite(search_mock, settings):
+    settings.ES_COMPOSITE_SIZE = 2
+    settings.HOTSPOT_MIN_ENTRIES = 2
+
+    def page(*keys):
+        buckets = [{"key": {"country": country, "lang": "en"}, "doc_count": count}
+                   for country, count in keys]
+        return {"aggregations": {"segments": {"buckets": buckets}}}
+
+    search_mock.side_effect = [
+        page(("France", 10), ("Italy", 1)),
+        page(("Spain", 5), ("UK", 3)),
+        page(("USA", 2)),
+        ]
+    cb = processors.ClusterBuilder("country", "lang")
+    query = cb.build_query(size=0)
+    pages = list(cb.iter_segments(query))
+    assert pages == [
+        [{"country": "France", "lang": "en"}],
+        [{"country": "Spain", "lang": "en"}, {"country": "UK", "lang": "en"}],
+        [{"country": "USA", "lang": "en"}],
+        ]
+
+    assert search_mock.call_count == 3
+    composite = search_mock.call_args_list[-1][0][0]["aggregations"]["segments"]["composite"]
+    assert composite["after"] == {"country": "UK", "lang": "en"}
+    assert composite["sources"] == [
+        {"country": {"terms": {"field": "country.keyword"}}},
+        {"lang": {"terms": {"field": "lang.keyword"}}}
+        ]
+
+
+@patch("dataman.processors.msearch")
+@patch("dataman.processors.search")
+def test_geo_cluster_builder__adaptive(search_mock, msearch_mock, settings):
+    settings.GEO_CLUSTER_MAX_SIZE = 10
+    settings.GEO_CLUSTER_MAX_PRECISION = 5
+    settings.HOTSPOT_MIN_ENTRIES = 2
+
+    def bucket(key, count):
+        return {
+            "key": key,
+            "doc_count": count,
+            "cell": {"bounds": {"top_left": {"lat": 1., "lon": 1.},
+                                "bottom_right": {"lat": 0., "lon": 2.}}},
+            "doc_count_lang": {"buckets": [{"key": "en", "doc_count": count}]}
+            }
+
+    def response(*buckets):
+        return {"aggregations": {"segments": {"buckets": list(buckets)}}}
+
+    search_mock.return_value = response(bucket("u4p", 100), bucket("u4r", 5))
+    msearch_mock.side_effect = [
+        # "u4n0" is a neighbour of "u4p" (a point on the edge).
+        [response(bucket("u4pr", 50), bucket("u4p0", 3), bucket("u4n0", 1))],
+        [response(bucket("u4pru", 30), bucket("u4prv", 20))]
+        ]
+    cb = processors.GeoClusterBuilder("lang", adaptive="true")
+    assert cb.precision == settings.GEO_CLUSTER_MIN_PRECISION
+    pages = list(cb.iter_segments(cb.build_query(size=0)))
+
+    # "u4pru" and "u4prv" are at max precision, so they aren't split.
+    assert [len(page) for page in pages] == [1, 1, 2]
+    assert msearch_mock.call_count == 2
+    query = msearch_mock.call_args_list[0][0][0][0]
+    assert query["aggregations"]["segments"]["geohash_grid"]["precision"] == 4
+    assert {"geo_bounding_box": {"location": {
+        "top_left": {"lat": 57.65625, "lon": 9.84375},
+        "bottom_right": {"lat": 56.25, "lon": 11.25}
+        }}} in query["query"]["bool"]["filter"]
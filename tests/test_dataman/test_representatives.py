@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from dataman.representatives import SegmentRepresentatives, segment_key
+
+
+def docs(*texts, start=10):
+    return [{"_id": str(start + i), "_normalized_text": text}
+            for i, text in enumerate(texts)]
+
+
+def test_segment_key():
+    assert segment_key({"lang": "en", "country": "UK", "docs": []}) == \
+        segment_key({"country": "UK", "lang": "en"})
+
+
+def test_update():
+    original = "Since the Flooding occurred in South Texas our home has gone through extensive damage"
+    state = SegmentRepresentatives("test")
+    result = state.update(docs(original, "RT _USER_ : " + original))
+    assert [x["_id"] for x in result["representative_docs"]] == ["10"]
+    assert [x["_id"] for x in result["non_representative_docs"]] == ["11"]
+
+    # Next run: only compared to stored representatives.
+    result = state.update(docs(original + " _URL_", "Flood warning for Atchison County", start=20))
+    assert [x["_id"] for x in result["representative_docs"]] == ["21"]
+    assert [x["_id"] for x in result["non_representative_docs"]] == ["20"]
+    assert state.representatives[0]["multiplicity"] == 3
+
+    # Late doc, older than the representative, takes its place.
+    result = state.update(docs(original, start=5))
+    assert result["demoted"] == ["10"]
+    assert state.representatives[0]["_id"] == "5"
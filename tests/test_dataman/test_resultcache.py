@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+import mock
+import pytest
+
+from django.core.cache import caches
+
+from dataman import resultcache
+
+
+@pytest.fixture
+def cache(settings):
+    settings.CLUSTER_CACHE = "default"
+    settings.CLUSTER_CACHE_TTL = 60
+    settings.CLUSTER_CACHE_BUCKET = 5
+    settings.CLUSTER_CACHE_MAX_BUCKETS = 288
+    settings.ES_REFRESH_INTERVAL = 0
+    caches["default"].clear()
+    return caches["default"]
+
+
+def test_canonical_filters():
+    filters = resultcache.canonical_filters({
+        "created_at__gte": "2018-07-13T10:02:31+00:00",
+        "created_at__lt": "2018-07-13T11:01:00+00:00",
+        "lang": "en",
+        "top_left_lat": 51.5,
+        })
+    # The range is exact: results hold only docs of the requested one.
+    assert filters == {
+        "created_at__gte": "2018-07-13T10:02:31+00:00",
+        "created_at__lt": "2018-07-13T11:01:00+00:00",
+        "lang": "en",
+        "top_left_lat": "51.5",
+        }
+    # Other user - the same filters.
+    assert resultcache.canonical_filters({
+        "created_at__gte": "2018-07-13T10:02:31+00:00",
+        "created_at__lt": "2018-07-13T11:01:00+00:00",
+        "lang": "en",
+        "top_left_lat": 51.5,
+        "username": "test",
+        "api_key": "d41d8cd98f00b204e9800998ecf8427e",
+        "format": "json",
+        }) == filters
+
+
+def test_get_buckets(settings):
+    settings.CLUSTER_CACHE_BUCKET = 5
+    settings.CLUSTER_CACHE_MAX_BUCKETS = 12
+    filters = {
+        "created_at__gte": "2018-07-13T10:00:00+00:00",
+        "created_at__lte": "2018-07-13T10:15:00+00:00",
+        }
+    assert len(resultcache.get_buckets(filters)) == 3
+    assert resultcache.get_buckets({"created_at__gte": filters["created_at__gte"]}) is None
+    filters["created_at__lte"] = "2018-07-13T11:05:00+00:00"
+    assert resultcache.get_buckets(filters) is None
+    # Bounds within buckets.
+    assert len(resultcache.get_buckets({
+        "created_at__gt": "2018-07-13T10:02:31+00:00",
+        "created_at__lt": "2018-07-13T10:11:00+00:00",
+        })) == 3
+
+
+def test_cached(cache):
+    filters = resultcache.canonical_filters({
+        "created_at__gte": "2018-07-13T10:00:00+00:00",
+        "created_at__lte": "2018-07-13T10:15:00+00:00",
+        })
+    compute = mock.Mock(return_value=[{"docs": []}])
+    assert resultcache.cached("test", ["lang"], filters, compute) == [{"docs": []}]
+    assert resultcache.cached("test", ["lang"], filters, compute) == [{"docs": []}]
+    assert compute.call_count == 1
+
+    # Other terms - other result.
+    resultcache.cached("test", ["country"], filters, compute)
+    assert compute.call_count == 2
+
+    # New doc out of the range.
+    resultcache.invalidate([{"created_at": "2018-07-13T10:20:00+00:00"}])
+    resultcache.cached("test", ["lang"], filters, compute)
+    assert compute.call_count == 2
+
+    # New doc in the range.
+    resultcache.invalidate([{"created_at": "2018-07-13T10:07:00+00:00"}])
+    resultcache.cached("test", ["lang"], filters, compute)
+    assert compute.call_count == 3
+
+    # Deleted doc.
+    resultcache.invalidate_all()
+    resultcache.cached("test", ["lang"], filters, compute)
+    assert compute.call_count == 4
+
+
+def test_cached__open_range(cache):
+    filters = resultcache.canonical_filters({
+        "created_at__gte": "2018-07-13T10:00:00+00:00"
+        })
+    compute = mock.Mock(return_value=[])
+    resultcache.cached("test", ["lang"], filters, compute)
+    resultcache.invalidate([{"created_at": "2018-07-13T09:00:00+00:00"}])
+    resultcache.cached("test", ["lang"], filters, compute)
+    assert compute.call_count == 2
+
+
+def test_cached__disabled(settings):
+    settings.CLUSTER_CACHE_TTL = 0
+    compute = mock.Mock(return_value=[])
+    resultcache.cached("test", ["lang"], {}, compute)
+    resultcache.cached("test", ["lang"], {}, compute)
+    assert compute.call_count == 2
+
+
+def test_cached__refresh(cache, settings):
+    settings.ES_REFRESH_INTERVAL = 60
+    filters = resultcache.canonical_filters({
+        "created_at__gte": "2018-07-13T10:00:00+00:00",
+        "created_at__lte": "2018-07-13T10:15:00+00:00",
+        })
+    compute = mock.Mock(return_value=[])
+    resultcache.cached("test", ["lang"], filters, compute)
+    resultcache.cached("test", ["lang"], filters, compute)
+    assert compute.call_count == 1
+
+    # New doc may be not searchable yet - results are not cached.
+    resultcache.invalidate([{"created_at": "2018-07-13T10:07:00+00:00"}])
+    resultcache.cached("test", ["lang"], filters, compute)
+    resultcache.cached("test", ["lang"], filters, compute)
+    assert compute.call_count == 3
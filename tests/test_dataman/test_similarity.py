@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import random
+from itertools import combinations
+from string import ascii_lowercase
+
+from Levenshtein import ratio
+
+from dataman import similarity
+
+
+def random_texts(size, seed=0):
+    rnd = random.Random(seed)
+    words = ["".join(rnd.choice(ascii_lowercase) for _ in range(rnd.randint(2, 9)))
+             for _ in range(1000)]
+    originals = [" ".join(rnd.choice(words) for _ in range(rnd.randint(6, 18)))
+                 for _ in range(size // 5)]
+    texts = []
+    for _ in range(size):
+        text = rnd.choice(originals)
+        dice = rnd.random()
+        if dice < 0.3:
+            text = "RT _USER_ : " + text
+        elif dice < 0.5:
+            text = text + " _URL_"
+        elif dice < 0.6:
+            text = text[:int(len(text)*0.9)]
+        texts.append(text)
+    return texts
+
+
+def exact_pairs(texts):
+    return set(
+        (i, j) for i, j in combinations(range(len(texts)), 2)
+        if ratio(texts[i], texts[j]) > similarity.SIMILAR_PREDICTION_EDIT_DISTANCE_MAX
+        )
+
+
+def test_shingles():
+    assert similarity.shingles("abc", 4) == {"abc"}
+    assert similarity.shingles("abcdef", 4) == {"abcd", "bcde", "cdef"}
+
+
+def test_fingerprint_is_deterministic():
+    text = "Since the Flooding occurred in South Texas our home has gone through"
+    fingerprint = similarity.MinHasher().fingerprint(text)
+    assert len(fingerprint) == similarity.LSH_BANDS
+    assert fingerprint == similarity.MINHASHER.fingerprint(text)
+
+
+def test_near_duplicate_pairs__small():
+    texts = random_texts(similarity.LSH_MIN_DOCS - 1)
+    assert set(similarity.near_duplicate_pairs(texts)) == exact_pairs(texts)
+
+
+def test_near_duplicate_pairs__lsh():
+    texts = random_texts(500)
+    found = set(similarity.near_duplicate_pairs(texts))
+    assert found == exact_pairs(texts)
+    assert len(similarity.candidate_pairs(texts)) < len(texts)*(len(texts) - 1) // 4
+
+
+def test_kernel_scan():
+    texts = random_texts(60)
+    similarities, duplicates = similarity.SimilarityKernel(texts).scan()
+    assert set(duplicates) == exact_pairs(texts)
+    for i, text in enumerate(texts):
+        expected = sum(ratio(text, other) for other in texts)
+        assert abs(similarities[i] - expected) < 1e-9
+
+
+def test_kernel_duplicates__length_pruning():
+    texts = ["flood", "flood in the city", "flood in the city!", ""]
+    kernel = similarity.SimilarityKernel(texts)
+    assert kernel.real_quick_ratio(0, 1) < similarity.SIMILAR_PREDICTION_EDIT_DISTANCE_MAX
+    assert kernel.real_quick_ratio(3, 3) == 1.
+    assert kernel.duplicates() == [(1, 2)]
+    assert kernel.duplicates([(2, 1), (0, 1)]) == [(1, 2)]
+
+
+def test_tfidf_centrality():
+    token_lists = [
+        ["flood", "texa", "home"],
+        ["flood", "texa", "damag"],
+        ["flood", "texa", "home", "damag"],
+        ["weather", "forecast"],
+        [],
+        ]
+    centrality = similarity.tfidf_centrality(token_lists)
+    assert len(centrality) == len(token_lists)
+    # The doc closest to everything else is the most central one.
+    assert centrality.argmax() == 2
+    assert centrality[3] == min(centrality[:4])
+    # Unrelated doc is only similar to itself.
+    assert abs(centrality[3] - 1.) < 1e-9
+    assert centrality[4] == 1.
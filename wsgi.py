@@ -14,3 +14,10 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings.base")
 
 application = get_wsgi_application()
+
+# Load NLP models and gazetteer before the first request (tweets are
+# normalized on POST).
+from dataman import nlp
+from core import gazetteer
+nlp.warm_up()
+gazetteer.get_gazetteer()